@@ -0,0 +1,317 @@
+"""Микробенчмарки бота: хранилище, автографик, "Мой график" и рассылка напоминаний
+
+Запуск:
+    python benchmarks.py --users 1000,10000,100000 --output bench.json
+    python benchmarks.py --compare bench_old.json bench.json
+
+Каждый размер базы считается в отдельном процессе, чтобы пиковая память (RSS)
+относилась только к нему. Результаты пишутся в JSON вместе с коммитом git.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import pytz
+
+import shift_bot_FINAL as bot
+
+# Сколько отдельных операций замерять для перцентилей
+SAMPLE_SIZE = 2000
+
+class NoopBot:
+    """Заглушка бота: send_message ничего не отправляет"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text):
+        self.sent += 1
+
+def peak_rss_mb():
+    """Пиковая память процесса в МБ (ru_maxrss в Linux - в КБ)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize(name, latencies, total=None, ops=None):
+    """Сводка по замерам: пропускная способность и перцентили задержки в мс"""
+    latencies = sorted(latencies)
+    ops = ops if ops is not None else len(latencies)
+    total = total if total is not None else sum(latencies)
+    return {
+        'name': name,
+        'ops': ops,
+        'total_s': round(total, 6),
+        'throughput_per_s': round(ops / total, 1) if total else None,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 4),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 4),
+    }
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+def build_users(count, manual_share, rng):
+    """Синтетическая база: у большинства автографик и пара ручных правок, у части - только ручные смены"""
+    today = date.today()
+    users = {}
+    for user_id in range(1, count + 1):
+        shifts = []
+        rules = []
+        if rng.random() < manual_share:
+            # Старый стиль: месяц смен, добавленных по одной
+            for offset in range(30):
+                shifts.append(((today + timedelta(days=offset)).toordinal(), rng.choice(bot.SHIFT_CYCLE)))
+        else:
+            anchor = today - timedelta(days=rng.randint(0, 365))
+            rules.append(bot.ShiftRule(anchor, rng.choice(bot.SHIFT_CYCLE), tuple(bot.SHIFT_CYCLE)))
+            for _ in range(rng.randint(0, 5)):
+                day = today + timedelta(days=rng.randint(0, 90))
+                shifts.append((day.toordinal(), rng.choice(bot.SHIFT_CYCLE + [None])))
+        users[str(user_id)] = bot.UserSchedule(rules, bot.PackedShifts(shifts))
+    return users
+
+def run_size(users_count, repeat, manual_share, seed):
+    """Все замеры для одного размера базы; файлы - во временном каталоге, он удаляется"""
+    with tempfile.TemporaryDirectory(prefix='shift_bench_') as workdir:
+        return measure_size(workdir, users_count, repeat, manual_share, seed)
+
+def measure_size(workdir, users_count, repeat, manual_share, seed):
+    """Замеры для одного размера базы с файлами в workdir"""
+    rng = random.Random(seed)
+    results = []
+    json_path = os.path.join(workdir, 'schedule.json')
+    db_path = os.path.join(workdir, 'schedule.db')
+
+    users = build_users(users_count, manual_share, rng)
+    raw = bot.dump_schedule(users)
+    bot.save_schedule(raw, json_path)
+    del raw
+    user_ids = list(users)
+    del users
+    sample_ids = [rng.choice(user_ids) for _ in range(min(SAMPLE_SIZE, users_count))]
+    file_size = os.path.getsize(json_path)
+
+    # Чтение и запись schedule.json целиком
+    load_times, save_times = [], []
+    for _ in range(repeat):
+        elapsed, raw = timed(bot.load_schedule, json_path)
+        load_times.append(elapsed)
+        elapsed, _ = timed(bot.save_schedule, raw, json_path)
+        save_times.append(elapsed)
+        del raw
+    results.append(summarize('load_schedule', load_times))
+    results.append(summarize('save_schedule', save_times))
+
+    # Запуск хранилища: разбор файла и построение индекса
+    elapsed, storage = timed(bot.JsonScheduleStorage, json_path)
+    results.append(summarize('json_storage_startup', [elapsed]))
+
+    # Двоичный снимок с упакованными сменами: запись, чтение целиком и через mmap
+    packed_path = os.path.join(workdir, 'schedule.packed')
+    elapsed, _ = timed(bot.save_packed_schedule, storage.users, packed_path)
+    results.append(summarize('packed_save', [elapsed]))
+    for name, use_mmap in (('packed_load', False), ('packed_load_mmap', True)):
+        elapsed, _ = timed(bot.load_packed_schedule, packed_path, use_mmap)
+        results.append(summarize(name, [elapsed]))
+    packed_size = os.path.getsize(packed_path)
+
+    # Генерация автографика на год (старый путь материализации дат)
+    generate_times = []
+    for _ in range(min(200, SAMPLE_SIZE)):
+        elapsed, _ = timed(bot.generate_auto_schedule, '01.01.2026', rng.choice(bot.SHIFT_CYCLE), 365)
+        generate_times.append(elapsed)
+    results.append(summarize('generate_auto_schedule_365', generate_times))
+
+    # Текст "Мой график"
+    today = date.today()
+    render_times = []
+    for user_id in sample_ids:
+        elapsed, _ = timed(bot.build_schedule_message, storage, user_id, today)
+        render_times.append(elapsed)
+    results.append(summarize('build_schedule_message', render_times))
+
+    # "Мой график" через кэш: первый просмотр строит текст, повторный - поиск в словаре
+    cache = bot.ScheduleRenderCache(storage, maxsize=len(sample_ids))
+    for name in ('render_cache_miss', 'render_cache_hit'):
+        render_times = []
+        for user_id in dict.fromkeys(sample_ids):
+            elapsed, _ = timed(cache.get, user_id, today)
+            render_times.append(elapsed)
+        results.append(summarize(name, render_times))
+
+    # Запись одной смены в память и сброс пачки на диск
+    write_times = []
+    for user_id in sample_ids:
+        elapsed, _ = timed(storage.set_shift, user_id, today + timedelta(days=rng.randint(0, 60)), 'day')
+        write_times.append(elapsed)
+    results.append(summarize('json_set_shift', write_times))
+    # В боте цикл событий ждёт только снимка, запись идёт в потоке (flush_async)
+    elapsed, _ = timed(storage._snapshot)
+    results.append(summarize('json_flush_snapshot', [elapsed]))
+    elapsed, _ = timed(storage.flush)
+    results.append(summarize('json_flush_batch', [elapsed]))
+
+    # Автозаполнение команды: автографики многих пользователей одной операцией хранилища
+    team_rules = {
+        user_id: bot.ShiftRule(today + timedelta(days=rng.randint(0, 30)), rng.choice(bot.SHIFT_CYCLE),
+                               tuple(bot.SHIFT_CYCLE))
+        for user_id in user_ids[:3000]
+    }
+    elapsed, _ = timed(storage.set_rule_batch, team_rules)
+    results.append(summarize('team_autofill_batch', [elapsed], total=elapsed, ops=len(team_rules)))
+
+    # Рассылка напоминаний на завтра по общему расписанию, без сети
+    scheduler = bot.ReminderScheduler(storage)
+    fire_at = datetime.now(pytz.utc)
+    elapsed, entries = timed(scheduler._default_entries, fire_at)
+    results.append(summarize('reminder_collect', [elapsed]))
+    # Очередь напоминаний: запись рассчитанного и выборка созревшего
+    outbox = bot.ReminderOutbox(os.path.join(workdir, 'reminder_outbox.db'))
+    elapsed, _ = timed(outbox.add, entries)
+    results.append(summarize('reminder_outbox_add', [elapsed], total=elapsed, ops=len(entries)))
+    elapsed, due = timed(outbox.take_due, fire_at, timedelta(minutes=bot.REMINDER_GRACE_MINUTES))
+    results.append(summarize('reminder_outbox_take', [elapsed], total=elapsed, ops=len(due)))
+    outbox.close()
+    messages = [(int(e.user_id), e.text) for e in entries]
+    noop = NoopBot()
+    started = time.perf_counter()
+    stats = asyncio.run(bot.deliver_messages(noop, messages, rate=1e9))
+    elapsed = time.perf_counter() - started
+    result = summarize('reminder_deliver_noop', [elapsed], total=elapsed, ops=len(messages))
+    result['delivery'] = {'sent': stats.sent, 'failed': stats.failed}
+    results.append(result)
+    storage.close()
+
+    # Журнал: первый запуск (снимок из schedule.json), запись смены, пачка в журнал, повторный запуск
+    journal_paths = {
+        'snapshot_path': os.path.join(workdir, 'schedule.snapshot'),
+        'journal_path': os.path.join(workdir, 'schedule.journal'),
+        'json_path': json_path,
+    }
+    elapsed, journal_storage = timed(lambda: bot.JournalScheduleStorage(**journal_paths))
+    results.append(summarize('journal_first_start', [elapsed]))
+    write_times = []
+    for user_id in sample_ids:
+        elapsed, _ = timed(journal_storage.set_shift, user_id, today + timedelta(days=rng.randint(0, 60)), 'rest')
+        write_times.append(elapsed)
+    results.append(summarize('journal_set_shift', write_times))
+    elapsed, _ = timed(journal_storage.flush)
+    results.append(summarize('journal_flush_batch', [elapsed]))
+    journal_storage.close()
+    elapsed, journal_storage = timed(lambda: bot.JournalScheduleStorage(**journal_paths))
+    results.append(summarize('journal_startup', [elapsed]))
+    journal_storage.close()
+
+    # SQLite: первый запуск (перенос из JSON и один проход построения индекса) и запись одной смены
+    elapsed, sqlite_storage = timed(lambda: bot.SqliteScheduleStorage(db_path, json_path=json_path))
+    results.append(summarize('sqlite_first_start', [elapsed]))
+    write_times = []
+    for user_id in sample_ids:
+        elapsed, _ = timed(sqlite_storage.set_shift, user_id, today + timedelta(days=rng.randint(0, 60)), 'night')
+        write_times.append(elapsed)
+    results.append(summarize('sqlite_set_shift', write_times))
+    render_times = []
+    for user_id in sample_ids:
+        elapsed, _ = timed(bot.build_schedule_message, sqlite_storage, user_id, today)
+        render_times.append(elapsed)
+    results.append(summarize('sqlite_build_schedule_message', render_times))
+    sqlite_storage.close()
+
+    return {
+        'users': users_count,
+        'schedule_json_bytes': file_size,
+        'schedule_packed_bytes': packed_size,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'benchmarks': results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_path, new_path):
+    """Сравнение двух прогонов: отношение p50 и пропускной способности"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    old_runs = {run['users']: {b['name']: b for b in run['benchmarks']} for run in old['runs']}
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for run in new['runs']:
+        before = old_runs.get(run['users'])
+        if before is None:
+            continue
+        print(f"\nПользователей: {run['users']}")
+        for bench in run['benchmarks']:
+            prev = before.get(bench['name'])
+            if prev is None:
+                continue
+            ratio = bench['p50_ms'] / prev['p50_ms'] if prev['p50_ms'] else float('nan')
+            print(f"  {bench['name']:32} p50 {prev['p50_ms']:>10.3f} -> {bench['p50_ms']:>10.3f} мс  (x{ratio:.2f})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', default='1000,10000,100000',
+                        help='размеры базы через запятую (до 1000000)')
+    parser.add_argument('--repeat', type=int, default=3, help='повторы чтения/записи файла')
+    parser.add_argument('--manual-share', type=float, default=0.2,
+                        help='доля пользователей только с ручными сменами')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.worker:
+        json.dump(run_size(args.worker, args.repeat, args.manual_share, args.seed), sys.stdout)
+        return
+
+    runs = []
+    for users_count in [int(n) for n in args.users.split(',')]:
+        print(f"⏱ {users_count} пользователей...", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', str(users_count),
+             '--repeat', str(args.repeat), '--manual-share', str(args.manual_share),
+             '--seed', str(args.seed)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        run = json.loads(output)
+        runs.append(run)
+        for bench in run['benchmarks']:
+            print(f"  {bench['name']:32} {bench['throughput_per_s'] or 0:>12.1f}/с  "
+                  f"p50 {bench['p50_ms']:.3f} мс  p99 {bench['p99_ms']:.3f} мс", file=sys.stderr)
+        print(f"  peak RSS {run['peak_rss_mb']} МБ, schedule.json {run['schedule_json_bytes']} байт, "
+              f"снимок {run['schedule_packed_bytes']} байт", file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ Результаты записаны в {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""Нагрузочный прогон бота целиком: настоящий main() против локальной заглушки Bot API
+
+Скрипт запускает shift_bot_FINAL.py отдельным процессом во временной папке и
+направляет его в заглушку Bot API из replay_updates.py (задержка ответов и 429 -
+по параметрам). Тысячи пользователей проходят один и тот же сценарий: /start,
+автозаполнение, добавление смены, «Мой график», удаление смены, /reminder на
+ближайшие минуты и ещё раз «Мой график». Апдейты подаются с заданной общей частотой,
+каждый пользователь ждёт ответа на предыдущий шаг, как в жизни.
+
+Итог по каждой частоте: задержка от апдейта до ответа (p50/p90/p99), пропускная
+способность, потерянные ответы, пришедшие напоминания, рост файлов хранилища и
+пиковая память бота. Частота, на которой задержка резко растёт или ответы теряются, -
+предел текущих настроек Application.
+
+Запуск:
+    python load_test.py --users 2000 --rate 50,100,200,400
+    python load_test.py --mode webhook --latency 0.05 --flood-rate 0.01 --api-limit 30
+    STORAGE_BACKEND=sqlite CONCURRENT_UPDATES=256 python load_test.py --reminder-in 0
+
+Переменные окружения (STORAGE_BACKEND, CONCURRENT_UPDATES и т.п.) передаются боту.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+import shift_bot_FINAL as bot
+from replay_updates import FakeBotApi, make_update, post_webhook
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shift_bot_FINAL.py')
+
+# Напоминание, а не ответ на апдейт: "☕ Завтра дневная смена!", "🌙 Через 2 ч. ночная смена: ..."
+REMINDER_PATTERN = re.compile(r'^\S+ (Завтра|Через \d+ ч\.) ')
+
+SHIFT_BUTTONS = ['☕ Дневная смена', '🌙 Ночная смена', '😴 Отсыпной', '🎉 Выходной']
+
+class Pacer:
+    """Общая частота подачи апдейтов: не больше rate в секунду на всех пользователей"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+def build_conversation(today, rng, reminder_at):
+    """Шаги одного пользователя: тексты сообщений по порядку"""
+    added = today + timedelta(days=rng.randint(2, 20))
+    texts = [
+        '/start',
+        '🤖 Автозаполнение графика', bot.format_date(today), rng.choice(SHIFT_BUTTONS),
+        '📅 Добавить смену', bot.format_date(added), rng.choice(SHIFT_BUTTONS),
+        '📋 Мой график',
+        '🗑 Удалить смену', bot.format_date(added),
+    ]
+    if reminder_at is not None:
+        texts.append(f"/reminder {reminder_at.strftime('%H:%M')}")
+    texts.append('📋 Мой график')
+    return texts
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def storage_files(workdir):
+    """Файлы графика выбранного STORAGE_BACKEND: база SQLite вместе с WAL, снимок и журнал, JSON"""
+    if bot.STORAGE_BACKEND == 'sqlite':
+        names = [bot.SCHEDULE_DB, bot.SCHEDULE_DB + '-wal']
+    elif bot.STORAGE_BACKEND == 'journal':
+        names = [bot.SCHEDULE_SNAPSHOT, bot.SCHEDULE_JOURNAL]
+    else:
+        names = [bot.SCHEDULE_FILE]
+    return [os.path.join(workdir, name) for name in names]
+
+def storage_bytes(workdir):
+    """Суммарный размер файлов графика (ещё не созданные - 0)"""
+    return sum(os.path.getsize(path) for path in storage_files(workdir) if os.path.exists(path))
+
+def peak_rss_kb(pid):
+    """Пиковая память процесса (VmHWM), если есть /proc"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def start_bot(workdir, args):
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_TOKEN': '123:test',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.api_port}',
+        'BOT_MODE': args.mode,
+        'PYTHONUNBUFFERED': '1',
+    })
+    if args.mode == 'webhook':
+        env.update({
+            'WEBHOOK_URL': f'http://127.0.0.1:{args.webhook_port}',
+            'WEBHOOK_PORT': str(args.webhook_port),
+            'WEBHOOK_PATH': 'telegram',
+            'WEBHOOK_SECRET': 'load',
+        })
+    log = open(os.path.join(workdir, 'bot.log'), 'w')
+    process = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=workdir, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    return process
+
+def stop_bot(process, timeout=60):
+    """Остановка как по Ctrl+C: бот успевает сбросить график на диск"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+async def run(rate, args):
+    workdir = tempfile.mkdtemp(prefix='shift_load_')
+    rng = random.Random(args.seed)
+    reminders = {}
+
+    def on_message(chat_id, text):
+        reminders.setdefault(chat_id, time.time())
+
+    api = FakeBotApi(
+        args.latency, args.jitter, args.flood_rate, args.api_limit,
+        is_reply=lambda text: not REMINDER_PATTERN.match(text), on_message=on_message, seed=args.seed
+    )
+    server = await asyncio.start_server(api.handle, '127.0.0.1', args.api_port)
+    process = start_bot(workdir, args)
+    try:
+        await asyncio.wait_for(api.ready.wait(), args.startup_timeout)
+    except asyncio.TimeoutError:
+        stop_bot(process)
+        server.close()
+        raise SystemExit(f"Бот не обратился к заглушке за {args.startup_timeout} с, лог: {workdir}/bot.log")
+    await asyncio.sleep(args.warmup)
+    storage_before = storage_bytes(workdir)
+
+    # Напоминание - после того, как все успеют дойти до /reminder
+    tz = pytz.timezone(bot.DEFAULT_TIMEZONE)
+    local_now = datetime.now(tz)
+    reminder_at = None
+    if args.reminder_in:
+        steps = len(build_conversation(local_now.date(), random.Random(), local_now)) * args.users
+        reminder_at = (local_now + timedelta(seconds=steps / rate, minutes=args.reminder_in)).replace(
+            second=0, microsecond=0
+        ) + timedelta(minutes=1)
+    conversations = {
+        100000 + number: build_conversation(local_now.date(), rng, reminder_at)
+        for number in range(args.users)
+    }
+
+    pacer = Pacer(rate)
+    latencies, errors = [], []
+    counters = {'sent': 0, 'lost': 0, 'reminders_expected': 0}
+    next_update_id = [1]
+
+    async def send(update):
+        if args.mode == 'webhook':
+            status = await post_webhook('127.0.0.1', args.webhook_port, 'telegram', 'load', update)
+            if status != 200:
+                errors.append(f"webhook ответил {status}")
+        else:
+            api.push_update(update)
+
+    async def user(user_id, texts):
+        for text in texts:
+            await pacer.wait()
+            update = make_update(next_update_id[0], user_id, text)
+            next_update_id[0] += 1
+            reply = api.expect_reply(user_id)
+            started = time.perf_counter()
+            await send(update)
+            counters['sent'] += 1
+            try:
+                answered_at, answer = await asyncio.wait_for(reply, args.timeout)
+            except asyncio.TimeoutError:
+                api.replies.pop(user_id, None)
+                counters['lost'] += 1
+                # Диалог сбился: дальше этому пользователю идти нельзя
+                return
+            latencies.append(answered_at - started)
+            if answer.startswith('❌'):
+                errors.append(answer.splitlines()[0])
+            if text.startswith('/reminder'):
+                counters['reminders_expected'] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(user_id, texts) for user_id, texts in conversations.items()))
+    elapsed = time.perf_counter() - started
+
+    if reminder_at is not None and counters['reminders_expected']:
+        # Job запускается раз в минуту: ждём напоминаний не дольше двух минут после срока
+        deadline = reminder_at.timestamp() + 120
+        while len(reminders) < counters['reminders_expected'] and time.time() < deadline:
+            await asyncio.sleep(1)
+
+    # Размер - пока бот работает, после очередного сброса на диск: при остановке
+    # checkpoint SQLite или сжатие журнала могут уменьшить файлы, и рост ушёл бы в минус
+    await asyncio.sleep(bot.SCHEDULE_FLUSH_INTERVAL + 1)
+    storage_after = storage_bytes(workdir)
+    rss_kb = peak_rss_kb(process.pid)
+    stop_bot(process)
+    server.close()
+
+    latencies.sort()
+    result = {
+        'mode': args.mode,
+        'rate': rate,
+        'users': args.users,
+        'updates': counters['sent'],
+        'answered': len(latencies),
+        'lost': counters['lost'],
+        'error_replies': len(errors),
+        'seconds': round(elapsed, 3),
+        'updates_per_s': round(len(latencies) / elapsed, 1),
+        'flooded': api.flooded,
+        'storage_bytes': storage_after,
+        'storage_growth_per_user': round((storage_after - storage_before) / args.users, 1),
+        'bot_peak_rss_mb': round(rss_kb / 1024, 1) if rss_kb else None,
+        'workdir': workdir,
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p90_ms': round(percentile(latencies, 0.9) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+        })
+    if reminder_at is not None:
+        delays = sorted(at - reminder_at.timestamp() for at in reminders.values())
+        result.update({
+            'reminders_expected': counters['reminders_expected'],
+            'reminders_received': len(reminders),
+            'reminder_delay_max_s': round(delays[-1], 1) if delays else None,
+        })
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', default='50,200', help='апдейтов в секунду на всех, через запятую')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа на sendMessage, с')
+    parser.add_argument('--jitter', type=float, default=0.01, help='разброс задержки, ± с')
+    parser.add_argument('--flood-rate', type=float, default=0, help='доля sendMessage с ответом 429')
+    parser.add_argument('--api-limit', type=int, default=0, help='sendMessage в секунду до ответов 429, 0 - без лимита')
+    parser.add_argument('--reminder-in', type=float, default=2,
+                        help='через сколько минут после сценария ждать напоминания, 0 - без /reminder')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать ответа бота, с')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8443)
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=1, help='пауза после запуска бота, с')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    failed = False
+    for rate in [float(n) for n in args.rate.split(',')]:
+        result = asyncio.run(run(rate, args))
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+        failed = failed or result['lost'] > 0
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
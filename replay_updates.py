@@ -0,0 +1,297 @@
+"""Локальный прогон записанных апдейтов через бота: сравнение задержки polling и webhook
+
+Скрипт поднимает заглушку Bot API, которая отвечает на getMe/getUpdates/sendMessage,
+и подаёт боту апдейты из JSONL-файла (по одному объекту Update в строке). Задержка
+считается от отправки апдейта до первого sendMessage в тот же чат.
+
+Запуск (replay в одном терминале, затем бот во втором):
+    python replay_updates.py generate --count 200 > updates.jsonl
+
+    # webhook
+    python replay_updates.py replay updates.jsonl --mode webhook --secret local
+    TELEGRAM_TOKEN=123:test TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_MODE=webhook \\
+        WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET=local python shift_bot_FINAL.py
+
+    # polling
+    python replay_updates.py replay updates.jsonl --mode polling
+    TELEGRAM_TOKEN=123:test TELEGRAM_API_URL=http://127.0.0.1:8081 python shift_bot_FINAL.py
+
+Прогон начинается, когда бот обратится к заглушке (setWebhook или getUpdates).
+Задержку ответов Bot API и ответы 429 можно включить: --latency, --flood-rate, --api-limit.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+
+# Что «нажимает» сгенерированный пользователь
+SAMPLE_TEXTS = ['/start', '📋 Мой график', 'ℹ️ Помощь']
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Shift Bot', 'username': 'shift_test_bot'}
+
+def make_update(update_id, user_id, text):
+    """Апдейт с текстовым сообщением от пользователя, как его присылает Telegram"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def generate(count, users):
+    for update_id in range(1, count + 1):
+        user_id = 100000 + update_id % users
+        print(json.dumps(make_update(update_id, user_id, SAMPLE_TEXTS[update_id % len(SAMPLE_TEXTS)]),
+                         ensure_ascii=False))
+
+async def read_request(reader):
+    """Разбор HTTP-запроса: метод, путь, заголовки, тело"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, target, headers, body
+
+def write_response(writer, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body
+    )
+
+class FakeBotApi:
+    """Заглушка Bot API: отдаёт апдейты через getUpdates и запоминает ответы бота
+
+    latency (± jitter) - задержка ответа на sendMessage, с. Ответ 429 с retry_after
+    приходит на долю flood_rate сообщений и на всё сверх api_limit сообщений в секунду,
+    как при превышении лимита Telegram. is_reply(text) отделяет ответы на апдейты от
+    сообщений, которые бот шлёт сам (напоминаний): их ловит on_message(chat_id, text).
+    """
+
+    def __init__(self, latency=0, jitter=0, flood_rate=0, api_limit=0, retry_after=1,
+                 is_reply=None, on_message=None, seed=None):
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.replies = {}
+        self.message_id = 0
+        # Бот запустился и готов принимать апдейты
+        self.ready = asyncio.Event()
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.api_limit = api_limit
+        self.retry_after = retry_after
+        self.is_reply = is_reply
+        self.on_message = on_message
+        self.rng = random.Random(seed)
+        # Отправки за текущую секунду для api_limit
+        self.window_start = 0
+        self.window_count = 0
+        self.flooded = 0
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def expect_reply(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.replies[chat_id] = future
+        return future
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        pending = [u for u in self.updates if u['update_id'] >= offset]
+        if not pending and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            pending = [u for u in self.updates if u['update_id'] >= offset]
+        # Подтверждённые ботом апдейты больше не нужны
+        self.updates = pending
+        return pending[:int(params.get('limit', 100))]
+
+    def flood(self):
+        """Отвечать ли на это сообщение 429"""
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start, self.window_count = now, 0
+        self.window_count += 1
+        if (self.api_limit and self.window_count > self.api_limit) or self.rng.random() < self.flood_rate:
+            self.flooded += 1
+            return True
+        return False
+
+    def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        text = params.get('text', '')
+        self.message_id += 1
+        if self.is_reply is None or self.is_reply(text):
+            future = self.replies.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result((time.perf_counter(), text))
+        elif self.on_message is not None:
+            self.on_message(chat_id, text)
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                _, target, headers, body = request
+                api_method = urlsplit(target).path.rsplit('/', 1)[-1]
+                if headers.get('content-type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+                if api_method == 'getMe':
+                    result = BOT_USER
+                elif api_method == 'getUpdates':
+                    self.ready.set()
+                    result = await self.get_updates(params)
+                elif api_method == 'sendMessage':
+                    if self.latency or self.jitter:
+                        await asyncio.sleep(max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+                    if self.flood():
+                        write_response(writer, '429 Too Many Requests', {
+                            'ok': False,
+                            'error_code': 429,
+                            'description': f'Too Many Requests: retry after {self.retry_after}',
+                            'parameters': {'retry_after': self.retry_after},
+                        })
+                        await writer.drain()
+                        continue
+                    result = self.send_message(params)
+                else:
+                    # setWebhook, deleteWebhook и прочее - просто успех
+                    if api_method == 'setWebhook':
+                        self.ready.set()
+                    result = True
+                write_response(writer, '200 OK', {'ok': True, 'result': result})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+async def post_webhook(host, port, path, secret, update):
+    """POST апдейта в webhook бота, ответ не ждём дольше статуса"""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(update).encode('utf-8')
+    headers = (
+        f"POST /{path} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+    )
+    if secret:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write((headers + "\r\n").encode('latin-1') + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+async def replay(args):
+    with open(args.updates, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    api = FakeBotApi(args.latency, flood_rate=args.flood_rate, api_limit=args.api_limit)
+    server = await asyncio.start_server(api.handle, '127.0.0.1', args.api_port)
+    print(f"Заглушка Bot API: http://127.0.0.1:{args.api_port}", file=sys.stderr)
+    await api.ready.wait()
+    await asyncio.sleep(args.warmup)
+
+    webhook = urlsplit(args.webhook)
+    latencies, lost = [], 0
+    for update in updates:
+        chat_id = update['message']['chat']['id']
+        reply = api.expect_reply(chat_id)
+        started = time.perf_counter()
+        if args.mode == 'webhook':
+            status = await post_webhook(webhook.hostname, webhook.port, webhook.path.lstrip('/'),
+                                        args.secret, update)
+            if status != 200:
+                print(f"webhook ответил {status}", file=sys.stderr)
+        else:
+            api.push_update(update)
+        try:
+            answered_at, _ = await asyncio.wait_for(reply, args.timeout)
+            latencies.append(answered_at - started)
+        except asyncio.TimeoutError:
+            api.replies.pop(chat_id, None)
+            lost += 1
+
+    server.close()
+    if not latencies:
+        print("Бот не ответил ни на один апдейт", file=sys.stderr)
+        return
+    latencies.sort()
+    print(json.dumps({
+        'mode': args.mode,
+        'updates': len(updates),
+        'answered': len(latencies),
+        'lost': lost,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+        'flooded': api.flooded,
+    }, ensure_ascii=False))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='сгенерировать апдейты в stdout')
+    gen.add_argument('--count', type=int, default=100)
+    gen.add_argument('--users', type=int, default=20)
+
+    rep = commands.add_parser('replay', help='прогнать апдейты через бота')
+    rep.add_argument('updates', help='JSONL с объектами Update')
+    rep.add_argument('--mode', choices=('polling', 'webhook'), default='webhook')
+    rep.add_argument('--webhook', default='http://127.0.0.1:8443/telegram')
+    rep.add_argument('--secret', default='')
+    rep.add_argument('--api-port', type=int, default=8081)
+    rep.add_argument('--timeout', type=float, default=5, help='сколько ждать ответа бота, с')
+    rep.add_argument('--warmup', type=float, default=1, help='пауза после запуска бота, с')
+    rep.add_argument('--latency', type=float, default=0, help='задержка ответа на sendMessage, с')
+    rep.add_argument('--flood-rate', type=float, default=0, help='доля sendMessage с ответом 429')
+    rep.add_argument('--api-limit', type=int, default=0, help='sendMessage в секунду до ответов 429, 0 - без лимита')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.count, args.users)
+    else:
+        asyncio.run(replay(args))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,39 @@
+import asyncio
+import csv
+import functools
+import heapq
+import inspect
 import logging
+import mmap
 import json
 import os
-from datetime import datetime, timedelta, time
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+import random
+import re
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import warnings
+import zlib
+
+import pytz
+from collections import OrderedDict, defaultdict, namedtuple
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, time
+from itertools import islice
+from time import perf_counter
+from bisect import bisect_left, bisect_right
+from calendar import monthrange
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram.warnings import PTBUserWarning
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BasePersistence, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler,
+    MessageHandler, PersistenceInput, TypeHandler, filters, ContextTypes, ConversationHandler
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -14,14 +44,112 @@ logger = logging.getLogger(__name__)
 
 # Файл для хранения графика
 SCHEDULE_FILE = 'schedule.json'
+SCHEDULE_FORMAT_VERSION = 3
+
+# Хранилище графика: 'json' (файл SCHEDULE_FILE) или 'sqlite' (база SCHEDULE_DB)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SCHEDULE_DB = os.getenv('SCHEDULE_DB', 'schedule.db')
+# Сколько последних записей журнала изменений SQLite (таблица changes) хранить для других воркеров
+CHANGES_KEEP_ROWS = int(os.getenv('CHANGES_KEEP_ROWS', '100000'))
+# STORAGE_BACKEND=journal: двоичный снимок графика и журнал изменений после него
+SCHEDULE_SNAPSHOT = os.getenv('SCHEDULE_SNAPSHOT', 'schedule.snapshot')
+SCHEDULE_JOURNAL = os.getenv('SCHEDULE_JOURNAL', 'schedule.journal')
+# Сколько записей журнала накопить перед сжатием в новый снимок
+JOURNAL_COMPACT_RECORDS = int(os.getenv('JOURNAL_COMPACT_RECORDS', '50000'))
+
+# Как часто (в секундах) сбрасывать изменения графика из памяти в schedule.json
+SCHEDULE_FLUSH_INTERVAL = float(os.getenv('SCHEDULE_FLUSH_INTERVAL', '2'))
+
+# Рассылка напоминаний: Telegram допускает около 30 сообщений в секунду на бота
+REMINDER_RATE_LIMIT = float(os.getenv('REMINDER_RATE_LIMIT', '30'))
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', '20'))
+REMINDER_MAX_ATTEMPTS = 5
+
+# Часовой пояс и время напоминания для тех, кто не настраивал их сам
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Kyiv')
+DEFAULT_REMINDER_TIME = '20:05'
+DEFAULT_REMINDER_KEY = ('*', 0)
+# На сколько дней вперёд искать смену для напоминаний "за N часов до смены"
+REMINDER_HORIZON_DAYS = 14
+# Очередь напоминаний на диске: рассчитываются на REMINDER_LOOKAHEAD_HOURS часов вперёд
+REMINDER_OUTBOX = os.getenv('REMINDER_OUTBOX', 'reminder_outbox.db')
+REMINDER_LOOKAHEAD_HOURS = float(os.getenv('REMINDER_LOOKAHEAD_HOURS', '24'))
+# Напоминания, пропущенные пока бот не работал, догоняются, если опоздали не больше чем на столько минут
+REMINDER_GRACE_MINUTES = float(os.getenv('REMINDER_GRACE_MINUTES', '120'))
+# Сколько дней хранить в очереди отправленные и отменённые напоминания
+REMINDER_OUTBOX_KEEP_DAYS = 7
+
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (выключены, если порт не задан)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Режим работы: 'polling' (по умолчанию) или 'webhook' за обратным прокси
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Внешний адрес, который видит Telegram (https://example.com), путь добавляется сам
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Наибольшее тело HTTP-запроса (апдейт от Telegram - единицы килобайт), больше - ответ 413
+MAX_HTTP_BODY = 1_000_000
+# Другой адрес Bot API, например локальная заглушка из replay_updates.py
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+# Состояния диалогов и user_data (пустая строка - не сохранять между перезапусками)
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_state.db')
+# Как часто (в секундах) изменения диалогов записываются в PERSISTENCE_FILE
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+
+# Кластер: роутер раздаёт апдейты WORKER_COUNT воркерам на портах WORKER_BASE_PORT + номер
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '2'))
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '8600'))
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя - всегда по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Ограничение частоты запросов (token bucket), отдельно для чтения ("Мой график", /stats и т.п.)
+# и тяжёлых записей (автозаполнение, очистка, импорт): на пользователя - столько в минуту
+# с запасом BURST подряд, на всех вместе - столько в секунду. 0 - без ограничения
+THROTTLE_READ_PER_MINUTE = float(os.getenv('THROTTLE_READ_PER_MINUTE', '30'))
+THROTTLE_READ_BURST = int(os.getenv('THROTTLE_READ_BURST', '10'))
+THROTTLE_WRITE_PER_MINUTE = float(os.getenv('THROTTLE_WRITE_PER_MINUTE', '3'))
+THROTTLE_WRITE_BURST = int(os.getenv('THROTTLE_WRITE_BURST', '3'))
+THROTTLE_GLOBAL_READ_RATE = float(os.getenv('THROTTLE_GLOBAL_READ_RATE', '500'))
+THROTTLE_GLOBAL_WRITE_RATE = float(os.getenv('THROTTLE_GLOBAL_WRITE_RATE', '100'))
+# Как часто (в секундах) писать в лог счётчики ограничения
+THROTTLE_LOG_INTERVAL = 60
+
+# Сколько пользователей держать в кэше ответа "Мой график"
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '10000'))
+# Сколько месяцев (пользователь, месяц) держать в кэше клавиатур календаря
+CALENDAR_CACHE_SIZE = int(os.getenv('CALENDAR_CACHE_SIZE', '10000'))
+
+# Ограничения импорта и выгрузки графика
+MAX_IMPORT_BYTES = 1_000_000
+MAX_IMPORT_ROWS = 10000
+MAX_EXPORT_YEARS = 10
+
+# Команды руководителей: название, размер, период отчёта о покрытии
+TEAM_NAME_PATTERN = re.compile(r'^[\w-]{1,32}$')
+MAX_TEAM_SIZE = 5000
+MAX_COVERAGE_DAYS = 92
+# Администраторы бота (id через запятую): только им доступно /autofill
+ADMIN_IDS = {user_id.strip() for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# Сколько пользователей ночная сверка проверяет пересчётом статистики по дням
+STATS_CHECK_SAMPLE = 100
+
+# Бот обрабатывает сообщения и нажатия кнопок календаря, остальные типы апдейтов не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Состояния для ConversationHandler
-CHOOSING_DATE, CHOOSING_SHIFT, CHOOSING_AUTO_DATE, CHOOSING_AUTO_SHIFT = range(4)
+CHOOSING_DATE, CHOOSING_SHIFT, CHOOSING_AUTO_DATE, CHOOSING_AUTO_SHIFT, CHOOSING_IMPORT, CHOOSING_AUTOFILL = range(6)
 
 # Типы смен
 SHIFT_TYPES = {
-    'day': {'name': 'Дневная смена', 'emoji': '☕'},
-    'night': {'name': 'Ночная смена', 'emoji': '🌙'},
+    'day': {'name': 'Дневная смена', 'emoji': '☕', 'start': '08:00'},
+    'night': {'name': 'Ночная смена', 'emoji': '🌙', 'start': '20:00'},
     'rest': {'name': 'Отсыпной', 'emoji': '😴'},
     'dayoff': {'name': 'Выходной', 'emoji': '🎉'}
 }
@@ -29,17 +157,27 @@ SHIFT_TYPES = {
 # Цикл смен
 SHIFT_CYCLE = ['day', 'night', 'rest', 'dayoff']
 
-def load_schedule():
+def load_schedule(path=SCHEDULE_FILE):
     """Загрузка графика из файла"""
-    if os.path.exists(SCHEDULE_FILE):
-        with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
     return {}
 
-def save_schedule(schedule):
-    """Сохранение графика в файл"""
-    with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(schedule, f, ensure_ascii=False, indent=2)
+def save_schedule(schedule, path=SCHEDULE_FILE, compact=False):
+    """Сохранение графика в файл (временный файл + fsync + rename, чтобы сбой не обрезал график)
+
+    compact - без отступов и пробелов: для регулярного сброса, где важна скорость записи.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if compact:
+            json.dump(schedule, f, ensure_ascii=False, separators=(',', ':'))
+        else:
+            json.dump(schedule, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 def generate_auto_schedule(start_date_str, start_shift_type, days=365):
     """Генерация графика на year вперёд по циклу"""
@@ -61,6 +199,2393 @@ def generate_auto_schedule(start_date_str, start_shift_type, days=365):
     
     return schedule
 
+def parse_date(date_str):
+    """Разбор даты ДД.ММ.ГГГГ (ввод пользователя) в объект date"""
+    return datetime.strptime(date_str, '%d.%m.%Y').date()
+
+def format_date(date_obj):
+    """Дата в формате ДД.ММ.ГГГГ для сообщений"""
+    return f"{date_obj.day:02d}.{date_obj.month:02d}.{date_obj.year:04d}"
+
+# Дни недели по date.weekday()
+WEEKDAYS_RU = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+MONTHS_RU = [
+    'Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+    'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь'
+]
+
+@functools.lru_cache(maxsize=4096)
+def shift_line(day, shift_type):
+    """Строка дня для "Мой график" без отметки СЕГОДНЯ/ЗАВТРА (общая для всех пользователей)"""
+    shift_info = SHIFT_TYPES[shift_type]
+    return f"{shift_info['emoji']} <b>{format_date(day)}</b> ({WEEKDAYS_RU[day.weekday()]})"
+
+# Упакованные ручные смены: по SHIFT_CODE_BITS бит на день, страницы по SHIFT_PAGE_DAYS дней.
+# Код 0 - записи нет, 1 - "смены нет" поверх правила, дальше - типы из SHIFT_TYPES
+SHIFT_CODES = [None, None] + list(SHIFT_TYPES)
+SHIFT_CODE_OF = {shift_type: code for code, shift_type in enumerate(SHIFT_CODES) if code >= 2}
+SHIFT_CODE_BITS = 3
+SHIFT_CODE_MASK = (1 << SHIFT_CODE_BITS) - 1
+SHIFT_PAGE_DAYS = 256
+SHIFT_PAGE_BYTES = SHIFT_PAGE_DAYS * SHIFT_CODE_BITS // 8
+assert len(SHIFT_CODES) <= 1 << SHIFT_CODE_BITS
+
+# Заголовок упакованных смен: число записей, число смен (без "смены нет"), число страниц
+PACKED_SHIFTS_HEADER = struct.Struct('<III')
+
+class PackedShifts:
+    """Ручные смены пользователя одним bytes: заголовок, номера страниц, страницы
+
+    Страница - это базовая дата (номер * SHIFT_PAGE_DAYS) и массив 3-битных кодов:
+    256 дней занимают 96 байт. Год смен подряд - 212 байт (заголовок 12, две страницы:
+    2 * 4 + 2 * 96), а если год задевает три страницы - 312. Страницы есть только там,
+    где есть записи, поэтому далёкая одиночная дата не раздувает массив. Запись
+    пересобирает bytes целиком: это сотни байт, а читают график гораздо чаще. Много
+    дней сразу (импорт, пачка смен) пишет update - за одну пересборку.
+    Формат в памяти и на диске один и тот же (to_bytes/from_buffer).
+    """
+
+    __slots__ = ('data',)
+
+    EMPTY = PACKED_SHIFTS_HEADER.pack(0, 0, 0)
+
+    def __init__(self, items=()):
+        self.data = self.EMPTY
+        self.update(items)
+
+    def _layout(self):
+        """(число записей, число смен, номера страниц)"""
+        count, filled, page_count = PACKED_SHIFTS_HEADER.unpack_from(self.data)
+        numbers = struct.unpack_from(f'<{page_count}I', self.data, PACKED_SHIFTS_HEADER.size)
+        return count, filled, numbers
+
+    def _pages_offset(self, page_count):
+        return PACKED_SHIFTS_HEADER.size + 4 * page_count
+
+    def _update(self, changes):
+        """Записать коды дней: changes - [(ordinal, значение)]
+
+        Значение - тип смены, None ("смены нет" поверх правила) или False (удалить запись).
+
+        Страница на время правки - одно целое число, код дня - SHIFT_CODE_BITS его бит.
+        """
+        count, filled, numbers = self._layout()
+        start = self._pages_offset(len(numbers))
+        pages = {
+            number: int.from_bytes(self.data[start + i * SHIFT_PAGE_BYTES:start + (i + 1) * SHIFT_PAGE_BYTES], 'little')
+            for i, number in enumerate(numbers)
+        }
+        for ordinal, shift_type in changes:
+            code = 0 if shift_type is False else SHIFT_CODE_OF[shift_type] if shift_type else 1
+            number, index = divmod(ordinal, SHIFT_PAGE_DAYS)
+            shift = index * SHIFT_CODE_BITS
+            value = pages.get(number, 0)
+            old = (value >> shift) & SHIFT_CODE_MASK
+            if old != code:
+                pages[number] = value ^ ((old ^ code) << shift)
+                count += (code != 0) - (old != 0)
+                filled += (code >= 2) - (old >= 2)
+        numbers = sorted(number for number, value in pages.items() if value)
+        self.data = b''.join([
+            PACKED_SHIFTS_HEADER.pack(count, filled, len(numbers)),
+            struct.pack(f'<{len(numbers)}I', *numbers),
+            *(pages[number].to_bytes(SHIFT_PAGE_BYTES, 'little') for number in numbers),
+        ])
+
+    def __len__(self):
+        return PACKED_SHIFTS_HEADER.unpack_from(self.data)[0]
+
+    def set(self, ordinal, shift_type):
+        self._update([(ordinal, shift_type)])
+
+    def update(self, items):
+        """Записать много смен одной пересборкой: items - [(ordinal, тип смены или None)]
+
+        set в цикле пересобирал бы bytes на каждый день - квадратично от размера графика.
+        """
+        items = list(items)
+        if items:
+            self._update(items)
+
+    def remove(self, ordinal):
+        self._update([(ordinal, False)])
+
+    def truncate_from(self, ordinal):
+        """Удалить все смены начиная с ordinal"""
+        removed = [(day, False) for day, _ in self.irange(ordinal, date.max.toordinal())]
+        if removed:
+            self._update(removed)
+
+    def irange(self, start, end):
+        """Смены с ordinal из [start, end] по возрастанию: (ordinal, тип смены)"""
+        _, _, numbers = self._layout()
+        pages_offset = self._pages_offset(len(numbers))
+        first, last = start // SHIFT_PAGE_DAYS, end // SHIFT_PAGE_DAYS
+        for i in range(bisect_left(numbers, first), bisect_right(numbers, last)):
+            base = numbers[i] * SHIFT_PAGE_DAYS
+            offset = pages_offset + i * SHIFT_PAGE_BYTES
+            index = max(start - base, 0)
+            stop = min(end - base, SHIFT_PAGE_DAYS - 1)
+            bits = int.from_bytes(self.data[offset:offset + SHIFT_PAGE_BYTES], 'little')
+            bits >>= index * SHIFT_CODE_BITS
+            while bits:
+                if not bits & SHIFT_CODE_MASK:
+                    # Пропускаем пустые дни разом: до младшего ненулевого кода
+                    skip = ((bits & -bits).bit_length() - 1) // SHIFT_CODE_BITS
+                    bits >>= skip * SHIFT_CODE_BITS
+                    index += skip
+                if index > stop:
+                    break
+                yield base + index, SHIFT_CODES[bits & SHIFT_CODE_MASK]
+                bits >>= SHIFT_CODE_BITS
+                index += 1
+
+    def items(self):
+        return self.irange(0, date.max.toordinal())
+
+    def count_filled(self):
+        return PACKED_SHIFTS_HEADER.unpack_from(self.data)[1]
+
+    def to_bytes(self):
+        return self.data
+
+    def copy(self):
+        """Копия для снимка: bytes не меняются на месте, поэтому копируется только ссылка"""
+        shifts = PackedShifts()
+        shifts.data = self.data
+        return shifts
+
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        """Разбор to_bytes() из buffer (bytes или mmap): (PackedShifts, смещение за концом записи)"""
+        _, _, page_count = PACKED_SHIFTS_HEADER.unpack_from(buffer, offset)
+        end = offset + PACKED_SHIFTS_HEADER.size + page_count * (4 + SHIFT_PAGE_BYTES)
+        shifts = cls()
+        shifts.data = bytes(buffer[offset:end])
+        return shifts, end
+
+class UserSchedule:
+    """График пользователя в памяти: правила (кортеж), ручные смены и настройки (None - не заданы)"""
+
+    __slots__ = ('rules', 'shifts', 'settings')
+
+    def __init__(self, rules=(), shifts=None, settings=None):
+        self.rules = tuple(rules)
+        self.shifts = shifts if shifts is not None else PackedShifts()
+        self.settings = settings or None
+
+    def __bool__(self):
+        return bool(self.rules or self.shifts or self.settings)
+
+# Правило автографика: с даты anchor смены идут по cycle, начиная со смены start
+ShiftRule = namedtuple('ShiftRule', ['anchor', 'start', 'cycle'])
+
+def resolve_rule(rules, day):
+    """Смена на дату по правилам (отсортированы по anchor, действует последнее начавшееся)"""
+    for rule in reversed(rules):
+        if rule.anchor <= day:
+            offset = rule.cycle.index(rule.start) + (day - rule.anchor).days
+            return rule.cycle[offset % len(rule.cycle)]
+    return None
+
+def rule_to_json(rule):
+    """Правило в виде словаря для schedule.json"""
+    return {'anchor': rule.anchor.isoformat(), 'start': rule.start, 'cycle': list(rule.cycle)}
+
+def rule_from_json(data, parse_key=date.fromisoformat):
+    """Правило из словаря schedule.json"""
+    return ShiftRule(parse_key(data['anchor']), data['start'], tuple(data['cycle']))
+
+def parse_schedule(data):
+    """Разбор содержимого schedule.json в {user_id: UserSchedule}
+
+    Старые форматы читаются прозрачно: {user_id: {дата: смена}} - как график из одних
+    ручных смен, а даты ДД.ММ.ГГГГ (до версии 3) переводятся в ISO-ключи.
+    """
+    if 'version' not in data:
+        data = {'version': 1, 'users': {
+            user_id: {'shifts': user_schedule} for user_id, user_schedule in data.items()
+        }}
+    parse_key = date.fromisoformat if data['version'] >= 3 else parse_date
+    return {
+        user_id: UserSchedule(
+            [rule_from_json(rule, parse_key) for rule in user_data.get('rules', [])],
+            PackedShifts(
+                (parse_key(day).toordinal(), shift_type)
+                for day, shift_type in user_data.get('shifts', {}).items()
+            ),
+            dict(user_data.get('settings', {}))
+        )
+        for user_id, user_data in data['users'].items()
+    }
+
+def team_from_json(team):
+    """Команда из словаря schedule.json или записи журнала: {'owner', 'members', 'invited'}
+
+    До приглашений участников добавляли без их согласия. В таких записях нет ключа
+    invited: участником остаётся только создатель, остальные становятся приглашёнными
+    и должны подтвердить участие сами.
+    """
+    members = set(team['members'])
+    if 'invited' in team:
+        return {'owner': team['owner'], 'members': members, 'invited': set(team['invited'])}
+    return {'owner': team['owner'], 'members': members & {team['owner']}, 'invited': members - {team['owner']}}
+
+def parse_teams(data):
+    """Команды из schedule.json: {название: {'owner': user_id, 'members': {...}, 'invited': {...}}}"""
+    if 'version' not in data:
+        return {}
+    return {name: team_from_json(team) for name, team in data.get('teams', {}).items()}
+
+def dump_schedule(users, teams=None):
+    """Обратное к parse_schedule (и parse_teams) преобразование для записи в schedule.json"""
+    data = {
+        'version': SCHEDULE_FORMAT_VERSION,
+        'users': {
+            user_id: {
+                'rules': [rule_to_json(rule) for rule in user_data.rules],
+                'shifts': {
+                    date.fromordinal(day).isoformat(): shift_type
+                    for day, shift_type in user_data.shifts.items()
+                },
+                'settings': user_data.settings or {}
+            }
+            for user_id, user_data in users.items()
+            if user_data
+        }
+    }
+    if teams:
+        data['teams'] = {
+            name: {
+                'owner': team['owner'],
+                'members': sorted(team['members'], key=int),
+                'invited': sorted(team['invited'], key=int),
+            }
+            for name, team in teams.items()
+        }
+    return data
+
+# Двоичный снимок графика: заголовок, JSON с командами, затем записи пользователей
+PACKED_SCHEDULE_MAGIC = b'SHIFTPK1'
+PACKED_LENGTH = struct.Struct('<I')
+
+def save_packed_schedule(users, path, teams=None, **header_fields):
+    """Запись графика в двоичный снимок (временный файл + fsync + rename)
+
+    Запись пользователя: длина и JSON с id, правилами и настройками, затем
+    PackedShifts.to_bytes(). Смены не разворачиваются в словари дат.
+    """
+    def block(payload):
+        return PACKED_LENGTH.pack(len(payload)) + payload
+
+    header = json.dumps({
+        'version': SCHEDULE_FORMAT_VERSION,
+        'users': sum(1 for user_data in users.values() if user_data),
+        'teams': dump_schedule({}, teams).get('teams', {}),
+        **header_fields,
+    }, ensure_ascii=False).encode('utf-8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PACKED_SCHEDULE_MAGIC + block(header))
+        for user_id, user_data in users.items():
+            if not user_data:
+                continue
+            meta = json.dumps({
+                'id': user_id,
+                'rules': [rule_to_json(rule) for rule in user_data.rules],
+                'settings': user_data.settings or {},
+            }, ensure_ascii=False).encode('utf-8')
+            f.write(block(meta) + user_data.shifts.to_bytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_packed_schedule(path, use_mmap=False):
+    """Чтение двоичного снимка: (users, teams, заголовок), графики и команды как у parse_schedule/parse_teams
+
+    С use_mmap файл не читается в память целиком: при загрузке большой базы пик
+    памяти - это сами графики, без второй копии файла.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else f.read()
+    if buffer[:len(PACKED_SCHEDULE_MAGIC)] != PACKED_SCHEDULE_MAGIC:
+        raise ValueError(f"{path}: не снимок графика")
+    offset = len(PACKED_SCHEDULE_MAGIC)
+
+    def block():
+        nonlocal offset
+        length, = PACKED_LENGTH.unpack_from(buffer, offset)
+        offset += PACKED_LENGTH.size + length
+        return json.loads(bytes(buffer[offset - length:offset]))
+
+    header = block()
+    users = {}
+    for _ in range(header['users']):
+        meta = block()
+        shifts, offset = PackedShifts.from_buffer(buffer, offset)
+        users[meta['id']] = UserSchedule(
+            [rule_from_json(rule) for rule in meta['rules']], shifts, meta['settings']
+        )
+    if use_mmap:
+        buffer.close()
+    return users, parse_teams(header), header
+
+class ScheduleIndex:
+    """Обратный индекс дата -> пользователи для рассылки напоминаний
+
+    Ручные смены лежат в корзинах по датам. Правила сгруппированы по циклу и фазе:
+    у всей группы на любую дату одна и та же смена, поэтому её считают один раз.
+
+    Для статистики по месяцам хранится только поправка ручных смен к циклу:
+    month_deltas[user_id][(год, месяц)][тип смены]. Счёт по правилам за месяц
+    считается по формуле, так что статистика любого месяца не обходит дни графика.
+    """
+
+    def __init__(self):
+        # date -> {user_id: тип смены или None}
+        self.by_date = defaultdict(dict)
+        self.user_dates = defaultdict(set)
+        # (цикл, фаза) -> {(user_id, anchor): дата окончания действия правила}
+        self.rule_groups = defaultdict(dict)
+        self.user_rule_keys = defaultdict(list)
+        # user_id -> {(год, месяц): {тип смены: ручные смены минус смены цикла в эти дни}}
+        self.month_deltas = defaultdict(dict)
+
+    def rule_shift(self, user_id, day):
+        """Смена по правилам пользователя на дату (без ручных смен) или None"""
+        for (cycle, phase), (_, anchor) in self.user_rule_keys.get(user_id, ()):
+            if anchor <= day < self.rule_groups[(cycle, phase)][(user_id, anchor)]:
+                return cycle[(day.toordinal() - phase) % len(cycle)]
+        return None
+
+    def _count_delta(self, user_id, day, old, new):
+        """Поправка статистики месяца: в день day вместо смены old теперь new"""
+        if old == new:
+            return
+        months = self.month_deltas[user_id]
+        key = (day.year, day.month)
+        counts = months.setdefault(key, {})
+        for shift_type, step in ((old, -1), (new, 1)):
+            if shift_type:
+                counts[shift_type] = counts.get(shift_type, 0) + step
+                if not counts[shift_type]:
+                    del counts[shift_type]
+        if not counts:
+            del months[key]
+            if not months:
+                del self.month_deltas[user_id]
+
+    def set_override(self, user_id, day, shift_type):
+        bucket = self.by_date[day]
+        old = bucket[user_id] if user_id in bucket else self.rule_shift(user_id, day)
+        self._count_delta(user_id, day, old, shift_type)
+        bucket[user_id] = shift_type
+        self.user_dates[user_id].add(day)
+
+    def remove_override(self, user_id, day):
+        bucket = self.by_date.get(day)
+        if bucket is not None and user_id in bucket:
+            self._count_delta(user_id, day, bucket.pop(user_id), self.rule_shift(user_id, day))
+            if not bucket:
+                del self.by_date[day]
+        self.user_dates[user_id].discard(day)
+
+    def drop_overrides_from(self, user_id, start_date):
+        """Убрать ручные смены пользователя начиная с start_date (их заменило правило)"""
+        for day in [d for d in self.user_dates.get(user_id, ()) if d >= start_date]:
+            self.remove_override(user_id, day)
+
+    def set_rules(self, user_id, rules):
+        """Заменить правила пользователя (отсортированы по anchor)"""
+        # Под ручными сменами меняется смена цикла: переносим поправки статистики
+        overrides = self.user_dates.get(user_id, ())
+        old_base = {day: self.rule_shift(user_id, day) for day in overrides}
+        for group, key in self.user_rule_keys.pop(user_id, []):
+            members = self.rule_groups[group]
+            del members[key]
+            if not members:
+                del self.rule_groups[group]
+        for i, rule in enumerate(rules):
+            end = rules[i + 1].anchor if i + 1 < len(rules) else date.max
+            phase = (rule.anchor.toordinal() - rule.cycle.index(rule.start)) % len(rule.cycle)
+            group = (rule.cycle, phase)
+            self.rule_groups[group][(user_id, rule.anchor)] = end
+            self.user_rule_keys[user_id].append((group, (user_id, rule.anchor)))
+        for day, base in old_base.items():
+            self._count_delta(user_id, day, self.rule_shift(user_id, day), base)
+
+    def month_stats(self, user_id, year, month):
+        """Число дней каждого типа смены за месяц: {тип смены: число}
+
+        Счёт по правилам - по формуле для каждого правила, плюс поправка ручных смен.
+        """
+        start = date(year, month, 1)
+        # Последний день включительно: следующего месяца после декабря 9999 года нет
+        end = date(year, month, monthrange(year, month)[1])
+        counts = defaultdict(int)
+        for (cycle, phase), (_, anchor) in self.user_rule_keys.get(user_id, ()):
+            first = max(start, anchor)
+            last = min(end, self.rule_groups[(cycle, phase)][(user_id, anchor)] - timedelta(days=1))
+            days = (last - first).days + 1
+            if days <= 0:
+                continue
+            full, rest = divmod(days, len(cycle))
+            offset = (first.toordinal() - phase) % len(cycle)
+            for position, shift_type in enumerate(cycle):
+                counts[shift_type] += full + ((position - offset) % len(cycle) < rest)
+        for shift_type, delta in self.month_deltas.get(user_id, {}).get((year, month), {}).items():
+            counts[shift_type] += delta
+        return {shift_type: count for shift_type, count in counts.items() if count}
+
+    def remove_user(self, user_id):
+        self.set_rules(user_id, [])
+        self.user_rule_keys.pop(user_id, None)
+        for day in list(self.user_dates.get(user_id, ())):
+            self.remove_override(user_id, day)
+        self.user_dates.pop(user_id, None)
+
+    def users_on(self, day):
+        """Все пользователи со сменой на дату: [(user_id, тип смены)]"""
+        explicit = self.by_date.get(day, {})
+        result = [(user_id, shift_type) for user_id, shift_type in explicit.items() if shift_type]
+        ordinal = day.toordinal()
+        for (cycle, phase), members in self.rule_groups.items():
+            shift_type = cycle[(ordinal - phase) % len(cycle)]
+            for (user_id, anchor), end in members.items():
+                if anchor <= day < end and user_id not in explicit:
+                    result.append((user_id, shift_type))
+        return result
+
+    def rosters(self, user_ids, start_date, end_date):
+        """Кто из user_ids на какой смене по дням: [(date, {тип смены: [user_id]})]
+
+        Правила участников группируются по (цикл, фаза): смена считается один раз на
+        группу и день. Ручные смены берутся из корзин дат, графики целиком не обходятся.
+        """
+        user_ids = set(user_ids)
+        groups = defaultdict(list)
+        for user_id in user_ids:
+            for group, key in self.user_rule_keys.get(user_id, ()):
+                groups[group].append((key[1], self.rule_groups[group][key], user_id))
+
+        result = []
+        day = start_date
+        while day <= end_date:
+            bucket = self.by_date.get(day, {})
+            if len(bucket) < len(user_ids):
+                explicit = {u: t for u, t in bucket.items() if u in user_ids}
+            else:
+                explicit = {u: bucket[u] for u in user_ids if u in bucket}
+            roster = defaultdict(list)
+            for user_id, shift_type in explicit.items():
+                if shift_type:
+                    roster[shift_type].append(user_id)
+            ordinal = day.toordinal()
+            for (cycle, phase), members in groups.items():
+                shift_type = cycle[(ordinal - phase) % len(cycle)]
+                for anchor, end, user_id in members:
+                    if anchor <= day < end and user_id not in explicit:
+                        roster[shift_type].append(user_id)
+            result.append((day, dict(roster)))
+            day += timedelta(days=1)
+        return result
+
+    def user_entries(self):
+        """Содержимое индекса по пользователям - для сверки с основными данными"""
+        entries = defaultdict(set)
+        for day, bucket in self.by_date.items():
+            for user_id, shift_type in bucket.items():
+                entries[user_id].add(('shift', day, shift_type))
+        for group, members in self.rule_groups.items():
+            for (user_id, anchor), end in members.items():
+                entries[user_id].add(('rule', group, anchor, end))
+        for user_id, months in self.month_deltas.items():
+            for month, counts in months.items():
+                entries[user_id].add(('stats', month, tuple(sorted(counts.items()))))
+        return entries
+
+class ScheduleStorage:
+    """Интерфейс хранилища графиков
+
+    График пользователя - это правила автографика (ShiftRule) и ручные смены поверх
+    них. Ручная смена со значением None означает, что смену из цикла удалили.
+
+    Блокировок нет: хранилище вызывается только из потока цикла событий. Составные
+    операции (delete_shift, прочитать и записать в обработчике) не прерываются, пока
+    в них нет await, а апдейты одного пользователя не перемешиваются благодаря
+    PerUserUpdateProcessor. Поэтому между чтением и записью графика нельзя ставить
+    await, а из потоков (asyncio.to_thread) хранилище не трогают - только готовый снимок.
+    """
+
+    def __init__(self):
+        # Функции f(user_id), вызываемые после любого изменения графика пользователя
+        self.listeners = []
+        # Функции f(user_ids), вызываемые после изменений из других процессов (refresh):
+        # множество изменённых пользователей или None, если перечитано всё
+        self.remote_listeners = []
+        # Номер версии графика пользователя, растёт при каждом изменении
+        self.versions = defaultdict(int)
+        self.rebuild_index()
+
+    def get_version(self, user_id):
+        """Версия графика пользователя (меняется при любом изменении)"""
+        return self.versions.get(str(user_id), 0)
+
+    def get_rules(self, user_id):
+        """Правила автографика пользователя, по возрастанию anchor"""
+        raise NotImplementedError
+
+    def iter_overrides(self, user_id, start_date, end_date):
+        """Ручные смены за период по возрастанию даты: (date, тип смены или None)"""
+        raise NotImplementedError
+
+    def count_shifts(self, user_id):
+        """Количество ручных смен в графике пользователя"""
+        raise NotImplementedError
+
+    def iter_users(self):
+        """Все графики: (user_id, правила, {date: тип смены или None})"""
+        raise NotImplementedError
+
+    def get_settings(self, user_id):
+        """Настройки пользователя (часовой пояс, напоминания), пустой словарь по умолчанию"""
+        raise NotImplementedError
+
+    def set_settings(self, user_id, settings):
+        """Сохранить настройки пользователя целиком"""
+        raise NotImplementedError
+
+    def iter_settings(self):
+        """Все непустые настройки: (user_id, настройки)"""
+        raise NotImplementedError
+
+    def count_users(self):
+        """Число пользователей с графиком"""
+        raise NotImplementedError
+
+    def refresh(self):
+        """Подхватить изменения, сделанные другими процессами; True, если что-то изменилось"""
+        return False
+
+    def prune_changes(self):
+        """Очистка старых записей об изменениях для других процессов, возвращает число удалённых"""
+        return 0
+
+    def get_team(self, name):
+        """Команда {'owner': user_id, 'members': {user_id, ...}, 'invited': {user_id, ...}} или None
+
+        members - подтвердившие участие (создатель - всегда), invited - приглашённые,
+        которые ещё не подтвердили. Графики команды видны только по members.
+        """
+        raise NotImplementedError
+
+    def set_team(self, name, owner, members, invited=()):
+        """Создать команду или заменить её состав"""
+        raise NotImplementedError
+
+    def delete_team(self, name):
+        raise NotImplementedError
+
+    # Изменения состава по одному участнику. В одном процессе хватает get_team/set_team
+    # (между ними нет await), в кластере SQLite делает это построчно, чтобы воркеры,
+    # одновременно меняющие одну команду, не затирали изменения друг друга
+
+    def invite_team_members(self, name, user_ids, limit=MAX_TEAM_SIZE):
+        """Пригласить тех, кого ещё нет в команде; False, если в ней стало бы больше limit человек"""
+        team = self.get_team(name)
+        if team is None:
+            return True
+        invited = team['invited'] | (set(user_ids) - team['members'])
+        if len(team['members']) + len(invited) > limit:
+            return False
+        self.set_team(name, team['owner'], team['members'], invited)
+        return True
+
+    def accept_team_invite(self, name, user_id):
+        """Перевести приглашённого в участники; False, если приглашения нет"""
+        team = self.get_team(name)
+        if team is None or user_id not in team['invited']:
+            return False
+        self.set_team(name, team['owner'], team['members'] | {user_id}, team['invited'] - {user_id})
+        return True
+
+    def remove_team_members(self, name, user_ids):
+        """Убрать из участников и приглашённых (создателя вызывающий не передаёт)"""
+        team = self.get_team(name)
+        if team is None:
+            return
+        user_ids = set(user_ids)
+        self.set_team(name, team['owner'], team['members'] - user_ids, team['invited'] - user_ids)
+
+    def iter_teams(self):
+        """Все команды: (название, команда)"""
+        raise NotImplementedError
+
+    def _write_shifts(self, user_id, shifts):
+        raise NotImplementedError
+
+    def _write_rule(self, user_id, rule):
+        raise NotImplementedError
+
+    def _write_rules(self, rules):
+        """Правила многих пользователей {user_id: ShiftRule}; хранилища пишут их одной транзакцией"""
+        for user_id, rule in rules.items():
+            self._write_rule(user_id, rule)
+
+    def _remove_shift(self, user_id, day):
+        raise NotImplementedError
+
+    def _clear_user(self, user_id):
+        raise NotImplementedError
+
+    def _build_index(self):
+        index = ScheduleIndex()
+        for user_id, rules, overrides in self.iter_users():
+            index.set_rules(user_id, rules)
+            for day, shift_type in overrides.items():
+                index.set_override(user_id, day, shift_type)
+        return index
+
+    def rebuild_index(self):
+        """Построение индекса дата -> пользователи по основным данным (при запуске)"""
+        self.index = self._build_index()
+
+    def verify_index(self):
+        """Сверка индекса с основными данными, при расхождении индекс перестраивается
+
+        Возвращает множество пользователей, у которых индекс разошёлся с данными.
+        """
+        fresh = self._build_index()
+        current_entries = self.index.user_entries()
+        fresh_entries = fresh.user_entries()
+        mismatched = {
+            user_id
+            for user_id in current_entries.keys() | fresh_entries.keys()
+            if current_entries.get(user_id) != fresh_entries.get(user_id)
+        }
+        if mismatched:
+            logger.warning(f"Индекс графика разошёлся с данными у пользователей: {len(mismatched)}, перестраиваем")
+            self.index = fresh
+        return mismatched
+
+    def set_shift(self, user_id, day, shift_type):
+        """Добавить или заменить одну смену (None - убрать смену из цикла)"""
+        self.set_shifts(user_id, {day: shift_type})
+
+    def set_shifts(self, user_id, shifts):
+        """Добавить или заменить набор смен {date: тип смены} одной операцией"""
+        self._write_shifts(user_id, shifts)
+        for day, shift_type in shifts.items():
+            self.index.set_override(user_id, day, shift_type)
+        self._notify(user_id)
+
+    def set_rule(self, user_id, rule):
+        """Автографик с rule.anchor: заменяет правила и ручные смены начиная с этой даты"""
+        self._write_rule(user_id, rule)
+        self.index.drop_overrides_from(user_id, rule.anchor)
+        self.index.set_rules(user_id, self.get_rules(user_id))
+        self._notify(user_id)
+
+    def set_rule_batch(self, rules):
+        """Автографики многих пользователей {user_id: ShiftRule} одной операцией хранилища
+
+        Для каждого пользователя - то же, что set_rule.
+        """
+        self._write_rules(rules)
+        for user_id, rule in rules.items():
+            self.index.drop_overrides_from(user_id, rule.anchor)
+            self.index.set_rules(user_id, self.get_rules(user_id))
+            self._notify(user_id)
+
+    def remove_shift(self, user_id, day):
+        """Удалить ручную смену на дату без учёта правил"""
+        self._remove_shift(user_id, day)
+        self.index.remove_override(user_id, day)
+        self._notify(user_id)
+
+    def clear_user(self, user_id):
+        """Удалить весь график пользователя, возвращает (число правил, число ручных смен)"""
+        counts = self._clear_user(user_id)
+        self.index.remove_user(user_id)
+        self._notify(user_id)
+        return counts
+
+    def _bump_version(self, user_id):
+        self.versions[str(user_id)] += 1
+
+    def _notify(self, user_id):
+        self._bump_version(user_id)
+        for listener in self.listeners:
+            listener(user_id)
+
+    def users_on(self, day):
+        """Все пользователи со сменой на дату: [(user_id, тип смены)] - одна корзина индекса"""
+        return self.index.users_on(day)
+
+    def rosters(self, user_ids, start_date, end_date):
+        """Кто из user_ids на какой смене по дням: [(date, {тип смены: [user_id]})]"""
+        return self.index.rosters(user_ids, start_date, end_date)
+
+    def month_stats(self, user_id, year, month):
+        """Сколько дней каждого типа смены у пользователя за месяц - из индекса, без обхода графика"""
+        return self.index.month_stats(str(user_id), year, month)
+
+    def check_month_stats(self, user_id, year, month):
+        """Сверка статистики месяца с графиком: (из индекса, пересчёт по дням)"""
+        start = date(year, month, 1)
+        end = date(year, month, monthrange(year, month)[1])
+        counts = defaultdict(int)
+        for _, shift_type in self.iter_shifts(user_id, start, end):
+            counts[shift_type] += 1
+        return self.month_stats(user_id, year, month), dict(counts)
+
+    def get_shift(self, user_id, day):
+        """Смена пользователя на дату или None"""
+        for _, shift_type in self.iter_overrides(user_id, day, day):
+            return shift_type
+        return resolve_rule(self.get_rules(user_id), day)
+
+    def has_schedule(self, user_id):
+        """Есть ли у пользователя хоть какой-то график"""
+        return bool(self.get_rules(user_id)) or self.count_shifts(user_id) > 0
+
+    def iter_shifts(self, user_id, start_date, end_date=date.max):
+        """Смены с start_date по возрастанию даты: (date, тип смены)
+
+        Выборка ленивая. Если есть правило, график бесконечен - ограничивайте её через
+        end_date или islice.
+        """
+        rules = self.get_rules(user_id)
+        overrides = self.iter_overrides(user_id, start_date, end_date)
+        rules_start = rules[0].anchor if rules else date.max
+
+        # До начала первого правила в графике только ручные смены
+        override = next(overrides, None)
+        while override is not None and override[0] < rules_start:
+            if override[1]:
+                yield override
+            override = next(overrides, None)
+
+        day = max(start_date, rules_start)
+        while rules and day <= end_date:
+            if override is not None and override[0] == day:
+                shift_type = override[1]
+                override = next(overrides, None)
+            else:
+                shift_type = resolve_rule(rules, day)
+            if shift_type:
+                yield day, shift_type
+            if day == date.max:
+                break
+            day += timedelta(days=1)
+
+    def get_range(self, user_id, start_date, end_date):
+        """Смены за период [start_date, end_date] по возрастанию даты: [(дата, тип смены)]"""
+        return list(self.iter_shifts(user_id, start_date, end_date))
+
+    def delete_shift(self, user_id, day):
+        """Удалить смену, возвращает True если она была"""
+        if self.get_shift(user_id, day) is None:
+            return False
+        if resolve_rule(self.get_rules(user_id), day):
+            # День покрыт циклом: запоминаем, что смены в этот день нет
+            self.set_shift(user_id, day, None)
+        else:
+            self.remove_shift(user_id, day)
+        return True
+
+    def flush(self):
+        """Запись отложенных изменений, возвращает число изменённых пользователей"""
+        return 0
+
+    async def flush_async(self):
+        """То же, что flush, из цикла событий: медленная запись на диск - в отдельном потоке"""
+        return self.flush()
+
+    def files(self):
+        """Файлы, в которых хранилище держит данные на диске (для метрики размера)"""
+        return []
+
+    def close(self):
+        """Освобождение ресурсов хранилища"""
+
+class JsonScheduleStorage(ScheduleStorage):
+    """Хранилище в JSON-файле: график держится в памяти, на диск пишется пачками"""
+
+    def __init__(self, path=SCHEDULE_FILE):
+        self.path = path
+        self.users, self.teams = self._load()
+        # Пользователи, изменённые после последней записи на диск
+        self.dirty_users = set()
+        self.teams_dirty = False
+        super().__init__()
+
+    def _load(self):
+        """Графики и команды при запуске: ({user_id: UserSchedule}, {название: команда})"""
+        data = load_schedule(self.path)
+        return parse_schedule(data), parse_teams(data)
+
+    def _user(self, user_id):
+        user_data = self.users.get(user_id)
+        if user_data is None:
+            user_data = self.users[user_id] = UserSchedule()
+        return user_data
+
+    def _mark_dirty(self, user_id):
+        self.dirty_users.add(user_id)
+
+    def get_rules(self, user_id):
+        user_data = self.users.get(user_id)
+        return list(user_data.rules) if user_data else []
+
+    def iter_overrides(self, user_id, start_date, end_date):
+        user_data = self.users.get(user_id)
+        if user_data is None:
+            return
+        for day, shift_type in user_data.shifts.irange(start_date.toordinal(), end_date.toordinal()):
+            yield date.fromordinal(day), shift_type
+
+    def count_shifts(self, user_id):
+        user_data = self.users.get(user_id)
+        return user_data.shifts.count_filled() if user_data else 0
+
+    def iter_users(self):
+        for user_id, user_data in self.users.items():
+            overrides = {date.fromordinal(d): t for d, t in user_data.shifts.items()}
+            yield user_id, list(user_data.rules), overrides
+
+    def count_users(self):
+        return sum(1 for user_data in self.users.values() if user_data.rules or user_data.shifts)
+
+    def get_settings(self, user_id):
+        user_data = self.users.get(user_id)
+        return dict(user_data.settings or {}) if user_data else {}
+
+    def set_settings(self, user_id, settings):
+        self._user(user_id).settings = dict(settings) or None
+        self._mark_dirty(user_id)
+
+    def iter_settings(self):
+        for user_id, user_data in self.users.items():
+            if user_data.settings:
+                yield user_id, dict(user_data.settings)
+
+    def get_team(self, name):
+        team = self.teams.get(name)
+        if team is None:
+            return None
+        return {'owner': team['owner'], 'members': set(team['members']), 'invited': set(team['invited'])}
+
+    def set_team(self, name, owner, members, invited=()):
+        self.teams[name] = {'owner': owner, 'members': set(members), 'invited': set(invited)}
+        self.teams_dirty = True
+
+    def delete_team(self, name):
+        self.teams.pop(name, None)
+        self.teams_dirty = True
+
+    def iter_teams(self):
+        for name in list(self.teams):
+            yield name, self.get_team(name)
+
+    def _write_shifts(self, user_id, shifts):
+        self._user(user_id).shifts.update((day.toordinal(), shift_type) for day, shift_type in shifts.items())
+        self._mark_dirty(user_id)
+
+    def _write_rule(self, user_id, rule):
+        user_data = self._user(user_id)
+        user_data.rules = tuple(r for r in user_data.rules if r.anchor < rule.anchor) + (rule,)
+        user_data.shifts.truncate_from(rule.anchor.toordinal())
+        self._mark_dirty(user_id)
+
+    def _remove_shift(self, user_id, day):
+        self._user(user_id).shifts.remove(day.toordinal())
+        self._mark_dirty(user_id)
+
+    def _clear_user(self, user_id):
+        user_data = self.users.get(user_id)
+        if not user_data:
+            return 0, 0
+        counts = len(user_data.rules), user_data.shifts.count_filled()
+        # Настройки напоминаний при очистке графика сохраняем
+        user_data.rules = ()
+        user_data.shifts = PackedShifts()
+        self._mark_dirty(user_id)
+        return counts
+
+    def _snapshot(self):
+        """Копия графиков и команд для записи из другого потока: (users, teams)
+
+        Правила - кортежи, настройки и команды при изменении заменяются целиком, а у
+        смен копируется ссылка на bytes. Снимок 5000 пользователей - миллисекунды.
+        """
+        users = {
+            user_id: UserSchedule(user_data.rules, user_data.shifts.copy(), user_data.settings)
+            for user_id, user_data in self.users.items()
+        }
+        return users, dict(self.teams)
+
+    def _save(self, users, teams):
+        save_schedule(dump_schedule(users, teams), self.path, compact=True)
+
+    def _take_dirty(self):
+        dirty = self.dirty_users, self.teams_dirty
+        self.dirty_users, self.teams_dirty = set(), False
+        return dirty
+
+    def _restore_dirty(self, dirty_users, teams_dirty):
+        # Не теряем отметки: повторим запись при следующем сбросе
+        self.dirty_users |= dirty_users
+        self.teams_dirty = self.teams_dirty or teams_dirty
+
+    def flush(self):
+        """Запись накопленных изменений на диск, возвращает число изменённых пользователей"""
+        if not self.dirty_users and not self.teams_dirty:
+            return 0
+        dirty_users, teams_dirty = self._take_dirty()
+        try:
+            self._save(self.users, self.teams)
+        except Exception:
+            self._restore_dirty(dirty_users, teams_dirty)
+            raise
+        return len(dirty_users)
+
+    async def flush_async(self):
+        """Снимок графика - в цикле событий, сериализация и fsync - в потоке
+
+        Изменения, сделанные во время записи, снова отмечаются и уйдут следующим сбросом.
+        """
+        if not self.dirty_users and not self.teams_dirty:
+            return 0
+        dirty_users, teams_dirty = self._take_dirty()
+        try:
+            await asyncio.to_thread(self._save, *self._snapshot())
+        except Exception:
+            self._restore_dirty(dirty_users, teams_dirty)
+            raise
+        return len(dirty_users)
+
+    def files(self):
+        return [self.path]
+
+    def close(self):
+        self.flush()
+
+def encode_journal_record(record):
+    """Строка журнала: CRC32 JSON-записи в hex, пробел, сама запись"""
+    payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+def read_journal(path):
+    """Чтение журнала: (поколение, [записи], длина целой части файла в байтах, длина файла)
+
+    Первая запись - заголовок с номером поколения. Чтение останавливается на первой
+    битой строке: это недописанный хвост после сбоя, всё после него отбрасывается.
+    """
+    generation, records, valid = None, [], 0
+    if not os.path.exists(path):
+        return generation, records, valid, 0
+    with open(path, 'rb') as f:
+        for line in f:
+            crc, _, payload = line.rstrip(b'\n').partition(b' ')
+            if not line.endswith(b'\n') or crc != b'%08x' % zlib.crc32(payload):
+                break
+            record = json.loads(payload)
+            if generation is None:
+                generation = record['generation']
+            else:
+                records.append(record)
+            valid += len(line)
+        size = f.seek(0, os.SEEK_END)
+    return generation, records, valid, size
+
+def read_packed_header(path):
+    """Заголовок двоичного снимка без чтения графиков"""
+    with open(path, 'rb') as f:
+        if f.read(len(PACKED_SCHEDULE_MAGIC)) != PACKED_SCHEDULE_MAGIC:
+            raise ValueError(f"{path}: не снимок графика")
+        length, = PACKED_LENGTH.unpack(f.read(PACKED_LENGTH.size))
+        return json.loads(f.read(length))
+
+class JournalScheduleStorage(JsonScheduleStorage):
+    """Хранилище со снимком и журналом: изменение - одна дописанная строка, а не весь файл
+
+    При запуске читается снимок (SCHEDULE_SNAPSHOT) и проигрывается хвост журнала
+    (SCHEDULE_JOURNAL). Записи копятся в памяти и пишутся одним fsync при flush, то есть
+    раз в SCHEDULE_FLUSH_INTERVAL: при сбое теряется не больше одной пачки. Когда в
+    журнале набирается JOURNAL_COMPACT_RECORDS записей, он сжимается в новый снимок.
+
+    Снимок и журнал помечены поколением. Если сбой случился после записи снимка, но до
+    замены журнала, старый журнал (предыдущего поколения) при запуске пропускается.
+    """
+
+    def __init__(self, snapshot_path=SCHEDULE_SNAPSHOT, journal_path=SCHEDULE_JOURNAL,
+                 json_path=SCHEDULE_FILE, compact_records=JOURNAL_COMPACT_RECORDS):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_records = compact_records
+        self.pending = []
+        self.journal_lock = threading.Lock()
+        self.generation = 0
+        self.journal_records = 0
+        self.journal = None
+        self.journal_generation = None
+        self.replaying = False
+        super().__init__(json_path)
+        if not os.path.exists(snapshot_path):
+            # Первый запуск: график из schedule.json становится снимком поколения 1
+            self.compact()
+        elif self.journal_generation != self.generation:
+            # Журнала нет или он уже вошёл в снимок: дальше пишем в новый
+            self._start_journal()
+        else:
+            self.journal = open(journal_path, 'ab')
+
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            self.users, self.teams, header = load_packed_schedule(self.snapshot_path, use_mmap=True)
+            self.generation = header.get('journal_generation', 0)
+        else:
+            self.users, self.teams = super()._load()
+
+        generation, records, valid, size = read_journal(self.journal_path)
+        self.journal_generation = generation
+        if generation is None and size:
+            raise ValueError(f"{self.journal_path}: не удалось прочитать заголовок журнала")
+        if generation is not None and generation < self.generation:
+            logger.info(f"Журнал {self.journal_path} уже вошёл в снимок (поколение {generation}), пропускаем")
+            records, valid = [], size
+        elif generation is not None and generation > self.generation:
+            raise ValueError(
+                f"{self.journal_path}: поколение журнала {generation} новее снимка ({self.generation})"
+            )
+        self.replaying = True
+        try:
+            for record in records:
+                self._apply(record)
+        finally:
+            self.replaying = False
+        self.journal_records = len(records)
+        if valid < size:
+            logger.warning(f"Журнал {self.journal_path}: отброшен недописанный хвост, байт: {size - valid}")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid)
+        if records:
+            logger.info(f"Из журнала применено записей: {len(records)}")
+        return self.users, self.teams
+
+    def _apply(self, record):
+        """Повтор одной записи журнала на графике в памяти"""
+        op = record['op']
+        if op == 'set':
+            self._write_shifts(record['user'], {
+                date.fromisoformat(day): shift_type for day, shift_type in record['shifts'].items()
+            })
+        elif op == 'rule':
+            self._write_rule(record['user'], rule_from_json(record['rule']))
+        elif op == 'rules':
+            self._write_rules({user_id: rule_from_json(rule) for user_id, rule in record['rules'].items()})
+        elif op == 'delete':
+            self._remove_shift(record['user'], date.fromisoformat(record['date']))
+        elif op == 'clear':
+            self._clear_user(record['user'])
+        elif op == 'settings':
+            self.set_settings(record['user'], record['settings'])
+        elif op == 'team':
+            team = team_from_json(record)
+            self.set_team(record['name'], team['owner'], team['members'], team['invited'])
+        elif op == 'team_delete':
+            self.delete_team(record['name'])
+        else:
+            raise ValueError(f"Неизвестная операция журнала: {op}")
+
+    def _log(self, record):
+        if not self.replaying:
+            line = encode_journal_record(record)
+            with self.journal_lock:
+                self.pending.append(line)
+
+    def _mark_dirty(self, user_id):
+        pass
+
+    def set_settings(self, user_id, settings):
+        super().set_settings(user_id, settings)
+        self._log({'op': 'settings', 'user': user_id, 'settings': settings})
+
+    def set_team(self, name, owner, members, invited=()):
+        super().set_team(name, owner, members, invited)
+        self._log({
+            'op': 'team', 'name': name, 'owner': owner,
+            'members': sorted(members, key=int), 'invited': sorted(invited, key=int)
+        })
+
+    def delete_team(self, name):
+        super().delete_team(name)
+        self._log({'op': 'team_delete', 'name': name})
+
+    def _write_shifts(self, user_id, shifts):
+        super()._write_shifts(user_id, shifts)
+        self._log({
+            'op': 'set', 'user': user_id,
+            'shifts': {day.isoformat(): shift_type for day, shift_type in shifts.items()}
+        })
+
+    def _write_rule(self, user_id, rule):
+        super()._write_rule(user_id, rule)
+        self._log({'op': 'rule', 'user': user_id, 'rule': rule_to_json(rule)})
+
+    def _write_rules(self, rules):
+        for user_id, rule in rules.items():
+            JsonScheduleStorage._write_rule(self, user_id, rule)
+        # Вся пачка - одна запись: после сбоя применяется целиком или не применяется
+        self._log({'op': 'rules', 'rules': {user_id: rule_to_json(rule) for user_id, rule in rules.items()}})
+
+    def _remove_shift(self, user_id, day):
+        super()._remove_shift(user_id, day)
+        self._log({'op': 'delete', 'user': user_id, 'date': day.isoformat()})
+
+    def _clear_user(self, user_id):
+        counts = super()._clear_user(user_id)
+        self._log({'op': 'clear', 'user': user_id})
+        return counts
+
+    def _append(self, pending):
+        self.journal.write(b''.join(pending))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def _take_pending(self):
+        with self.journal_lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def _restore_pending(self, pending):
+        # Не теряем записи: повторим при следующем сбросе
+        with self.journal_lock:
+            self.pending = pending + self.pending
+
+    def flush(self):
+        """Дописать накопленные записи в журнал одним fsync, возвращает число записей"""
+        pending = self._take_pending()
+        if pending:
+            try:
+                self._append(pending)
+            except Exception:
+                self._restore_pending(pending)
+                raise
+            self.journal_records += len(pending)
+        if self.journal_records >= self.compact_records:
+            self.compact()
+        return len(pending)
+
+    async def flush_async(self):
+        """Как flush, но fsync журнала и запись снимка при сжатии - в потоке"""
+        pending = self._take_pending()
+        if pending:
+            try:
+                await asyncio.to_thread(self._append, pending)
+            except Exception:
+                self._restore_pending(pending)
+                raise
+            self.journal_records += len(pending)
+        if self.journal_records >= self.compact_records:
+            started = perf_counter()
+            records = self.journal_records
+            # Всё, что ещё не в журнале, войдёт в снимок; записанное во время сжатия
+            # попадёт в pending и уйдёт уже в новый журнал
+            unwritten = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write_snapshot, *self._snapshot(), self.generation + 1)
+            except Exception:
+                self._restore_pending(unwritten)
+                raise
+            self._log_compaction(records, started)
+        return len(pending)
+
+    def _write_snapshot(self, users, teams, generation):
+        """Снимок поколения generation и пустой журнал после него"""
+        save_packed_schedule(users, self.snapshot_path, teams, journal_generation=generation)
+        self.generation = generation
+        self._start_journal()
+
+    def _log_compaction(self, records, started):
+        logger.info(
+            f"Журнал сжат в снимок поколения {self.generation}: записей {records}, "
+            f"{perf_counter() - started:.2f} с"
+        )
+
+    def compact(self):
+        """Записать снимок следующего поколения и начать пустой журнал"""
+        started = perf_counter()
+        with self.journal_lock:
+            records = self.journal_records
+            self._write_snapshot(self.users, self.teams, self.generation + 1)
+            # Всё, что ещё не в журнале, уже вошло в снимок
+            self.pending = []
+        self._log_compaction(records, started)
+
+    def _start_journal(self):
+        """Пустой журнал текущего поколения вместо старого (временный файл + rename)"""
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_journal_record({'generation': self.generation}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'ab')
+        self.journal_generation = self.generation
+        self.journal_records = 0
+
+    def files(self):
+        return [self.snapshot_path, self.journal_path]
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+
+def inspect_journal(snapshot_path=SCHEDULE_SNAPSHOT, journal_path=SCHEDULE_JOURNAL):
+    """Сводка по снимку и журналу для команды journal inspect"""
+    lines = []
+    snapshot_generation = 0
+    if os.path.exists(snapshot_path):
+        header = read_packed_header(snapshot_path)
+        snapshot_generation = header.get('journal_generation', 0)
+        lines.append(
+            f"Снимок {snapshot_path}: поколение {snapshot_generation}, пользователей {header['users']}, "
+            f"команд {len(header.get('teams', {}))}, {os.path.getsize(snapshot_path)} байт"
+        )
+    else:
+        lines.append(f"Снимка {snapshot_path} нет")
+    generation, records, valid, size = read_journal(journal_path)
+    if generation is None:
+        lines.append(f"Журнала {journal_path} нет" if not size else f"Журнал {journal_path}: битый заголовок")
+        return lines
+    counts = defaultdict(int)
+    for record in records:
+        counts[record['op']] += 1
+    state = "уже в снимке" if generation < snapshot_generation else "будет применён при запуске"
+    lines.append(f"Журнал {journal_path}: поколение {generation} ({state}), записей {len(records)}, {size} байт")
+    for op, count in sorted(counts.items()):
+        lines.append(f"  {op}: {count}")
+    if valid < size:
+        lines.append(f"  недописанный хвост: {size - valid} байт (отбросится при запуске)")
+    return lines
+
+class SqliteScheduleStorage(ScheduleStorage):
+    """Хранилище в SQLite (WAL): одна строка на (пользователь, дата) и таблица правил
+
+    Каждая запись графика или настроек добавляет в той же транзакции строку в таблицу
+    changes (seq, user_id). seq - общая для всех воркеров версия графика пользователя,
+    а refresh по ней перечитывает только тех, кого изменили другие процессы.
+    """
+
+    def __init__(self, path, json_path=None):
+        """json_path - schedule.json для однократного переноса при первом запуске"""
+        self.path = path
+        self.conn = self.connect(path)
+        if json_path is not None:
+            # Переносим до построения индекса: индекс строится один раз, уже с перенесённым
+            migrate_json_to_sqlite(json_path, path, conn=self.conn)
+        # Меняется, когда в базу пишет другое соединение (другой воркер)
+        self.data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        super().__init__()
+
+    @classmethod
+    def connect(cls, path):
+        """Соединение с базой графика: WAL и актуальная схема"""
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        cls._migrate(conn)
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        """Создание и обновление схемы базы (версия хранится в PRAGMA user_version)"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            # shift_type может быть NULL: смена из цикла, удалённая вручную
+            conn.executescript(
+                """
+                BEGIN;
+                CREATE TABLE IF NOT EXISTS shifts (
+                    user_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    shift_type TEXT NOT NULL,
+                    PRIMARY KEY (user_id, day)
+                ) WITHOUT ROWID;
+                CREATE TABLE shifts_new (
+                    user_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    shift_type TEXT,
+                    PRIMARY KEY (user_id, day)
+                ) WITHOUT ROWID;
+                INSERT INTO shifts_new SELECT user_id, day, shift_type FROM shifts;
+                DROP TABLE shifts;
+                ALTER TABLE shifts_new RENAME TO shifts;
+                CREATE INDEX shifts_day ON shifts (day);
+                CREATE TABLE rules (
+                    user_id INTEGER NOT NULL,
+                    anchor TEXT NOT NULL,
+                    start_shift TEXT NOT NULL,
+                    cycle TEXT NOT NULL,
+                    PRIMARY KEY (user_id, anchor)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                PRAGMA user_version = 1;
+                COMMIT;
+                """
+            )
+        if version < 2:
+            conn.executescript(
+                """
+                BEGIN;
+                CREATE TABLE settings (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                PRAGMA user_version = 2;
+                COMMIT;
+                """
+            )
+        if version < 3:
+            conn.executescript(
+                """
+                BEGIN;
+                CREATE TABLE teams (
+                    name TEXT PRIMARY KEY,
+                    owner INTEGER NOT NULL
+                );
+                CREATE TABLE team_members (
+                    team TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    PRIMARY KEY (team, user_id)
+                ) WITHOUT ROWID;
+                PRAGMA user_version = 3;
+                COMMIT;
+                """
+            )
+        if version < 4:
+            # Участие в команде подтверждает сам участник; добавленные раньше без согласия -
+            # приглашённые (accepted = 0), подтверждённым остаётся только создатель
+            conn.executescript(
+                """
+                BEGIN;
+                ALTER TABLE team_members ADD COLUMN accepted INTEGER NOT NULL DEFAULT 0;
+                UPDATE team_members SET accepted = 1
+                WHERE user_id = (SELECT owner FROM teams WHERE teams.name = team_members.team);
+                PRAGMA user_version = 4;
+                COMMIT;
+                """
+            )
+        if version < 5:
+            # Журнал изменений для других процессов: кто изменился после seq
+            conn.executescript(
+                """
+                BEGIN;
+                CREATE TABLE changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL
+                );
+                PRAGMA user_version = 5;
+                COMMIT;
+                """
+            )
+
+    @staticmethod
+    def _rule_from_row(anchor, start_shift, cycle):
+        return ShiftRule(date.fromisoformat(anchor), start_shift, tuple(cycle.split(',')))
+
+    def get_rules(self, user_id):
+        rows = self.conn.execute(
+            'SELECT anchor, start_shift, cycle FROM rules WHERE user_id = ? ORDER BY anchor',
+            (int(user_id),)
+        )
+        return [self._rule_from_row(*row) for row in rows]
+
+    def iter_overrides(self, user_id, start_date, end_date):
+        rows = self.conn.execute(
+            'SELECT day, shift_type FROM shifts WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day',
+            (int(user_id), start_date.isoformat(), end_date.isoformat())
+        )
+        for day, shift_type in rows:
+            yield date.fromisoformat(day), shift_type
+
+    def count_shifts(self, user_id):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM shifts WHERE user_id = ? AND shift_type IS NOT NULL',
+            (int(user_id),)
+        ).fetchone()[0]
+
+    def iter_users(self):
+        rules = defaultdict(list)
+        for user_id, anchor, start_shift, cycle in self.conn.execute(
+            'SELECT user_id, anchor, start_shift, cycle FROM rules ORDER BY user_id, anchor'
+        ):
+            rules[str(user_id)].append(self._rule_from_row(anchor, start_shift, cycle))
+        overrides = defaultdict(dict)
+        for user_id, day, shift_type in self.conn.execute('SELECT user_id, day, shift_type FROM shifts'):
+            overrides[str(user_id)][date.fromisoformat(day)] = shift_type
+        for user_id in rules.keys() | overrides.keys():
+            yield user_id, rules.get(user_id, []), overrides.get(user_id, {})
+
+    def count_users(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM (SELECT user_id FROM shifts UNION SELECT user_id FROM rules)'
+        ).fetchone()[0]
+
+    def get_settings(self, user_id):
+        row = self.conn.execute('SELECT data FROM settings WHERE user_id = ?', (int(user_id),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_settings(self, user_id, settings):
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO settings (user_id, data) VALUES (?, ?) '
+                'ON CONFLICT (user_id) DO UPDATE SET data = excluded.data',
+                (int(user_id), json.dumps(settings, ensure_ascii=False))
+            )
+            self._log_changes([user_id])
+
+    def iter_settings(self):
+        for user_id, data in self.conn.execute('SELECT user_id, data FROM settings'):
+            settings = json.loads(data)
+            if settings:
+                yield str(user_id), settings
+
+    def get_team(self, name):
+        row = self.conn.execute('SELECT owner FROM teams WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        team = {'owner': str(row[0]), 'members': set(), 'invited': set()}
+        for user_id, accepted in self.conn.execute(
+            'SELECT user_id, accepted FROM team_members WHERE team = ?', (name,)
+        ):
+            team['members' if accepted else 'invited'].add(str(user_id))
+        return team
+
+    def set_team(self, name, owner, members, invited=()):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO teams (name, owner) VALUES (?, ?)', (name, int(owner)))
+            self.conn.execute('DELETE FROM team_members WHERE team = ?', (name,))
+            self.conn.executemany(
+                'INSERT INTO team_members (team, user_id, accepted) VALUES (?, ?, ?)',
+                [(name, int(user_id), 1) for user_id in members]
+                + [(name, int(user_id), 0) for user_id in invited]
+            )
+
+    def delete_team(self, name):
+        with self.conn:
+            self.conn.execute('DELETE FROM teams WHERE name = ?', (name,))
+            self.conn.execute('DELETE FROM team_members WHERE team = ?', (name,))
+
+    def invite_team_members(self, name, user_ids, limit=MAX_TEAM_SIZE):
+        with self.conn:
+            # IMMEDIATE: подсчёт и вставка под одной блокировкой записи
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO team_members (team, user_id, accepted) '
+                'SELECT ?, ?, 0 WHERE EXISTS (SELECT 1 FROM teams WHERE name = ?)',
+                [(name, int(user_id), name) for user_id in user_ids]
+            )
+            size, = self.conn.execute('SELECT COUNT(*) FROM team_members WHERE team = ?', (name,)).fetchone()
+            if size > limit:
+                self.conn.rollback()
+                return False
+        return True
+
+    def accept_team_invite(self, name, user_id):
+        with self.conn:
+            cursor = self.conn.execute(
+                'UPDATE team_members SET accepted = 1 WHERE team = ? AND user_id = ? AND accepted = 0',
+                (name, int(user_id))
+            )
+        return cursor.rowcount == 1
+
+    def remove_team_members(self, name, user_ids):
+        with self.conn:
+            self.conn.executemany(
+                'DELETE FROM team_members WHERE team = ? AND user_id = ?',
+                [(name, int(user_id)) for user_id in user_ids]
+            )
+
+    def iter_teams(self):
+        names = [name for name, in self.conn.execute('SELECT name FROM teams ORDER BY name')]
+        for name in names:
+            yield name, self.get_team(name)
+
+    def _log_changes(self, user_ids):
+        """Записи в changes об изменении пользователей - последним действием транзакции записи"""
+        user_ids = [str(user_id) for user_id in user_ids]
+        self.conn.executemany('INSERT INTO changes (user_id) VALUES (?)', [(int(u),) for u in user_ids])
+        last = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()[0]
+        first = last - len(user_ids) + 1
+        # Пишет одно соединение за раз, поэтому номера одной транзакции идут подряд
+        for seq, user_id in enumerate(user_ids, first):
+            self.versions[user_id] = seq
+        if first == self.last_change + 1:
+            self.last_change = last
+        else:
+            # Между прочитанным и нашей записью есть чужие изменения: свои пропустит refresh
+            self.own_changes.update(range(first, last + 1))
+
+    def _bump_version(self, user_id):
+        # Версия - номер записи в changes, он уже выставлен в _log_changes
+        pass
+
+    def get_version(self, user_id):
+        return self.versions.get(str(user_id), self.pruned_to)
+
+    def _write_shifts(self, user_id, shifts):
+        rows = [(int(user_id), day.isoformat(), t) for day, t in shifts.items()]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO shifts (user_id, day, shift_type) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id, day) DO UPDATE SET shift_type = excluded.shift_type',
+                rows
+            )
+            self._log_changes([user_id])
+
+    def _write_rule(self, user_id, rule):
+        anchor = rule.anchor.isoformat()
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM rules WHERE user_id = ? AND anchor >= ?', (int(user_id), anchor)
+            )
+            self.conn.execute(
+                'DELETE FROM shifts WHERE user_id = ? AND day >= ?', (int(user_id), anchor)
+            )
+            self.conn.execute(
+                'INSERT INTO rules (user_id, anchor, start_shift, cycle) VALUES (?, ?, ?, ?)',
+                (int(user_id), anchor, rule.start, ','.join(rule.cycle))
+            )
+            self._log_changes([user_id])
+
+    def _write_rules(self, rules):
+        anchors = [(int(user_id), rule.anchor.isoformat()) for user_id, rule in rules.items()]
+        with self.conn:
+            self.conn.executemany('DELETE FROM rules WHERE user_id = ? AND anchor >= ?', anchors)
+            self.conn.executemany('DELETE FROM shifts WHERE user_id = ? AND day >= ?', anchors)
+            self.conn.executemany(
+                'INSERT INTO rules (user_id, anchor, start_shift, cycle) VALUES (?, ?, ?, ?)',
+                [
+                    (int(user_id), rule.anchor.isoformat(), rule.start, ','.join(rule.cycle))
+                    for user_id, rule in rules.items()
+                ]
+            )
+            self._log_changes(rules)
+
+    def _remove_shift(self, user_id, day):
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM shifts WHERE user_id = ? AND day = ?',
+                (int(user_id), day.isoformat())
+            )
+            self._log_changes([user_id])
+
+    def _pruned_to(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'changes_pruned_to'").fetchone()
+        return int(row[0]) if row else 0
+
+    def rebuild_index(self):
+        # Номер последнего изменения читаем до данных: то, что запишут во время построения,
+        # refresh перечитает ещё раз
+        self.pruned_to = self._pruned_to()
+        self.versions = {
+            str(user_id): seq
+            for user_id, seq in self.conn.execute('SELECT user_id, MAX(seq) FROM changes GROUP BY user_id')
+        }
+        self.last_change = max([self.pruned_to, *self.versions.values()])
+        self.own_changes = set()
+        super().rebuild_index()
+
+    def _reload_user(self, user_id):
+        """Перечитать график одного пользователя из базы в индекс"""
+        self.index.remove_user(user_id)
+        self.index.set_rules(user_id, self.get_rules(user_id))
+        for day, shift_type in self.iter_overrides(user_id, date.min, date.max):
+            self.index.set_override(user_id, day, shift_type)
+
+    def refresh(self):
+        """Подхватить изменения других воркеров: перечитываются только изменённые пользователи
+
+        Проверка PRAGMA data_version почти ничего не стоит, поэтому refresh вызывается
+        перед каждым апдейтом. Если changes уже очищена дальше прочитанного (воркер долго
+        стоял), индекс перестраивается целиком.
+        """
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        if self.last_change < self._pruned_to():
+            logger.warning("Журнал изменений очищен дальше прочитанного, перестраиваем индекс целиком")
+            self.rebuild_index()
+            changed = None
+        else:
+            changed = set()
+            for seq, user_id in self.conn.execute(
+                'SELECT seq, user_id FROM changes WHERE seq > ? ORDER BY seq', (self.last_change,)
+            ):
+                user_id = str(user_id)
+                self.versions[user_id] = seq
+                self.last_change = seq
+                if seq in self.own_changes:
+                    self.own_changes.discard(seq)
+                else:
+                    changed.add(user_id)
+            for user_id in changed:
+                self._reload_user(user_id)
+            if not changed:
+                return False
+        for listener in self.remote_listeners:
+            listener(changed)
+        return True
+
+    def prune_changes(self, keep=CHANGES_KEEP_ROWS):
+        with self.conn:
+            row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            cutoff = (row[0] if row else 0) - keep
+            if cutoff <= self._pruned_to():
+                return 0
+            removed = self.conn.execute('DELETE FROM changes WHERE seq <= ?', (cutoff,)).rowcount
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('changes_pruned_to', ?)", (str(cutoff),)
+            )
+        return removed
+
+    def _clear_user(self, user_id):
+        shifts_count = self.count_shifts(user_id)
+        with self.conn:
+            rules_count = self.conn.execute(
+                'DELETE FROM rules WHERE user_id = ?', (int(user_id),)
+            ).rowcount
+            self.conn.execute('DELETE FROM shifts WHERE user_id = ?', (int(user_id),))
+            self._log_changes([user_id])
+        return rules_count, shifts_count
+
+    def files(self):
+        # В режиме WAL свежие записи лежат в -wal, пока их не перенесёт checkpoint
+        return [self.path, self.path + '-wal']
+
+    def close(self):
+        self.conn.close()
+
+def migrate_json_to_sqlite(json_path=SCHEDULE_FILE, db_path=SCHEDULE_DB, conn=None):
+    """Однократный перенос графика из schedule.json в SQLite
+
+    conn - уже открытое соединение (так переносит SqliteScheduleStorage при запуске, до
+    построения индекса); без него база открывается только на время переноса.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    own_conn = conn is None
+    if own_conn:
+        conn = SqliteScheduleStorage.connect(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+            logger.info(f"Перенос из {json_path} уже выполнялся, пропускаем")
+            return 0
+        data = load_schedule(json_path)
+        users = parse_schedule(data)
+        rows = [
+            (int(user_id), date.fromordinal(day).isoformat(), shift_type)
+            for user_id, user_data in users.items()
+            for day, shift_type in user_data.shifts.items()
+        ]
+        rule_rows = [
+            (int(user_id), rule.anchor.isoformat(), rule.start, ','.join(rule.cycle))
+            for user_id, user_data in users.items()
+            for rule in user_data.rules
+        ]
+        with conn:
+            conn.executemany(
+                'INSERT INTO shifts (user_id, day, shift_type) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id, day) DO UPDATE SET shift_type = excluded.shift_type',
+                rows
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO rules (user_id, anchor, start_shift, cycle) VALUES (?, ?, ?, ?)',
+                rule_rows
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO settings (user_id, data) VALUES (?, ?)',
+                [
+                    (int(user_id), json.dumps(user_data.settings, ensure_ascii=False))
+                    for user_id, user_data in users.items()
+                    if user_data.settings
+                ]
+            )
+            for name, team in parse_teams(data).items():
+                conn.execute('INSERT OR REPLACE INTO teams (name, owner) VALUES (?, ?)', (name, int(team['owner'])))
+                conn.executemany(
+                    'INSERT OR REPLACE INTO team_members (team, user_id, accepted) VALUES (?, ?, ?)',
+                    [(name, int(user_id), 1) for user_id in team['members']]
+                    + [(name, int(user_id), 0) for user_id in team['invited']]
+                )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                (datetime.now().isoformat(),)
+            )
+        logger.info(
+            f"Перенесено из {json_path} в {db_path}: смен {len(rows)}, правил {len(rule_rows)}"
+        )
+        return len(rows) + len(rule_rows)
+    finally:
+        if own_conn:
+            conn.close()
+
+_storage = None
+
+def get_storage():
+    """Хранилище графиков, выбранное через STORAGE_BACKEND"""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == 'sqlite':
+            # При первом запуске на SQLite переносим старый schedule.json
+            _storage = SqliteScheduleStorage(SCHEDULE_DB, json_path=SCHEDULE_FILE)
+        elif STORAGE_BACKEND == 'json':
+            _storage = JsonScheduleStorage()
+        elif STORAGE_BACKEND == 'journal':
+            _storage = JournalScheduleStorage()
+        else:
+            raise ValueError(f"Неизвестное хранилище: {STORAGE_BACKEND}")
+    return _storage
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+    """Счётчик Prometheus с метками"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+class Gauge:
+    """Показатель Prometheus, значение считается функцией в момент запроса /metrics"""
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.error(f"Ошибка расчёта метрики {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value:g}"]
+
+class Histogram:
+    """Гистограмма Prometheus с метками (время в секундах)"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        # метки -> [счётчики по корзинам..., сумма, количество]
+        self.values = {}
+
+    def observe(self, *label_values, value):
+        data = self.values.get(label_values)
+        if data is None:
+            data = self.values[label_values] = [0] * len(self.BUCKETS) + [0.0, 0]
+        position = bisect_left(self.BUCKETS, value)
+        if position < len(self.BUCKETS):
+            data[position] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, data in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, data):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), label_values + (f"{bound:g}",))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ('le',), label_values + ('+Inf',))
+            lines.append(f"{self.name}_bucket{labels} {data[-1]}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {data[-2]:g}")
+            lines.append(f"{self.name}_count{labels} {data[-1]}")
+        return lines
+
+class BotMetrics:
+    """Метрики бота: обработчики, хранилище, напоминания"""
+
+    def __init__(self, storage):
+        self.handler_seconds = Histogram(
+            'shift_bot_handler_seconds', 'Время обработки апдейта', ('handler',))
+        self.handler_errors = Counter(
+            'shift_bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+        self.conversation_outcomes = Counter(
+            'shift_bot_conversation_steps_total', 'Переходы диалогов по результату шага',
+            ('handler', 'outcome'))
+        self.storage_seconds = Histogram(
+            'shift_bot_storage_seconds', 'Время операций хранилища', ('operation',))
+        self.storage_errors = Counter(
+            'shift_bot_storage_errors_total', 'Ошибки операций хранилища', ('operation',))
+        self.reminder_run_seconds = Histogram(
+            'shift_bot_reminder_run_seconds', 'Длительность рассылки напоминаний')
+        self.reminder_messages = Counter(
+            'shift_bot_reminder_messages_total', 'Сообщения рассылки по результату', ('result',))
+        self.throttled_updates = Counter(
+            'shift_bot_throttled_updates_total', 'Апдейты, отклонённые ограничением частоты',
+            ('category', 'scope'))
+        self.gauges = [
+            Gauge('shift_bot_storage_file_bytes', 'Размер файлов хранилища графика',
+                  lambda: sum(os.path.getsize(path) for path in storage.files() if os.path.exists(path))),
+            Gauge('shift_bot_storage_users', 'Пользователей с графиком', storage.count_users),
+            Gauge('shift_bot_storage_dirty_users', 'Изменения, ещё не записанные на диск',
+                  lambda: len(getattr(storage, 'dirty_users', ()))),
+        ]
+
+    def observe_delivery(self, stats):
+        self.reminder_run_seconds.observe(value=stats.duration)
+        self.reminder_messages.inc('sent', amount=stats.sent)
+        self.reminder_messages.inc('failed', amount=stats.failed)
+        self.reminder_messages.inc('throttled', amount=stats.throttled)
+        self.reminder_messages.inc('retried', amount=stats.retried)
+
+    def render(self):
+        lines = []
+        for metric in (self.handler_seconds, self.handler_errors, self.conversation_outcomes,
+                       self.storage_seconds, self.storage_errors, self.reminder_run_seconds,
+                       self.reminder_messages, self.throttled_updates, *self.gauges):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# Метрики включаются переменной METRICS_PORT, иначе обработчики не оборачиваются вовсе
+metrics = None
+
+# Состояния диалогов для меток метрик
+STATE_NAMES = {
+    CHOOSING_DATE: 'choosing_date',
+    CHOOSING_SHIFT: 'choosing_shift',
+    CHOOSING_AUTO_DATE: 'choosing_auto_date',
+    CHOOSING_AUTO_SHIFT: 'choosing_auto_shift',
+    CHOOSING_IMPORT: 'choosing_import',
+    CHOOSING_AUTOFILL: 'choosing_autofill',
+    ConversationHandler.END: 'end',
+}
+
+# Операции хранилища, время которых попадает в метрики
+INSTRUMENTED_STORAGE_METHODS = (
+    'get_rules', 'get_shift', 'count_shifts', 'set_shifts', 'set_rule', 'remove_shift',
+    'delete_shift', 'clear_user', 'users_on', 'get_settings', 'set_settings', 'flush', 'flush_async',
+)
+
+def _timed_storage_method(method, operation):
+    if inspect.iscoroutinefunction(method):
+        async def async_wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                metrics.storage_errors.inc(operation)
+                raise
+            finally:
+                metrics.storage_seconds.observe(operation, value=perf_counter() - started)
+        return async_wrapper
+
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            metrics.storage_errors.inc(operation)
+            raise
+        finally:
+            metrics.storage_seconds.observe(operation, value=perf_counter() - started)
+    return wrapper
+
+def instrument_storage(storage):
+    """Замер времени операций хранилища (подменяет методы экземпляра)"""
+    for operation in INSTRUMENTED_STORAGE_METHODS:
+        setattr(storage, operation, _timed_storage_method(getattr(storage, operation), operation))
+
+def _timed_callback(callback, name, conversation):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = perf_counter()
+        try:
+            result = await callback(update, context)
+        except ApplicationHandlerStop:
+            # Штатная остановка обработки апдейта (ограничение частоты), не ошибка
+            raise
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+        finally:
+            metrics.handler_seconds.observe(name, value=perf_counter() - started)
+        if conversation:
+            metrics.conversation_outcomes.inc(name, STATE_NAMES.get(result, str(result)))
+        return result
+    return wrapper
+
+def instrument_application(application):
+    """Замер времени всех зарегистрированных обработчиков, включая шаги диалогов"""
+    def wrap(handler, conversation=False):
+        handler.callback = _timed_callback(handler.callback, handler.callback.__name__, conversation)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                steps = list(handler.entry_points) + list(handler.fallbacks)
+                for state_handlers in handler.states.values():
+                    steps.extend(state_handlers)
+                for step in steps:
+                    wrap(step, conversation=True)
+            else:
+                wrap(handler)
+
+class RequestTooLarge(ValueError):
+    """Content-Length больше MAX_HTTP_BODY: тело не читается"""
+
+async def read_http_request(reader, max_body=MAX_HTTP_BODY):
+    """Разбор HTTP-запроса: (метод, путь без query, заголовки, тело) или None
+
+    Неверный Content-Length - ValueError, слишком большой - RequestTooLarge, тело
+    короче заявленного - asyncio.IncompleteReadError.
+    """
+    request_line = await reader.readline()
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 2:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length < 0:
+        raise ValueError(f"Content-Length: {length}")
+    if length > max_body:
+        raise RequestTooLarge(f"Content-Length: {length}")
+    body = await reader.readexactly(length)
+    return parts[0], parts[1].split('?')[0], headers, body
+
+async def write_http_response(writer, status, body, content_type='text/plain; charset=utf-8'):
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode('latin-1') + body
+    )
+    await writer.drain()
+
+async def handle_metrics_request(reader, writer):
+    """Минимальный HTTP-обработчик: GET /metrics в текстовом формате Prometheus"""
+    try:
+        request = await read_http_request(reader)
+        if request is not None and request[0] == 'GET' and request[1] == '/metrics':
+            await write_http_response(writer, '200 OK', metrics.render().encode('utf-8'),
+                                      'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            await write_http_response(writer, '404 Not Found', b'not found\n')
+    except RequestTooLarge:
+        await write_http_response(writer, '413 Payload Too Large', b'too large\n')
+    except (ValueError, asyncio.IncompleteReadError):
+        await write_http_response(writer, '400 Bad Request', b'bad request\n')
+    finally:
+        writer.close()
+
+def setup_metrics():
+    """Включение метрик, если задан METRICS_PORT"""
+    global metrics
+    if METRICS_PORT and metrics is None:
+        storage = get_storage()
+        metrics = BotMetrics(storage)
+        instrument_storage(storage)
+    return metrics
+
+class SqlitePersistence(BasePersistence):
+    """Состояния диалогов и user_data в SQLite: перезапуск не обрывает начатые диалоги
+
+    Файл могут делить несколько воркеров: апдейты распределяются по user_id, поэтому
+    каждый воркер пишет только строки своих пользователей.
+    """
+
+    def __init__(self, path, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                conversation_key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (name, conversation_key)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    async def get_user_data(self):
+        return {
+            user_id: json.loads(data)
+            for user_id, data in self.conn.execute('SELECT user_id, data FROM user_data')
+        }
+
+    async def update_user_data(self, user_id, data):
+        with self.conn:
+            if data:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                    (user_id, json.dumps(data, ensure_ascii=False))
+                )
+            else:
+                self.conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+
+    async def drop_user_data(self, user_id):
+        with self.conn:
+            self.conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+
+    async def get_conversations(self, name):
+        rows = self.conn.execute(
+            'SELECT conversation_key, state FROM conversations WHERE name = ?', (name,)
+        )
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        with self.conn:
+            if new_state is None:
+                self.conn.execute(
+                    'DELETE FROM conversations WHERE name = ? AND conversation_key = ?',
+                    (name, json.dumps(list(key)))
+                )
+            else:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO conversations (name, conversation_key, state) VALUES (?, ?, ?)',
+                    (name, json.dumps(list(key)), json.dumps(new_state))
+                )
+
+    # chat_data, bot_data и callback_data бот не использует
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Каждое изменение уже записано своей транзакцией
+        pass
+
+# Что считается чтением и тяжёлой записью для ограничения частоты: кнопки и команды.
+# Диалоги тяжёлых записей (автозаполнение, /import, /autofill) здесь не перечислены:
+# токен списывается на последнем шаге (take_throttle_token), а не при открытии диалога,
+# чтобы отмена его не тратила
+THROTTLE_READ_TEXTS = ("📋 Мой график",)
+THROTTLE_READ_COMMANDS = {'stats', 'export', 'roster', 'coverage'}
+THROTTLE_WRITE_TEXTS = ("🗑 Очистить весь график",)
+
+class RateLimiter:
+    """Token bucket без ожидания: rate запросов в секунду на ключ с запасом capacity
+
+    Ключа нет в словаре - бак полон, поэтому наполнившиеся баки можно удалять (prune).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        # ключ -> (токены, время обновления)
+        self.buckets = {}
+
+    def take(self, key, now):
+        """Взять токен: 0, если можно, иначе сколько секунд ждать следующего"""
+        tokens, updated = self.buckets.get(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+        self.buckets[key] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    def give_back(self, key):
+        """Вернуть токен, если запрос всё-таки не выполнен"""
+        tokens, updated = self.buckets[key]
+        self.buckets[key] = (min(self.capacity, tokens + 1), updated)
+
+    def prune(self, now):
+        """Удалить баки, которые уже наполнились"""
+        full = [
+            key for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate >= self.capacity
+        ]
+        for key in full:
+            del self.buckets[key]
+        return len(full)
+
+def throttle_category(update):
+    """'read', 'write' или None (не ограничивается) по тексту сообщения"""
+    message = update.message
+    if message is None or not message.text:
+        return None
+    text = message.text
+    if text.startswith('/'):
+        command = text[1:].split(maxsplit=1)[0].split('@')[0].lower() if len(text) > 1 else ''
+        if command in THROTTLE_READ_COMMANDS:
+            return 'read'
+        return None
+    if any(button in text for button in THROTTLE_READ_TEXTS):
+        return 'read'
+    if any(button in text for button in THROTTLE_WRITE_TEXTS):
+        return 'write'
+    return None
+
+class UpdateThrottle:
+    """Ограничение частоты запросов перед обработчиками
+
+    Для каждой категории (чтение, тяжёлая запись) свой бак на пользователя и общий бак
+    на всех. Один шумный пользователь упирается в свой бак и не отнимает общий.
+    """
+
+    def __init__(self, read=(THROTTLE_READ_PER_MINUTE, THROTTLE_READ_BURST, THROTTLE_GLOBAL_READ_RATE),
+                 write=(THROTTLE_WRITE_PER_MINUTE, THROTTLE_WRITE_BURST, THROTTLE_GLOBAL_WRITE_RATE)):
+        """read, write - (в минуту на пользователя, запас подряд, в секунду на всех); 0 - без ограничения"""
+        self.limiters = {}
+        for category, (per_minute, burst, global_rate) in (('read', read), ('write', write)):
+            self.limiters[category] = (
+                RateLimiter(per_minute / 60, max(1, burst)) if per_minute > 0 else None,
+                RateLimiter(global_rate, max(1, global_rate)) if global_rate > 0 else None,
+            )
+        # (категория, 'allowed' / 'user' / 'global') -> апдейтов с прошлой записи в лог
+        self.counters = defaultdict(int)
+        # (user_id, категория) -> до какого момента пользователь уже знает, что его ограничили
+        self.notified_until = {}
+
+    def check(self, category, user_id, now):
+        """(0, None), если апдейт можно обработать, иначе (сколько секунд ждать, 'user' или 'global')"""
+        per_user, overall = self.limiters[category]
+        if per_user is not None:
+            wait = per_user.take(user_id, now)
+            if wait:
+                self.counters[(category, 'user')] += 1
+                return wait, 'user'
+        if overall is not None:
+            wait = overall.take(None, now)
+            if wait:
+                if per_user is not None:
+                    per_user.give_back(user_id)
+                self.counters[(category, 'global')] += 1
+                return wait, 'global'
+        self.counters[(category, 'allowed')] += 1
+        return 0, None
+
+    def should_notify(self, category, user_id, now, wait):
+        """Отвечать об ограничении один раз за период ожидания, а не на каждое нажатие"""
+        key = (user_id, category)
+        if self.notified_until.get(key, 0) > now:
+            return False
+        self.notified_until[key] = now + wait
+        return True
+
+    def take_stats(self, now):
+        """Счётчики с прошлого вызова; заодно убираем наполнившиеся баки"""
+        counters, self.counters = self.counters, defaultdict(int)
+        for limiters in self.limiters.values():
+            for limiter in limiters:
+                if limiter is not None:
+                    limiter.prune(now)
+        self.notified_until = {key: until for key, until in self.notified_until.items() if until > now}
+        return counters
+
+_update_throttle = None
+
+def get_update_throttle():
+    global _update_throttle
+    if _update_throttle is None:
+        _update_throttle = UpdateThrottle()
+    return _update_throttle
+
+async def take_throttle_token(update, category):
+    """Списать токен категории; False (и один ответ за период ожидания), если лимит исчерпан"""
+    throttle = get_update_throttle()
+    now = perf_counter()
+    wait, scope = throttle.check(category, update.effective_user.id, now)
+    if not wait:
+        return True
+    if metrics is not None:
+        metrics.throttled_updates.inc(category, scope)
+    if throttle.should_notify(category, update.effective_user.id, now, wait):
+        await update.effective_message.reply_text(
+            f"⏳ Слишком много запросов подряд. Попробуй ещё раз через {max(1, round(wait))} сек."
+        )
+    return False
+
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -2, до всех обработчиков: апдейт сверх лимита дальше не идёт"""
+    category = throttle_category(update)
+    if category is None or update.effective_user is None:
+        return
+    if not await take_throttle_token(update, category):
+        raise ApplicationHandlerStop
+
+async def refresh_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: изменения графика из других воркеров кластера - до индекса и кэшей
+
+    Каждый воркер держит свой индекс и кэши, поэтому проверяет базу перед каждым апдейтом.
+    """
+    get_storage().refresh()
+
+async def log_throttle_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Счётчики ограничения частоты в лог, если кого-то ограничили - для подбора лимитов"""
+    counters = get_update_throttle().take_stats(perf_counter())
+    if not any(counters[(category, scope)] for category in ('read', 'write') for scope in ('user', 'global')):
+        return
+    parts = [
+        f"{category}: пропущено {counters[(category, 'allowed')]}, "
+        f"по лимиту пользователя {counters[(category, 'user')]}, по общему {counters[(category, 'global')]}"
+        for category in ('read', 'write')
+    ]
+    logger.info(f"Ограничение запросов за {THROTTLE_LOG_INTERVAL} с: " + "; ".join(parts))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных пользователей
+
+    Диалоги и user_data рассчитаны на последовательные шаги, поэтому апдейты одного
+    пользователя ждут друг друга (в порядке поступления), а остальные не ждут.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # Семафор базового класса берётся до очереди пользователя, и быстрые нажатия
+        # одного пользователя заняли бы все места. Поэтому лимит считаем сами, уже
+        # после блокировки пользователя, а базовому классу отдаём заведомо больший.
+        super().__init__(2 ** 31 - 1)
+        self.limit = max_concurrent_updates
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        # user_id -> [блокировка, сколько апдейтов пользователя в работе]
+        self.user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.slots:
+                await coroutine
+            return
+        entry = self.user_locks.get(user.id)
+        if entry is None:
+            entry = self.user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self.slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def flush_schedule_loop(storage, stop):
+    """Фоновый сброс изменений графика на диск каждые SCHEDULE_FLUSH_INTERVAL секунд
+
+    Запись идёт в потоке (flush_async), поэтому задачу не отменяют посреди записи, а
+    останавливают через stop: финальный flush при закрытии не пересечётся с ней.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), SCHEDULE_FLUSH_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            count = await storage.flush_async()
+            if count:
+                logger.debug(f"График сохранён, изменённых пользователей: {count}")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения графика: {e}")
+
+_flush_task = None
+_flush_stop = None
+_metrics_server = None
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после инициализации бота"""
+    global _flush_task, _flush_stop, _metrics_server
+    _flush_stop = asyncio.Event()
+    _flush_task = asyncio.create_task(flush_schedule_loop(get_storage(), _flush_stop))
+    if metrics is not None:
+        _metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def post_shutdown(application: Application):
+    """Остановка фоновых задач и финальный сброс графика на диск"""
+    if _flush_task is not None:
+        # Дожидаемся записи, которая уже идёт в потоке
+        _flush_stop.set()
+        await _flush_task
+    if _metrics_server is not None:
+        _metrics_server.close()
+    if _reminder_scheduler is not None:
+        _reminder_scheduler.outbox.close()
+    get_storage().close()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     keyboard = [
@@ -76,7 +2601,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Привет! Я помогу тебе отслеживать график смен.\n\n"
         "🔔 Каждый день в 20:05 буду напоминать о завтрашней смене!\n\n"
-        "🤖 Используй 'Автозаполнение графика' чтобы заполнить весь год автоматически!\n\n"
+        "🤖 Используй 'Автозаполнение графика' чтобы заполнить график по циклу автоматически!\n\n"
         "Выбери действие:",
         reply_markup=reply_markup
     )
@@ -86,25 +2611,34 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "📖 <b>Доступные команды:</b>\n\n"
         "📅 <b>Добавить смену</b> - добавить одну дату вручную\n"
-        "🤖 <b>Автозаполнение графика</b> - заполнить весь год автоматически\n"
+        "🤖 <b>Автозаполнение графика</b> - заполнить график по циклу автоматически\n"
         "   (просто укажи начальную дату и тип смены)\n"
         "📋 <b>Мой график</b> - посмотреть все смены\n"
         "🗑 <b>Удалить смену</b> - удалить конкретную дату\n"
         "🗑 <b>Очистить весь график</b> - удалить все смены\n\n"
         "<b>Цикл смен:</b>\n"
         "☕ День → 🌙 Ночь → 😴 Отсыпной → 🎉 Выходной\n\n"
-        "⏰ Напоминания приходят каждый день в 20:05"
+        "⏰ Напоминания приходят каждый день в 20:05\n"
+        "/reminder - время напоминания и напоминания до смены\n"
+        "/timezone - твой часовой пояс\n\n"
+        "/import - загрузить график из CSV или календаря (.ics)\n"
+        "/export - выгрузить график в календарь (.ics), /export csv - в таблицу\n"
+        "/stats - сколько смен за месяц, /stats 2026 - по месяцам года\n\n"
+        "/team - команды: кто на какой смене и дни без покрытия\n"
+        "/autofill - графики всей команды одним списком (для администраторов)\n"
+        "/myid - твой id для приглашения в команду"
     )
     await update.message.reply_text(help_text, parse_mode='HTML')
 
 async def auto_schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало автозаполнения графика"""
     await update.message.reply_text(
-        "🤖 <b>Автозаполнение графика на год</b>\n\n"
-        "Укажи дату начала в формате ДД.ММ.ГГГГ\n"
+        "🤖 <b>Автозаполнение графика</b>\n\n"
+        "Выбери дату начала в календаре или введи в формате ДД.ММ.ГГГГ\n"
         "Например: 16.01.2026\n\n"
         "Или напиши 'отмена' для выхода",
-        parse_mode='HTML'
+        parse_mode='HTML',
+        reply_markup=calendar_markup(update.effective_user.id)
     )
     return CHOOSING_AUTO_DATE
 
@@ -122,38 +2656,48 @@ async def auto_schedule_receive_date(update: Update, context: ContextTypes.DEFAU
             [KeyboardButton("ℹ️ Помощь")]
         ]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text("❌ Автозаполнение отменено", reply_markup=reply_markup)
-        return ConversationHandler.END
-    
-    try:
-        # Проверяем формат даты
-        date_obj = datetime.strptime(text, '%d.%m.%Y')
-        context.user_data['auto_start_date'] = text
-        
-        # Кнопки для выбора начальной смены
-        keyboard = [
-            [KeyboardButton("☕ Дневная смена")],
-            [KeyboardButton("🌙 Ночная смена")],
-            [KeyboardButton("😴 Отсыпной")],
-            [KeyboardButton("🎉 Выходной")],
-            [KeyboardButton("❌ Отмена")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        await update.message.reply_text(
-            f"✅ Начальная дата: {text}\n\n"
-            "Теперь выбери с какой смены начать цикл:\n\n"
-            "Цикл будет: День → Ночь → Отсыпной → Выходной",
-            reply_markup=reply_markup
-        )
-        return CHOOSING_AUTO_SHIFT
-        
+        await update.message.reply_text("❌ Автозаполнение отменено", reply_markup=reply_markup)
+        return ConversationHandler.END
+    
+    try:
+        # Проверяем формат даты
+        datetime.strptime(text, '%d.%m.%Y')
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат даты!\n"
             "Используй формат: ДД.ММ.ГГГГ (например, 16.01.2026)"
         )
         return CHOOSING_AUTO_DATE
+    return await ask_auto_shift(update, context, text)
+
+async def auto_schedule_receive_date_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начальная дата автозаполнения из календаря"""
+    text = await calendar_choice(update)
+    if text is None:
+        return CHOOSING_AUTO_DATE
+    return await ask_auto_shift(update, context, text)
+
+async def ask_auto_shift(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    """Начальная дата выбрана - спрашиваем, с какой смены начать цикл"""
+    context.user_data['auto_start_date'] = text
+    
+    # Кнопки для выбора начальной смены
+    keyboard = [
+        [KeyboardButton("☕ Дневная смена")],
+        [KeyboardButton("🌙 Ночная смена")],
+        [KeyboardButton("😴 Отсыпной")],
+        [KeyboardButton("🎉 Выходной")],
+        [KeyboardButton("❌ Отмена")]
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await update.effective_message.reply_text(
+        f"✅ Начальная дата: {text}\n\n"
+        "Теперь выбери с какой смены начать цикл:\n\n"
+        "Цикл будет: День → Ночь → Отсыпной → Выходной",
+        reply_markup=reply_markup
+    )
+    return CHOOSING_AUTO_SHIFT
 
 async def auto_schedule_receive_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение начальной смены и генерация графика"""
@@ -184,22 +2728,16 @@ async def auto_schedule_receive_shift(update: Update, context: ContextTypes.DEFA
         shift_type = 'dayoff'
     
     if shift_type:
+        # Тяжёлая запись - только здесь, на последнем шаге: отменивший диалог токен не тратит
+        if not await take_throttle_token(update, 'write'):
+            return CHOOSING_AUTO_SHIFT
         start_date = context.user_data['auto_start_date']
         user_id = str(update.effective_user.id)
         
-        await update.message.reply_text("⏳ Генерирую график на год...")
-        
-        # Генерируем график на 365 дней
-        auto_schedule = generate_auto_schedule(start_date, shift_type, days=365)
-        
-        # Загружаем существующий график
-        schedule = load_schedule()
-        if user_id not in schedule:
-            schedule[user_id] = {}
-        
-        # Добавляем автоматически сгенерированный график
-        schedule[user_id].update(auto_schedule)
-        save_schedule(schedule)
+        # Сохраняем правило цикла вместо списка дат: график не ограничен по сроку
+        storage = get_storage()
+        start_date_obj = parse_date(start_date)
+        storage.set_rule(user_id, ShiftRule(start_date_obj, shift_type, tuple(SHIFT_CYCLE)))
         
         shift_info = SHIFT_TYPES[shift_type]
         
@@ -216,20 +2754,17 @@ async def auto_schedule_receive_shift(update: Update, context: ContextTypes.DEFA
         
         # Показываем первые несколько дней для примера
         preview = []
-        start_date_obj = datetime.strptime(start_date, '%d.%m.%Y')
-        for i in range(8):  # Показываем первые 8 дней (2 цикла)
-            date = start_date_obj + timedelta(days=i)
-            date_str = date.strftime('%d.%m.%Y')
-            shift = auto_schedule[date_str]
+        # Показываем первые 8 дней (2 цикла)
+        for day, shift in storage.get_range(user_id, start_date_obj, start_date_obj + timedelta(days=7)):
             shift_info_preview = SHIFT_TYPES[shift]
-            preview.append(f"{shift_info_preview['emoji']} {date_str} - {shift_info_preview['name']}")
+            preview.append(f"{shift_info_preview['emoji']} {format_date(day)} - {shift_info_preview['name']}")
         
         preview_text = "\n".join(preview)
         
         await update.message.reply_text(
-            f"✅ График на год заполнен автоматически!\n\n"
+            f"✅ График заполнен автоматически!\n\n"
             f"📅 Начало: {start_date}\n"
-            f"📊 Добавлено смен: 365\n\n"
+            f"🔁 Цикл повторяется без ограничения по сроку\n\n"
             f"<b>Первые 8 дней:</b>\n{preview_text}\n\n"
             f"Используй 'Мой график' чтобы посмотреть все смены",
             parse_mode='HTML',
@@ -243,9 +2778,10 @@ async def auto_schedule_receive_shift(update: Update, context: ContextTypes.DEFA
 async def add_shift_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало добавления смены"""
     await update.message.reply_text(
-        "📅 Введи дату в формате ДД.ММ.ГГГГ\n"
+        "📅 Выбери дату в календаре или введи в формате ДД.ММ.ГГГГ\n"
         "Например: 18.01.2026\n\n"
-        "Или напиши 'отмена' для выхода"
+        "Или напиши 'отмена' для выхода",
+        reply_markup=calendar_markup(update.effective_user.id)
     )
     return CHOOSING_DATE
 
@@ -259,32 +2795,42 @@ async def receive_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Проверяем формат даты
-        date_obj = datetime.strptime(text, '%d.%m.%Y')
-        context.user_data['selected_date'] = text
-        
-        # Кнопки для выбора типа смены
-        keyboard = [
-            [KeyboardButton("☕ Дневная смена")],
-            [KeyboardButton("🌙 Ночная смена")],
-            [KeyboardButton("😴 Отсыпной")],
-            [KeyboardButton("🎉 Выходной")],
-            [KeyboardButton("❌ Отмена")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        await update.message.reply_text(
-            f"✅ Дата: {text}\n\n"
-            "Теперь выбери тип смены:",
-            reply_markup=reply_markup
-        )
-        return CHOOSING_SHIFT
-        
+        datetime.strptime(text, '%d.%m.%Y')
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат даты!\n"
             "Используй формат: ДД.ММ.ГГГГ (например, 18.01.2026)"
         )
         return CHOOSING_DATE
+    return await ask_shift_type(update, context, text)
+
+async def receive_date_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Дата для добавления смены из календаря"""
+    text = await calendar_choice(update)
+    if text is None:
+        return CHOOSING_DATE
+    return await ask_shift_type(update, context, text)
+
+async def ask_shift_type(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    """Дата выбрана - спрашиваем тип смены"""
+    context.user_data['selected_date'] = text
+    
+    # Кнопки для выбора типа смены
+    keyboard = [
+        [KeyboardButton("☕ Дневная смена")],
+        [KeyboardButton("🌙 Ночная смена")],
+        [KeyboardButton("😴 Отсыпной")],
+        [KeyboardButton("🎉 Выходной")],
+        [KeyboardButton("❌ Отмена")]
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await update.effective_message.reply_text(
+        f"✅ Дата: {text}\n\n"
+        "Теперь выбери тип смены:",
+        reply_markup=reply_markup
+    )
+    return CHOOSING_SHIFT
 
 async def receive_shift_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение типа смены от пользователя"""
@@ -300,191 +2846,1563 @@ async def receive_shift_type(update: Update, context: ContextTypes.DEFAULT_TYPE)
             [KeyboardButton("🗑 Очистить весь график")],
             [KeyboardButton("ℹ️ Помощь")]
         ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text("❌ Добавление смены отменено", reply_markup=reply_markup)
-        return ConversationHandler.END
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        await update.message.reply_text("❌ Добавление смены отменено", reply_markup=reply_markup)
+        return ConversationHandler.END
+    
+    # Определяем тип смены
+    shift_type = None
+    if "☕" in text or "дневная" in text.lower():
+        shift_type = 'day'
+    elif "🌙" in text or "ночная" in text.lower():
+        shift_type = 'night'
+    elif "😴" in text or "отсыпной" in text.lower():
+        shift_type = 'rest'
+    elif "🎉" in text or "выходной" in text.lower():
+        shift_type = 'dayoff'
+    
+    if shift_type:
+        date_str = context.user_data['selected_date']
+        user_id = str(update.effective_user.id)
+        
+        # Добавляем смену
+        get_storage().set_shift(user_id, parse_date(date_str), shift_type)
+        
+        shift_info = SHIFT_TYPES[shift_type]
+        
+        # Возвращаем основную клавиатуру
+        keyboard = [
+            [KeyboardButton("📅 Добавить смену")],
+            [KeyboardButton("🤖 Автозаполнение графика")],
+            [KeyboardButton("📋 Мой график")],
+            [KeyboardButton("🗑 Удалить смену")],
+            [KeyboardButton("🗑 Очистить весь график")],
+            [KeyboardButton("ℹ️ Помощь")]
+        ]
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        
+        await update.message.reply_text(
+            f"✅ Смена добавлена!\n\n"
+            f"📅 Дата: {date_str}\n"
+            f"{shift_info['emoji']} Тип: {shift_info['name']}",
+            reply_markup=reply_markup
+        )
+        return ConversationHandler.END
+    else:
+        await update.message.reply_text("❌ Неверный выбор! Выбери тип смены из кнопок.")
+        return CHOOSING_SHIFT
+
+def build_schedule_message(storage, user_id, today):
+    """Текст "Мой график": ближайшие 30 смен начиная с today, None если смен впереди нет"""
+    upcoming = list(islice(storage.iter_shifts(user_id, today), 30))
+    if not upcoming:
+        return None
+    
+    tomorrow = today + timedelta(days=1)
+    lines = ["📋 <b>Твой график смен (ближайшие 30 дней):</b>", ""]
+    for day, shift_type in upcoming:
+        line = shift_line(day, shift_type)
+        # Отмечаем сегодня и завтра
+        if day == today:
+            line += " 👈 СЕГОДНЯ"
+        elif day == tomorrow:
+            line += " 👉 ЗАВТРА"
+        lines.append(line)
+    
+    lines.append("")
+    rules = storage.get_rules(user_id)
+    if rules:
+        lines.append(f"🔁 График по циклу с {format_date(rules[-1].anchor)}")
+        lines.append(f"✏️ Ручных смен: {storage.count_shifts(user_id)}")
+    else:
+        lines.append(f"📊 Всего смен в графике: {storage.count_shifts(user_id)}")
+    return "\n".join(lines)
+
+def parse_shift_type(value):
+    """Тип смены по коду (day), названию ("Ночная смена") или эмодзи
+
+    Пустая строка или '-' - смены нет (''), None - не удалось распознать.
+    """
+    value = value.strip()
+    if value in ('', '-'):
+        return ''
+    if value in SHIFT_TYPES:
+        return value
+    lowered = value.lower()
+    for shift_type, shift_info in SHIFT_TYPES.items():
+        if shift_info['emoji'] in value or shift_info['name'].lower().split()[0] in lowered:
+            return shift_type
+    return None
+
+def parse_import_date(value):
+    """Дата из ДД.ММ.ГГГГ, ГГГГ-ММ-ДД или ГГГГММДД (формат iCalendar)"""
+    value = value.strip()
+    if '.' in value:
+        return datetime.strptime(value, '%d.%m.%Y').date()
+    if '-' in value:
+        return date.fromisoformat(value)
+    return datetime.strptime(value[:8], '%Y%m%d').date()
+
+def parse_csv_import(text):
+    """Строки "дата,смена" (разделитель , ; или табуляция), первая строка может быть заголовком
+
+    Пустая смена или '-' означает, что в этот день смены нет.
+    Возвращает ({date: тип смены или None}, [ошибки]).
+    """
+    lines = text.splitlines()
+    try:
+        dialect = csv.Sniffer().sniff(lines[0] if lines else '', delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    shifts, errors = {}, []
+    for number, row in enumerate(csv.reader(lines, dialect), 1):
+        if not row or not ''.join(row).strip():
+            continue
+        if number == 1 and row[0].strip().lower() in ('date', 'дата'):
+            continue
+        try:
+            day = parse_import_date(row[0])
+        except ValueError:
+            errors.append(f"строка {number}: неверная дата «{row[0].strip()}»")
+            continue
+        shift_type = parse_shift_type(row[1] if len(row) > 1 else '')
+        if shift_type is None:
+            errors.append(f"строка {number}: неизвестная смена «{row[1].strip()}»")
+            continue
+        shifts[day] = shift_type or None
+    return shifts, errors
+
+def parse_ics_import(text):
+    """События VEVENT: дата из DTSTART, смена из CATEGORIES или SUMMARY
+
+    Возвращает ({date: тип смены}, [ошибки]).
+    """
+    # Развёртка продолженных строк (RFC 5545: перенос + пробел)
+    text = text.replace('\r\n', '\n').replace('\n ', '').replace('\n\t', '')
+    shifts, errors = {}, []
+    event = None
+    for number, line in enumerate(text.split('\n'), 1):
+        name, _, value = line.partition(':')
+        name = name.split(';')[0].upper()
+        if name == 'BEGIN' and value.strip().upper() == 'VEVENT':
+            event = {'line': number}
+        elif name == 'END' and value.strip().upper() == 'VEVENT' and event is not None:
+            try:
+                day = parse_import_date(event.get('DTSTART', ''))
+            except ValueError:
+                errors.append(f"событие в строке {event['line']}: нет даты DTSTART")
+                event = None
+                continue
+            shift_type = parse_shift_type(event.get('CATEGORIES', '')) or parse_shift_type(event.get('SUMMARY', ''))
+            if not shift_type:
+                errors.append(f"событие в строке {event['line']}: неизвестная смена «{event.get('SUMMARY', '')}»")
+            else:
+                shifts[day] = shift_type
+            event = None
+        elif event is not None and name in ('DTSTART', 'SUMMARY', 'CATEGORIES'):
+            event[name] = value.replace('\\,', ',').replace('\\;', ';')
+    return shifts, errors
+
+def parse_import(text):
+    """Разбор CSV или ICS (определяется по содержимому)"""
+    if 'BEGIN:VCALENDAR' in text[:1000].upper():
+        return parse_ics_import(text)
+    return parse_csv_import(text)
+
+def parse_autofill_roster(text):
+    """Строки "id,дата начала,смена[,цикл]" для автозаполнения графиков команды
+
+    Цикл - смены через пробел (по умолчанию SHIFT_CYCLE), начальная смена должна в него
+    входить. Первая строка может быть заголовком. Возвращает ({user_id: ShiftRule}, [ошибки]).
+    """
+    lines = text.splitlines()
+    try:
+        dialect = csv.Sniffer().sniff(lines[0] if lines else '', delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    rules, errors = {}, []
+    for number, row in enumerate(csv.reader(lines, dialect), 1):
+        if not row or not ''.join(row).strip():
+            continue
+        user_id = row[0].strip()
+        if not user_id.isdigit():
+            if number != 1:
+                errors.append(f"строка {number}: неверный id «{user_id}»")
+            continue
+        if user_id in rules:
+            errors.append(f"строка {number}: id {user_id} уже был выше")
+            continue
+        try:
+            anchor = parse_import_date(row[1])
+        except (IndexError, ValueError):
+            errors.append(f"строка {number}: неверная дата «{row[1].strip() if len(row) > 1 else ''}»")
+            continue
+        start = parse_shift_type(row[2]) if len(row) > 2 else ''
+        if not start:
+            errors.append(f"строка {number}: неизвестная смена «{row[2].strip() if len(row) > 2 else ''}»")
+            continue
+        cycle = tuple(SHIFT_CYCLE)
+        if len(row) > 3 and row[3].strip():
+            cycle = tuple(parse_shift_type(value) for value in row[3].split())
+            if not all(cycle):
+                errors.append(f"строка {number}: неизвестная смена в цикле «{row[3].strip()}»")
+                continue
+        if start not in cycle:
+            errors.append(f"строка {number}: смены «{row[2].strip()}» нет в цикле")
+            continue
+        rules[user_id] = ShiftRule(anchor, start, cycle)
+    return rules, errors
+
+def export_range(storage, user_id, today, years):
+    """Период выгрузки: от первой записи графика до today + years лет"""
+    starts = [rule.anchor for rule in storage.get_rules(user_id)[:1]]
+    for day, _ in storage.iter_overrides(user_id, date.min, date.max):
+        starts.append(day)
+        break
+    start = min(starts, default=today)
+    return start, today + timedelta(days=365 * years)
+
+def iter_csv_export(storage, user_id, start_date, end_date):
+    """CSV построчно: график не собирается в памяти целиком"""
+    yield "date,shift,name\r\n"
+    for day, shift_type in storage.iter_shifts(user_id, start_date, end_date):
+        yield f"{day.isoformat()},{shift_type},{SHIFT_TYPES[shift_type]['name']}\r\n"
+
+def iter_ics_export(storage, user_id, start_date, end_date):
+    """iCalendar построчно: одно событие на весь день для каждой смены"""
+    stamp = datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//shift-bot//RU\r\nCALSCALE:GREGORIAN\r\n"
+    for day, shift_type in storage.iter_shifts(user_id, start_date, end_date):
+        shift_info = SHIFT_TYPES[shift_type]
+        yield (
+            "BEGIN:VEVENT\r\n"
+            f"UID:{user_id}-{day:%Y%m%d}@shift-bot\r\n"
+            f"DTSTAMP:{stamp}\r\n"
+            f"DTSTART;VALUE=DATE:{day:%Y%m%d}\r\n"
+            f"DTEND;VALUE=DATE:{day + timedelta(days=1):%Y%m%d}\r\n"
+            f"SUMMARY:{shift_info['emoji']} {shift_info['name']}\r\n"
+            f"CATEGORIES:{shift_type}\r\n"
+            "END:VEVENT\r\n"
+        )
+    yield "END:VCALENDAR\r\n"
+
+def write_export(chunks, file):
+    """Запись выгрузки во временный файл по частям"""
+    for chunk in chunks:
+        file.write(chunk.encode('utf-8'))
+    file.seek(0)
+    return file
+
+NO_SCHEDULE_TEXT = (
+    "📋 У тебя пока нет запланированных смен.\n\nИспользуй:\n"
+    "🤖 'Автозаполнение графика' - для автоматического заполнения\n"
+    "📅 'Добавить смену' - для ручного добавления"
+)
+NO_UPCOMING_TEXT = "📋 У тебя нет будущих смен в графике."
+
+def render_schedule_reply(storage, user_id, today):
+    """Полный ответ на "Мой график" (HTML), в том числе когда смен нет"""
+    if not storage.has_schedule(user_id):
+        return NO_SCHEDULE_TEXT
+    message = build_schedule_message(storage, user_id, today)
+    return NO_UPCOMING_TEXT if message is None else message
+
+class ScheduleRenderCache:
+    """LRU-кэш ответа "Мой график" по пользователям
+
+    Запись действительна, пока не изменились версия графика и текущая дата. Изменение
+    графика сразу удаляет запись пользователя (слушатель хранилища).
+    """
+
+    def __init__(self, storage, maxsize=RENDER_CACHE_SIZE):
+        self.storage = storage
+        self.maxsize = maxsize
+        # user_id -> (версия графика, дата, текст)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, today):
+        version = self.storage.get_version(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[0] == version and entry[1] == today:
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        text = render_schedule_reply(self.storage, user_id, today)
+        self.entries[user_id] = (version, today, text)
+        self.entries.move_to_end(user_id)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return text
+
+    def invalidate(self, user_id):
+        self.entries.pop(str(user_id), None)
+
+_render_cache = None
+
+def get_render_cache():
+    """Кэш "Мой график" поверх хранилища графиков"""
+    global _render_cache
+    if _render_cache is None:
+        storage = get_storage()
+        _render_cache = ScheduleRenderCache(storage)
+        storage.listeners.append(_render_cache.invalidate)
+    return _render_cache
+
+async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать график смен"""
+    user_id = str(update.effective_user.id)
+    # Повторный просмотр без изменений графика - поиск в словаре
+    message = get_render_cache().get(user_id, date.today())
+    await update.message.reply_text(message, parse_mode='HTML')
+
+# Данные кнопок календаря: cal:m:ГГГГ-ММ - другой месяц, cal:d:ГГГГ-ММ-ДД - день, cal:- - ничего
+CALENDAR_NOOP = 'cal:-'
+
+def build_calendar_markup(storage, user_id, year, month, today):
+    """Клавиатура месяца: день и эмодзи смены в каждой клетке, листание по краям заголовка"""
+    first = date(year, month, 1)
+    last = date(year, month, monthrange(year, month)[1])
+    shifts = dict(storage.get_range(user_id, first, last))
+    # На краях календаря (date.min, date.max) листать дальше некуда
+    previous_button = next_button = InlineKeyboardButton(" ", callback_data=CALENDAR_NOOP)
+    if first > date.min:
+        previous_month = first - timedelta(days=1)
+        previous_button = InlineKeyboardButton("◀️", callback_data=f"cal:m:{previous_month:%Y-%m}")
+    if last < date.max:
+        next_month = last + timedelta(days=1)
+        next_button = InlineKeyboardButton("▶️", callback_data=f"cal:m:{next_month:%Y-%m}")
+    rows = [
+        [
+            previous_button,
+            InlineKeyboardButton(f"{MONTHS_RU[month - 1]} {year}", callback_data=CALENDAR_NOOP),
+            next_button,
+        ],
+        [InlineKeyboardButton(name, callback_data=CALENDAR_NOOP) for name in WEEKDAYS_RU],
+    ]
+    week = [InlineKeyboardButton(" ", callback_data=CALENDAR_NOOP)] * first.weekday()
+    for number in range(1, last.day + 1):
+        day = first.replace(day=number)
+        label = str(number)
+        if day in shifts:
+            label += SHIFT_TYPES[shifts[day]]['emoji']
+        if day == today:
+            label = f"·{label}·"
+        week.append(InlineKeyboardButton(label, callback_data=f"cal:d:{day.isoformat()}"))
+        if len(week) == 7:
+            rows.append(week)
+            week = []
+    if week:
+        rows.append(week + [InlineKeyboardButton(" ", callback_data=CALENDAR_NOOP)] * (7 - len(week)))
+    return InlineKeyboardMarkup(rows)
+
+class CalendarKeyboardCache:
+    """LRU-кэш клавиатур календаря по (пользователь, месяц)
+
+    Запись действительна, пока не изменились версия графика и текущая дата, поэтому
+    листание туда-обратно и повторное открытие календаря не пересчитывают месяц.
+    """
+
+    def __init__(self, storage, maxsize=CALENDAR_CACHE_SIZE):
+        self.storage = storage
+        self.maxsize = maxsize
+        # (user_id, год, месяц) -> (версия графика, дата, клавиатура)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, year, month, today):
+        key = (user_id, year, month)
+        version = self.storage.get_version(user_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version and entry[1] == today:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        markup = build_calendar_markup(self.storage, user_id, year, month, today)
+        self.entries[key] = (version, today, markup)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return markup
+
+_calendar_cache = None
+
+def get_calendar_cache():
+    """Кэш клавиатур календаря поверх хранилища графиков"""
+    global _calendar_cache
+    if _calendar_cache is None:
+        _calendar_cache = CalendarKeyboardCache(get_storage())
+    return _calendar_cache
+
+def calendar_markup(user_id, year=None, month=None):
+    """Календарь пользователя на месяц (по умолчанию текущий)"""
+    today = date.today()
+    return get_calendar_cache().get(str(user_id), year or today.year, month or today.month, today)
+
+async def calendar_choice(update: Update):
+    """Нажатие в календаре: листание месяца - на месте, выбор дня - дата ДД.ММ.ГГГГ
+
+    Возвращает None, если день не выбран (листание или пустая клетка).
+    """
+    query = update.callback_query
+    _, action, value = (query.data.split(':', 2) + ['', ''])[:3]
+    try:
+        # Данные кнопки приходят от клиента: старый или подделанный календарь
+        # не должен ронять обработчик
+        if action == 'm':
+            year, month = map(int, value.split('-'))
+            date(year, month, 1)
+        elif action == 'd':
+            day = date.fromisoformat(value)
+    except (ValueError, OverflowError):
+        await query.answer("⌛ Кнопка устарела, открой календарь заново")
+        return None
+    await query.answer()
+    if action == 'm':
+        # Тот же message_id: Telegram перерисует клавиатуру без нового сообщения
+        await query.edit_message_reply_markup(calendar_markup(update.effective_user.id, year, month))
+        return None
+    if action != 'd':
+        return None
+    text = format_date(day)
+    # Убираем календарь из сообщения, чтобы по нему не нажали ещё раз
+    await query.edit_message_reply_markup(None)
+    return text
+
+async def calendar_expired(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие в календаре вне диалога (диалог уже закончен или отменён)"""
+    await update.callback_query.answer("Этот календарь уже не активен")
+    await update.callback_query.edit_message_reply_markup(None)
+
+async def delete_shift_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало удаления смены"""
+    user_id = str(update.effective_user.id)
+    
+    if not get_storage().has_schedule(user_id):
+        await update.message.reply_text("📋 У тебя нет запланированных смен для удаления")
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "🗑 Выбери смену для удаления в календаре или введи дату в формате ДД.ММ.ГГГГ\n"
+        "Например: 18.01.2026\n\n"
+        "Или напиши 'отмена' для выхода",
+        reply_markup=calendar_markup(user_id)
+    )
+    return CHOOSING_DATE
+
+async def delete_shift_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подтверждение удаления смены"""
+    text = update.message.text.strip()
+    
+    if text.lower() == 'отмена':
+        await update.message.reply_text("❌ Удаление отменено")
+        return ConversationHandler.END
+    
+    try:
+        # Проверяем формат даты
+        parse_date(text)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Неверный формат даты!\n"
+            "Используй формат: ДД.ММ.ГГГГ (например, 18.01.2026)"
+        )
+        return CHOOSING_DATE
+    return await delete_shift_on(update, text)
+
+async def delete_shift_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Дата удаления смены из календаря"""
+    text = await calendar_choice(update)
+    if text is None:
+        return CHOOSING_DATE
+    return await delete_shift_on(update, text)
+
+async def delete_shift_on(update: Update, text):
+    """Удаление смены на выбранную дату"""
+    user_id = str(update.effective_user.id)
+    
+    if get_storage().delete_shift(user_id, parse_date(text)):
+        await update.effective_message.reply_text(f"✅ Смена на {text} удалена!")
+    else:
+        await update.effective_message.reply_text(f"❌ Смена на {text} не найдена в графике")
+    
+    return ConversationHandler.END
+
+async def clear_all_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Очистить весь график"""
+    user_id = str(update.effective_user.id)
+    rules_count, shifts_count = get_storage().clear_user(user_id)
+    
+    if rules_count or shifts_count:
+        text = "✅ Весь график очищен!"
+        if rules_count:
+            text += f"\n🔁 Удалено автографиков: {rules_count}"
+        text += f"\n📅 Удалено ручных смен: {shifts_count}"
+        await update.message.reply_text(text)
+    else:
+        await update.message.reply_text("📋 У тебя нет смен для удаления")
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало импорта графика из CSV или ICS"""
+    await update.message.reply_text(
+        "📥 <b>Импорт графика</b>\n\n"
+        "Пришли файл .csv или .ics или вставь строки текстом:\n"
+        "<code>01.11.2026,day\n02.11.2026,Ночная смена\n03.11.2026,-</code>\n\n"
+        "Смена: day, night, rest, dayoff или название; '-' - смены нет.\n"
+        "Или напиши 'отмена' для выхода",
+        parse_mode='HTML'
+    )
+    return CHOOSING_IMPORT
+
+async def read_uploaded_text(message):
+    """Текст присланного файла или сообщения; None, если файл больше MAX_IMPORT_BYTES"""
+    if message.document is None:
+        return message.text or ''
+    if message.document.file_size and message.document.file_size > MAX_IMPORT_BYTES:
+        await message.reply_text(f"❌ Файл слишком большой (до {MAX_IMPORT_BYTES // 1000} КБ)")
+        return None
+    telegram_file = await message.document.get_file()
+    return bytes(await telegram_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+
+async def receive_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Разбор присланного файла или текста и запись всех смен одной операцией"""
+    message = update.message
+    text = await read_uploaded_text(message)
+    if text is None:
+        return CHOOSING_IMPORT
+    if message.document is None and text.strip().lower() == 'отмена':
+        await message.reply_text("❌ Импорт отменён")
+        return ConversationHandler.END
+    if not await take_throttle_token(update, 'write'):
+        return CHOOSING_IMPORT
+
+    shifts, errors = parse_import(text)
+    if errors:
+        shown = "\n".join(errors[:10])
+        more = f"\n…и ещё {len(errors) - 10}" if len(errors) > 10 else ""
+        await message.reply_text(f"❌ Ничего не импортировано, исправь ошибки:\n{shown}{more}")
+        return CHOOSING_IMPORT
+    if not shifts:
+        await message.reply_text("❌ Не нашёл ни одной смены. Пришли CSV или ICS ещё раз")
+        return CHOOSING_IMPORT
+    if len(shifts) > MAX_IMPORT_ROWS:
+        await message.reply_text(f"❌ Слишком много строк: {len(shifts)} (можно до {MAX_IMPORT_ROWS})")
+        return CHOOSING_IMPORT
+
+    # Все смены записываются одной операцией хранилища
+    get_storage().set_shifts(str(update.effective_user.id), shifts)
+    await message.reply_text(
+        f"✅ Импортировано дней: {len(shifts)}\n"
+        f"📅 С {format_date(min(shifts))} по {format_date(max(shifts))}"
+    )
+    return ConversationHandler.END
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [ics|csv] [лет вперёд] - выгрузка графика файлом"""
+    args = [arg.lower() for arg in context.args]
+    file_format = 'csv' if 'csv' in args else 'ics'
+    years = next((int(arg) for arg in args if arg.isdigit()), 1)
+    if not 1 <= years <= MAX_EXPORT_YEARS:
+        await update.message.reply_text(f"❌ Можно выгрузить от 1 до {MAX_EXPORT_YEARS} лет вперёд")
+        return
+
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    if not storage.has_schedule(user_id):
+        await update.message.reply_text("📋 У тебя пока нет смен для выгрузки")
+        return
+
+    start_date, end_date = export_range(storage, user_id, date.today(), years)
+    chunks = (iter_csv_export if file_format == 'csv' else iter_ics_export)(storage, user_id, start_date, end_date)
+    with tempfile.TemporaryFile() as file:
+        write_export(chunks, file)
+        await update.message.reply_document(
+            document=file,
+            filename=f"shifts.{file_format}",
+            caption=f"📤 График с {format_date(start_date)} по {format_date(end_date)}"
+        )
+
+class TokenBucket:
+    """Общий ограничитель скорости отправки (token bucket)"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = None
+        # До этого момента отправка приостановлена (ответ RetryAfter от Telegram)
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться разрешения на отправку одного сообщения"""
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Остановить отправку для всех на seconds секунд"""
+        loop = asyncio.get_running_loop()
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+        self.tokens = 0
+
+@dataclass
+class DeliveryStats:
+    """Итоги одной рассылки"""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0
+    retried: int = 0
+    duration: float = 0.0
+
+    def __str__(self):
+        return (
+            f"всего {self.total}, отправлено {self.sent}, ошибок {self.failed}, "
+            f"RetryAfter {self.throttled}, повторов {self.retried}, за {self.duration:.1f} с"
+        )
+
+async def deliver_messages(bot, messages, concurrency=REMINDER_CONCURRENCY,
+                           rate=REMINDER_RATE_LIMIT, max_attempts=REMINDER_MAX_ATTEMPTS, on_result=None):
+    """Параллельная рассылка [(chat_id, text)] с общим лимитом скорости
+
+    bot - любой объект с async send_message(chat_id=..., text=...), например context.bot.
+    on_result(номер сообщения, отправлено ли) вызывается, когда судьба сообщения решена.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    stats = DeliveryStats(total=len(messages))
+    bucket = TokenBucket(rate)
+    queue = asyncio.Queue()
+    for number, (chat_id, text) in enumerate(messages):
+        queue.put_nowait((number, chat_id, text, 1))
+
+    async def requeue(item, delay):
+        # task_done исходного сообщения только после возврата в очередь, чтобы join() не завершился раньше
+        await asyncio.sleep(delay)
+        queue.put_nowait(item)
+        queue.task_done()
+
+    def finish(number, sent):
+        if on_result is not None:
+            on_result(number, sent)
+
+    async def worker():
+        while True:
+            number, chat_id, text, attempt = await queue.get()
+            await bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                stats.sent += 1
+                finish(number, True)
+            except RetryAfter as e:
+                # Flood control касается всего бота: тормозим всех и повторяем сообщение
+                stats.throttled += 1
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                bucket.pause(retry_after)
+                queue.put_nowait((number, chat_id, text, attempt))
+            except (TimedOut, NetworkError) as e:
+                if attempt >= max_attempts:
+                    stats.failed += 1
+                    finish(number, False)
+                    logger.error(f"Не удалось отправить сообщение {chat_id} за {attempt} попыток: {e}")
+                else:
+                    stats.retried += 1
+                    loop.create_task(requeue((number, chat_id, text, attempt + 1), 2 ** attempt))
+                    continue
+            except Exception as e:
+                # Бот заблокирован, чат не найден и т.п. - повтор не поможет
+                stats.failed += 1
+                finish(number, False)
+                logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
+            queue.task_done()
+
+    workers = [loop.create_task(worker()) for _ in range(max(1, min(concurrency, len(messages))))]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    stats.duration = loop.time() - started
+    return stats
+
+def parse_hhmm(text):
+    """Разбор времени ЧЧ:ММ в объект time"""
+    return datetime.strptime(text, '%H:%M').time()
+
+def reminder_variants(settings):
+    """Напоминания пользователя по его настройкам
+
+    ('daily', time) - каждый день в это время о завтрашней смене,
+    ('before', часы, типы смен) - за столько часов до начала смены.
+    """
+    variants = []
+    daily = settings.get('daily', DEFAULT_REMINDER_TIME)
+    if daily:
+        variants.append(('daily', parse_hhmm(daily)))
+    for before in settings.get('before', []):
+        variants.append(('before', before['hours'], tuple(before['shifts'])))
+    return variants
+
+def next_reminder_time(storage, user_id, variant, tz, after):
+    """Ближайшее время срабатывания напоминания строго после after (UTC)"""
+    local_now = after.astimezone(tz)
+    if variant[0] == 'daily':
+        for days in range(3):
+            day = local_now.date() + timedelta(days=days)
+            fire_at = tz.localize(datetime.combine(day, variant[1])).astimezone(pytz.utc)
+            if fire_at > after:
+                return fire_at
+        return None
+
+    _, hours, shift_types = variant
+    offset = timedelta(hours=hours)
+    start_day = (local_now + offset).date() - timedelta(days=1)
+    end_day = start_day + timedelta(days=REMINDER_HORIZON_DAYS)
+    for day, shift_type in storage.iter_shifts(user_id, start_day, end_day):
+        if shift_type not in shift_types:
+            continue
+        shift_start = datetime.combine(day, parse_hhmm(SHIFT_TYPES[shift_type]['start']))
+        fire_at = tz.localize(shift_start).astimezone(pytz.utc) - offset
+        if fire_at > after:
+            return fire_at
+    # Подходящих смен впереди нет: проверим снова, когда горизонт сдвинется
+    return after + timedelta(days=REMINDER_HORIZON_DAYS // 2)
+
+# Рассчитанное напоминание: вид ('daily' или 'beforeN'), дата и тип смены, время отправки (UTC)
+ReminderEntry = namedtuple('ReminderEntry', ['user_id', 'kind', 'day', 'shift_type', 'fire_at', 'text'])
+
+def daily_reminder_text(shift_type):
+    shift_info = SHIFT_TYPES[shift_type]
+    return f"{shift_info['emoji']} Завтра {shift_info['name'].lower()}!"
+
+def reminder_entry(storage, user_id, variant, tz, fire_at):
+    """Напоминание (ReminderEntry) в момент fire_at или None, если напоминать не о чем"""
+    local_fire = fire_at.astimezone(tz)
+    if variant[0] == 'daily':
+        day = local_fire.date() + timedelta(days=1)
+        shift_type = storage.get_shift(user_id, day)
+        if not shift_type:
+            return None
+        return ReminderEntry(user_id, 'daily', day, shift_type, fire_at, daily_reminder_text(shift_type))
+
+    _, hours, shift_types = variant
+    shift_start = local_fire + timedelta(hours=hours)
+    shift_type = storage.get_shift(user_id, shift_start.date())
+    if shift_type not in shift_types or SHIFT_TYPES[shift_type]['start'] != shift_start.strftime('%H:%M'):
+        # График изменился после планирования
+        return None
+    shift_info = SHIFT_TYPES[shift_type]
+    return ReminderEntry(user_id, f'before{hours}', shift_start.date(), shift_type, fire_at, (
+        f"{shift_info['emoji']} Через {hours} ч. {shift_info['name'].lower()}: "
+        f"{format_date(shift_start.date())} в {shift_info['start']}"
+    ))
+
+class ReminderOutbox:
+    """Очередь напоминаний в SQLite: одна строка на (пользователь, вид напоминания, дата смены)
+
+    Планировщик заранее складывает сюда рассчитанные напоминания, а рассылка только
+    забирает созревшие строки в статусе pending и отмечает каждую отправленную. Повторный
+    расчёт той же строки не трогает уже отправленные, поэтому перезапуск посреди
+    рассылки не шлёт сообщение второй раз (кроме того единственного, что было в пути).
+    Статусы: pending, sent, failed, cancelled (смену убрали), expired (опоздали дольше окна).
+    """
+
+    def __init__(self, path=REMINDER_OUTBOX):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                day TEXT NOT NULL,
+                shift_type TEXT NOT NULL,
+                fire_at INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                sent_at INTEGER,
+                PRIMARY KEY (user_id, kind, day)
+            );
+            CREATE INDEX IF NOT EXISTS outbox_status_fire_at ON outbox (status, fire_at);
+            """
+        )
+        # Строки, которые сейчас отправляются: следующий запуск рассылки их не берёт
+        self.in_flight = set()
+
+    def add(self, entries):
+        """Записать рассчитанные напоминания; отправленные и просроченные не меняются"""
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO outbox (user_id, kind, day, shift_type, fire_at, text)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, kind, day) DO UPDATE SET
+                    shift_type = excluded.shift_type, fire_at = excluded.fire_at,
+                    text = excluded.text, status = 'pending'
+                WHERE status IN ('pending', 'cancelled')
+                """,
+                [
+                    (int(e.user_id), e.kind, e.day.isoformat(), e.shift_type, int(e.fire_at.timestamp()), e.text)
+                    for e in entries
+                ]
+            )
+
+    def take_due(self, now, grace):
+        """Созревшие pending-строки (ReminderEntry); опоздавшие дольше grace помечаются expired"""
+        with self.conn:
+            expired = self.conn.execute(
+                "UPDATE outbox SET status = 'expired' WHERE status = 'pending' AND fire_at < ?",
+                (int((now - grace).timestamp()),)
+            ).rowcount
+        if expired:
+            logger.warning(f"Напоминания опоздали больше чем на {grace}, не отправляем: {expired}")
+        rows = self.conn.execute(
+            """
+            SELECT user_id, kind, day, shift_type, fire_at, text FROM outbox
+            WHERE status = 'pending' AND fire_at <= ? ORDER BY fire_at
+            """,
+            (int(now.timestamp()),)
+        )
+        entries = []
+        for user_id, kind, day, shift_type, fire_at, text in rows:
+            entry = ReminderEntry(
+                str(user_id), kind, date.fromisoformat(day), shift_type,
+                datetime.fromtimestamp(fire_at, pytz.utc), text
+            )
+            if entry[:3] not in self.in_flight:
+                self.in_flight.add(entry[:3])
+                entries.append(entry)
+        return entries
+
+    def mark(self, entries, status):
+        """Итог отправки строк: sent, failed или cancelled"""
+        sent_at = int(datetime.now(pytz.utc).timestamp())
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET status = ?, sent_at = ? WHERE user_id = ? AND kind = ? AND day = ?",
+                [(status, sent_at, int(e.user_id), e.kind, e.day.isoformat()) for e in entries]
+            )
+        for entry in entries:
+            self.in_flight.discard(entry[:3])
+
+    def counts(self):
+        """Число строк по статусам"""
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status'))
+
+    def purge(self, before):
+        """Удалить завершённые строки со временем отправки раньше before"""
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM outbox WHERE status != 'pending' AND fire_at < ?", (int(before.timestamp()),)
+            ).rowcount
+
+    def close(self):
+        self.conn.close()
+
+class ReminderScheduler:
+    """Планировщик напоминаний: корзины по минутам UTC и min-heap ближайших минут
+
+    Каждую минуту забираются только созревшие корзины, поэтому накладные расходы не
+    зависят от числа пользователей и их напоминаний. Пользователи без своих настроек
+    не планируются по одному: для них есть общая запись DEFAULT_REMINDER_KEY.
+
+    С очередью (outbox) корзины забираются заранее, на REMINDER_LOOKAHEAD_HOURS вперёд.
+    Если график изменился после расчёта, напоминания пользователя пересчитываются.
+    """
+
+    def __init__(self, storage, outbox=None):
+        self.storage = storage
+        self.outbox = outbox
+        # Уже рассчитанные общие напоминания: минута UTC -> дата смены
+        self.default_planned = {}
+        # Минута UTC (целое число минут от эпохи) -> {(user_id, номер напоминания)}
+        self.buckets = {}
+        self.heap = []
+        self.planned = {}
+        self.user_keys = defaultdict(set)
+        # Пользователи со своими настройками: {user_id: (часовой пояс, напоминания)}
+        self.custom = {}
+        # До какого момента напоминания уже рассчитаны (последний pop_due)
+        self.last_run = None
+
+    def _add(self, key, fire_at):
+        self._remove(key)
+        if fire_at is None:
+            return
+        minute = int(fire_at.timestamp() // 60)
+        bucket = self.buckets.get(minute)
+        if bucket is None:
+            bucket = self.buckets[minute] = set()
+            heapq.heappush(self.heap, minute)
+        bucket.add(key)
+        self.planned[key] = minute
+        self.user_keys[key[0]].add(key)
+
+    def _remove(self, key):
+        minute = self.planned.pop(key, None)
+        if minute is not None:
+            self.buckets[minute].discard(key)
+            self.user_keys[key[0]].discard(key)
+
+    def _user_plan(self, user_id):
+        if user_id == DEFAULT_REMINDER_KEY[0]:
+            return pytz.timezone(DEFAULT_TIMEZONE), [('daily', parse_hhmm(DEFAULT_REMINDER_TIME))]
+        return self.custom[user_id]
+
+    def _schedule_key(self, key, after):
+        tz, variants = self._user_plan(key[0])
+        self._add(key, next_reminder_time(self.storage, key[0], variants[key[1]], tz, after))
+
+    def load(self, now):
+        """Планирование всех напоминаний при запуске"""
+        self._schedule_key(DEFAULT_REMINDER_KEY, now)
+        for user_id, settings in self.storage.iter_settings():
+            self.schedule_user(user_id, settings, now)
+
+    def reload(self):
+        """Перепланировать всё заново (другой процесс изменил неизвестно что)"""
+        self.buckets = {}
+        self.heap = []
+        self.planned = {}
+        self.user_keys = defaultdict(set)
+        self.custom = {}
+        self.default_planned = {}
+        # Уже рассчитанное пересчитается заново: очередь обновит только неотправленное
+        self.load(datetime.now(pytz.utc))
+
+    def schedule_user(self, user_id, settings, now):
+        """Перепланировать напоминания пользователя после изменения его настроек"""
+        for key in list(self.user_keys.get(user_id, ())):
+            self._remove(key)
+        if not settings:
+            self.custom.pop(user_id, None)
+            return
+        tz = pytz.timezone(settings.get('timezone', DEFAULT_TIMEZONE))
+        self.custom[user_id] = (tz, reminder_variants(settings))
+        for number in range(len(self.custom[user_id][1])):
+            self._schedule_key((user_id, number), now)
+
+    def on_schedule_changed(self, user_id):
+        """Напоминания зависят от графика: "до смены" перепланируем, рассчитанные заранее пересчитываем"""
+        now = datetime.now(pytz.utc)
+        if user_id in self.custom:
+            for number, variant in enumerate(self.custom[user_id][1]):
+                if variant[0] == 'before' or self.outbox is not None:
+                    self._schedule_key((user_id, number), now)
+            return
+        if self.outbox is None:
+            return
+        # Общее напоминание уже в очереди: обновляем строку только этого пользователя
+        now_minute = int(now.timestamp() // 60)
+        for minute, day in list(self.default_planned.items()):
+            if minute < now_minute:
+                del self.default_planned[minute]
+                continue
+            shift_type = self.storage.get_shift(user_id, day)
+            if shift_type:
+                fire_at = datetime.fromtimestamp(minute * 60, pytz.utc)
+                self.outbox.add([
+                    ReminderEntry(user_id, 'daily', day, shift_type, fire_at, daily_reminder_text(shift_type))
+                ])
+
+    def on_remote_change(self, user_ids):
+        """Изменения из других воркеров: перепланировать только изменённых пользователей"""
+        if user_ids is None:
+            self.reload()
+            return
+        now = datetime.now(pytz.utc)
+        for user_id in user_ids:
+            # Другой воркер мог поменять и настройки напоминаний, и график
+            self.schedule_user(user_id, self.storage.get_settings(user_id), now)
+            self.on_schedule_changed(user_id)
+
+    def pop_due(self, now):
+        """Забрать напоминания со временем до now и сразу запланировать следующие
+
+        Возвращает список ReminderEntry. now может быть в будущем - так напоминания
+        рассчитываются заранее для очереди.
+        """
+        self.last_run = now
+        now_minute = int(now.timestamp() // 60)
+        entries = []
+        while self.heap and self.heap[0] <= now_minute:
+            minute = heapq.heappop(self.heap)
+            fire_at = datetime.fromtimestamp(minute * 60, pytz.utc)
+            for key in self.buckets.pop(minute, ()):
+                del self.planned[key]
+                self.user_keys[key[0]].discard(key)
+                if key == DEFAULT_REMINDER_KEY:
+                    entries.extend(self._default_entries(fire_at))
+                else:
+                    tz, variants = self._user_plan(key[0])
+                    entry = reminder_entry(self.storage, key[0], variants[key[1]], tz, fire_at)
+                    if entry:
+                        entries.append(entry)
+                self._schedule_key(key, fire_at)
+        return entries
+
+    def _default_entries(self, fire_at):
+        """Общее напоминание для всех, кто не менял настройки: одна корзина индекса"""
+        tz = pytz.timezone(DEFAULT_TIMEZONE)
+        tomorrow = fire_at.astimezone(tz).date() + timedelta(days=1)
+        self.default_planned[int(fire_at.timestamp() // 60)] = tomorrow
+        return [
+            ReminderEntry(user_id, 'daily', tomorrow, shift_type, fire_at, daily_reminder_text(shift_type))
+            for user_id, shift_type in self.storage.users_on(tomorrow)
+            if user_id not in self.custom
+        ]
+
+_reminder_scheduler = None
+
+def get_reminder_scheduler():
+    """Планировщик напоминаний поверх хранилища графиков и очереди REMINDER_OUTBOX"""
+    global _reminder_scheduler
+    if _reminder_scheduler is None:
+        storage = get_storage()
+        _reminder_scheduler = ReminderScheduler(storage, ReminderOutbox(REMINDER_OUTBOX))
+        # Начинаем с начала окна догона: то, что пропустили за время простоя, рассчитается заново,
+        # а уже отправленное очередь не перезапишет
+        now = datetime.now(pytz.utc)
+        _reminder_scheduler.load(now - timedelta(minutes=REMINDER_GRACE_MINUTES))
+        storage.listeners.append(_reminder_scheduler.on_schedule_changed)
+        storage.remote_listeners.append(_reminder_scheduler.on_remote_change)
+        logger.info(f"Очередь напоминаний {REMINDER_OUTBOX}: {_reminder_scheduler.outbox.counts()}")
+    return _reminder_scheduler
+
+async def send_due_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Ежеминутно: рассчитать напоминания на REMINDER_LOOKAHEAD_HOURS вперёд и разослать созревшие из очереди"""
+    scheduler = get_reminder_scheduler()
+    storage = get_storage()
+    outbox = scheduler.outbox
+    # В кластере график меняют и другие воркеры: подхватываем их изменения (планировщик
+    # перепланирует только изменённых пользователей через remote_listeners)
+    storage.refresh()
+    now = datetime.now(pytz.utc)
+    planned = scheduler.pop_due(now + timedelta(hours=REMINDER_LOOKAHEAD_HOURS))
+    if planned:
+        outbox.add(planned)
+        logger.info(f"Напоминаний рассчитано в очередь: {len(planned)}")
+
+    entries = outbox.take_due(now, timedelta(minutes=REMINDER_GRACE_MINUTES))
+    # График мог измениться после расчёта: отправляем, только если смена та же
+    current, cancelled = [], []
+    for entry in entries:
+        (current if storage.get_shift(entry.user_id, entry.day) == entry.shift_type else cancelled).append(entry)
+    if cancelled:
+        outbox.mark(cancelled, 'cancelled')
+    entries = current
+    if not entries:
+        return
+
+    def on_result(number, sent):
+        # Отмечаем сразу: падение посреди рассылки не приведёт к повторной отправке
+        outbox.mark([entries[number]], 'sent' if sent else 'failed')
+
+    try:
+        stats = await deliver_messages(context.bot, [(int(e.user_id), e.text) for e in entries], on_result=on_result)
+    finally:
+        # Неотмеченные строки остаются pending и уйдут при следующем запуске
+        outbox.in_flight.difference_update(e[:3] for e in entries)
+    logger.info(f"Напоминания: {stats}")
+    if metrics is not None:
+        metrics.observe_delivery(stats)
+
+async def prune_storage_changes(context: ContextTypes.DEFAULT_TYPE):
+    """Удаление старых записей журнала изменений, по которому воркеры подхватывают чужие изменения"""
+    removed = get_storage().prune_changes()
+    if removed:
+        logger.info(f"Из журнала изменений хранилища удалено старых записей: {removed}")
+
+async def purge_reminder_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Удаление из очереди напоминаний, отправленных больше REMINDER_OUTBOX_KEEP_DAYS дней назад"""
+    removed = get_reminder_scheduler().outbox.purge(
+        datetime.now(pytz.utc) - timedelta(days=REMINDER_OUTBOX_KEEP_DAYS)
+    )
+    if removed:
+        logger.info(f"Из очереди напоминаний удалено старых строк: {removed}")
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /timezone - часовой пояс для напоминаний"""
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    settings = storage.get_settings(user_id)
     
-    # Определяем тип смены
-    shift_type = None
-    if "☕" in text or "дневная" in text.lower():
-        shift_type = 'day'
-    elif "🌙" in text or "ночная" in text.lower():
-        shift_type = 'night'
-    elif "😴" in text or "отсыпной" in text.lower():
-        shift_type = 'rest'
-    elif "🎉" in text or "выходной" in text.lower():
-        shift_type = 'dayoff'
+    if not context.args:
+        await update.message.reply_text(
+            f"🌍 Твой часовой пояс: {settings.get('timezone', DEFAULT_TIMEZONE)}\n\n"
+            "Чтобы изменить, напиши например: /timezone Europe/Moscow"
+        )
+        return
     
-    if shift_type:
-        date_str = context.user_data['selected_date']
-        user_id = str(update.effective_user.id)
-        
-        # Загружаем график
-        schedule = load_schedule()
-        if user_id not in schedule:
-            schedule[user_id] = {}
-        
-        # Добавляем смену
-        schedule[user_id][date_str] = shift_type
-        save_schedule(schedule)
-        
-        shift_info = SHIFT_TYPES[shift_type]
-        
-        # Возвращаем основную клавиатуру
-        keyboard = [
-            [KeyboardButton("📅 Добавить смену")],
-            [KeyboardButton("🤖 Автозаполнение графика")],
-            [KeyboardButton("📋 Мой график")],
-            [KeyboardButton("🗑 Удалить смену")],
-            [KeyboardButton("🗑 Очистить весь график")],
-            [KeyboardButton("ℹ️ Помощь")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
+    try:
+        tz = pytz.timezone(context.args[0])
+    except pytz.UnknownTimeZoneError:
         await update.message.reply_text(
-            f"✅ Смена добавлена!\n\n"
-            f"📅 Дата: {date_str}\n"
-            f"{shift_info['emoji']} Тип: {shift_info['name']}",
-            reply_markup=reply_markup
+            "❌ Неизвестный часовой пояс!\n"
+            "Используй название из базы tz, например: Europe/Kyiv, Europe/Moscow, Asia/Almaty"
         )
-        return ConversationHandler.END
-    else:
-        await update.message.reply_text("❌ Неверный выбор! Выбери тип смены из кнопок.")
-        return CHOOSING_SHIFT
+        return
+    
+    settings['timezone'] = tz.zone
+    storage.set_settings(user_id, settings)
+    get_reminder_scheduler().schedule_user(user_id, settings, datetime.now(pytz.utc))
+    await update.message.reply_text(f"✅ Часовой пояс: {tz.zone}")
 
-async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать график смен"""
+async def reminder_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /reminder - время ежедневного напоминания"""
     user_id = str(update.effective_user.id)
-    schedule = load_schedule()
+    storage = get_storage()
+    settings = storage.get_settings(user_id)
     
-    if user_id not in schedule or not schedule[user_id]:
-        await update.message.reply_text("📋 У тебя пока нет запланированных смен.\n\nИспользуй:\n🤖 'Автозаполнение графика' - для автоматического заполнения\n📅 'Добавить смену' - для ручного добавления")
+    if not context.args:
+        lines = [f"🌍 Часовой пояс: {settings.get('timezone', DEFAULT_TIMEZONE)}"]
+        for variant in reminder_variants(settings):
+            if variant[0] == 'daily':
+                lines.append(f"🔔 Каждый день в {variant[1].strftime('%H:%M')} - о завтрашней смене")
+            else:
+                names = ", ".join(SHIFT_TYPES[t]['name'].lower() for t in variant[2])
+                lines.append(f"⏰ За {variant[1]} ч. до начала: {names}")
+        if len(lines) == 1:
+            lines.append("🔕 Напоминания выключены")
+        await update.message.reply_text(
+            "\n".join(lines) + "\n\n"
+            "/reminder 21:30 - ежедневное напоминание в 21:30\n"
+            "/reminder off - выключить ежедневное напоминание\n"
+            "/before 12 night - напомнить за 12 ч. до ночной смены\n"
+            "/before off - убрать напоминания до смены\n"
+            "/timezone Europe/Moscow - сменить часовой пояс"
+        )
         return
     
-    user_schedule = schedule[user_id]
+    if context.args[0].lower() == 'off':
+        settings['daily'] = None
+        reply = "🔕 Ежедневное напоминание выключено"
+    else:
+        try:
+            settings['daily'] = parse_hhmm(context.args[0]).strftime('%H:%M')
+        except ValueError:
+            await update.message.reply_text("❌ Неверный формат времени! Используй ЧЧ:ММ, например: /reminder 21:30")
+            return
+        reply = f"✅ Буду напоминать каждый день в {settings['daily']}"
     
-    # Сортируем даты
-    sorted_dates = sorted(user_schedule.keys(), key=lambda x: datetime.strptime(x, '%d.%m.%Y'))
+    storage.set_settings(user_id, settings)
+    get_reminder_scheduler().schedule_user(user_id, settings, datetime.now(pytz.utc))
+    await update.message.reply_text(reply)
+
+async def before_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /before - напоминание за N часов до начала смены"""
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    settings = storage.get_settings(user_id)
+    shifts_with_start = [t for t, info in SHIFT_TYPES.items() if 'start' in info]
     
-    # Показываем ближайшие 30 смен
-    today = datetime.now()
-    future_dates = [d for d in sorted_dates if datetime.strptime(d, '%d.%m.%Y') >= today][:30]
+    if context.args and context.args[0].lower() == 'off':
+        settings['before'] = []
+        reply = "🔕 Напоминания до смены удалены"
+    else:
+        try:
+            hours = int(context.args[0])
+            if not 1 <= hours <= 48:
+                raise ValueError
+            shift_types = context.args[1:] or shifts_with_start
+            if any(t not in shifts_with_start for t in shift_types):
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                "❌ Используй: /before ЧАСЫ [day|night]\n"
+                "Например: /before 12 night - за 12 ч. до ночной смены (от 1 до 48 ч.)"
+            )
+            return
+        settings.setdefault('before', []).append({'hours': hours, 'shifts': list(shift_types)})
+        names = ", ".join(SHIFT_TYPES[t]['name'].lower() for t in shift_types)
+        reply = f"✅ Напомню за {hours} ч. до начала: {names}"
     
-    if not future_dates:
-        await update.message.reply_text("📋 У тебя нет будущих смен в графике.")
+    storage.set_settings(user_id, settings)
+    get_reminder_scheduler().schedule_user(user_id, settings, datetime.now(pytz.utc))
+    await update.message.reply_text(reply)
+
+def parse_user_date(text, today):
+    """Дата из ДД.ММ.ГГГГ или ДД.ММ (текущий год)"""
+    if text.count('.') == 1:
+        day, month = text.split('.')
+        return date(today.year, int(month), int(day))
+    return parse_date(text)
+
+def user_link(user_id):
+    return f'<a href="tg://user?id={user_id}">{user_id}</a>'
+
+def is_admin(user_id):
+    """Администратор бота из ADMIN_IDS"""
+    return str(user_id) in ADMIN_IDS
+
+def get_visible_team(storage, name, user_id):
+    """Команда, если пользователь её руководитель, принявший приглашение участник или администратор бота
+
+    Приглашённые, но не принявшие приглашение состав и графики команды не видят, и в
+    /roster и /coverage попадают только team['members'] - те, кто согласился.
+    """
+    team = storage.get_team(name.lower())
+    if team is None or not (user_id == team['owner'] or user_id in team['members'] or is_admin(user_id)):
+        return None
+    return team
+
+def format_stats_counts(counts):
+    """Число смен каждого типа одной строкой: ☕8 🌙7 😴7 🎉8"""
+    return " ".join(f"{info['emoji']}{counts.get(shift_type, 0)}" for shift_type, info in SHIFT_TYPES.items())
+
+def count_worked(counts):
+    """Рабочие смены - типы со временем начала"""
+    return sum(counts.get(shift_type, 0) for shift_type, info in SHIFT_TYPES.items() if 'start' in info)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - сколько смен каждого типа за месяц и по месяцам года"""
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    today = date.today()
+    year, month = today.year, today.month
+    try:
+        if context.args and '.' in context.args[0]:
+            month, year = (int(part) for part in context.args[0].split('.'))
+            date(year, month, 1)
+        elif context.args:
+            year, month = int(context.args[0]), None
+            date(year, 1, 1)
+    except ValueError:
+        await update.message.reply_text("❌ Используй: /stats, /stats ММ.ГГГГ или /stats ГГГГ")
+        return
+    if not storage.has_schedule(user_id):
+        await update.message.reply_text(NO_SCHEDULE_TEXT)
         return
-    
-    message = "📋 <b>Твой график смен (ближайшие 30 дней):</b>\n\n"
-    
-    for date_str in future_dates:
-        shift_type = user_schedule[date_str]
-        shift_info = SHIFT_TYPES[shift_type]
-        date_obj = datetime.strptime(date_str, '%d.%m.%Y')
-        weekday = date_obj.strftime('%A')
-        weekday_ru = {
-            'Monday': 'Пн',
-            'Tuesday': 'Вт',
-            'Wednesday': 'Ср',
-            'Thursday': 'Чт',
-            'Friday': 'Пт',
-            'Saturday': 'Сб',
-            'Sunday': 'Вс'
-        }.get(weekday, weekday)
-        
-        # Отмечаем сегодня и завтра
-        if date_obj.date() == today.date():
-            marker = " 👈 СЕГОДНЯ"
-        elif date_obj.date() == (today + timedelta(days=1)).date():
-            marker = " 👉 ЗАВТРА"
-        else:
-            marker = ""
-        
-        message += f"{shift_info['emoji']} <b>{date_str}</b> ({weekday_ru}){marker}\n"
-    
-    total_count = len(sorted_dates)
-    message += f"\n📊 Всего смен в графике: {total_count}"
-    
-    await update.message.reply_text(message, parse_mode='HTML')
 
-async def delete_shift_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Начало удаления смены"""
+    months = [storage.month_stats(user_id, year, m) for m in range(1, 13)]
+    year_counts = defaultdict(int)
+    for counts in months:
+        for shift_type, count in counts.items():
+            year_counts[shift_type] += count
+
+    if month is not None:
+        counts = months[month - 1]
+        lines = [f"📊 <b>{MONTHS_RU[month - 1]} {year}</b>", ""]
+        for shift_type, info in SHIFT_TYPES.items():
+            lines.append(f"{info['emoji']} {info['name']}: {counts.get(shift_type, 0)}")
+        lines += [
+            f"💼 Рабочих смен: {count_worked(counts)}",
+            "",
+            f"За {year} год: {format_stats_counts(year_counts)}, рабочих смен: {count_worked(year_counts)}",
+        ]
+    else:
+        lines = [f"📊 <b>{year} год</b>", ""]
+        for number, counts in enumerate(months):
+            lines.append(f"{MONTHS_RU[number][:3]}: {format_stats_counts(counts)} 💼{count_worked(counts)}")
+        lines += ["", f"Всего: {format_stats_counts(year_counts)}, рабочих смен: {count_worked(year_counts)}"]
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /myid - свой id, чтобы руководитель добавил в команду"""
+    await update.message.reply_text(
+        f"🆔 Твой id: <code>{update.effective_user.id}</code>\n"
+        "Передай его руководителю, чтобы он пригласил тебя в команду, "
+        "а потом подтверди приглашение: /team join НАЗВАНИЕ",
+        parse_mode='HTML'
+    )
+
+async def team_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /team - создание команд и управление составом"""
     user_id = str(update.effective_user.id)
-    schedule = load_schedule()
-    
-    if user_id not in schedule or not schedule[user_id]:
-        await update.message.reply_text("📋 У тебя нет запланированных смен для удаления")
+    storage = get_storage()
+    args = context.args
+    usage = (
+        "👥 <b>Команды</b>\n\n"
+        "/team create НАЗВАНИЕ - создать команду\n"
+        "/team add НАЗВАНИЕ ID ... - пригласить участников (id из /myid)\n"
+        "/team join НАЗВАНИЕ - принять приглашение\n"
+        "/team leave НАЗВАНИЕ - выйти из команды или отклонить приглашение\n"
+        "/team remove НАЗВАНИЕ ID ... - убрать участников\n"
+        "/team delete НАЗВАНИЕ - удалить команду\n"
+        "/team НАЗВАНИЕ - состав команды\n"
+        "/autofill НАЗВАНИЕ - автографики участников одним списком (администраторы)\n"
+        "/roster НАЗВАНИЕ [ДД.ММ] - кто на какой смене\n"
+        "/coverage НАЗВАНИЕ [С ПО] - покрытие смен за период"
+    )
+
+    if not args:
+        teams, invitations = [], []
+        for name, team in storage.iter_teams():
+            if user_id in team['members']:
+                teams.append(name)
+            elif user_id in team['invited']:
+                invitations.append(name)
+        text = usage
+        if teams:
+            text += "\n\nТвои команды: " + ", ".join(sorted(teams))
+        if invitations:
+            text += "\n\n✉️ Приглашения: " + ", ".join(sorted(invitations)) + " (принять: /team join НАЗВАНИЕ)"
+        await update.message.reply_text(text, parse_mode='HTML')
+        return
+
+    action = args[0].lower()
+    if action not in ('create', 'add', 'remove', 'delete', 'join', 'leave'):
+        team = get_visible_team(storage, action, user_id)
+        if team is None:
+            await update.message.reply_text("❌ Команда не найдена")
+            return
+        members = ", ".join(user_link(member) for member in sorted(team['members'], key=int))
+        text = f"👥 <b>{action}</b>: {len(team['members'])} чел.\n{members}"
+        if team['invited'] and (user_id == team['owner'] or is_admin(user_id)):
+            text += f"\n✉️ Ждут подтверждения: {len(team['invited'])}"
+        await update.message.reply_text(text, parse_mode='HTML')
+        return
+
+    if len(args) < 2 or not TEAM_NAME_PATTERN.match(args[1]):
+        await update.message.reply_text(
+            "❌ Название команды: буквы, цифры, - и _, до 32 символов\n\n" + usage, parse_mode='HTML'
+        )
+        return
+    name = args[1].lower()
+    team = storage.get_team(name)
+
+    if action == 'create':
+        if team is not None:
+            await update.message.reply_text("❌ Команда с таким названием уже есть")
+            return
+        storage.set_team(name, user_id, {user_id})
+        await update.message.reply_text(f"✅ Команда {name} создана. Пригласи участников: /team add {name} ID")
+        return
+
+    if action == 'join':
+        if team is None or user_id not in team['invited']:
+            await update.message.reply_text(f"❌ Приглашения в команду {name} нет")
+            return
+        if not storage.accept_team_invite(name, user_id):
+            await update.message.reply_text(f"❌ Приглашения в команду {name} нет")
+            return
+        await update.message.reply_text(
+            f"✅ Ты в команде {name}: руководитель видит твой график в /roster и /coverage"
+        )
+        return
+
+    if action == 'leave':
+        if team is None or user_id not in team['members'] | team['invited']:
+            await update.message.reply_text("❌ Команда не найдена")
+            return
+        if user_id == team['owner']:
+            await update.message.reply_text(f"❌ Создатель не может выйти из команды, её можно удалить: /team delete {name}")
+            return
+        storage.remove_team_members(name, {user_id})
+        await update.message.reply_text(f"✅ Ты больше не в команде {name}")
+        return
+
+    if team is None or team['owner'] != user_id:
+        await update.message.reply_text("❌ Менять команду может только тот, кто её создал")
+        return
+
+    if action == 'delete':
+        storage.delete_team(name)
+        await update.message.reply_text(f"✅ Команда {name} удалена")
+        return
+
+    ids = {arg for arg in args[2:] if arg.isdigit()}
+    if not ids or len(ids) != len(args[2:]):
+        await update.message.reply_text(f"❌ Используй: /team {action} {name} ID ... (числа из /myid)")
+        return
+    # Состав меняем построчно, а не перезаписью всей команды: join/leave из другого
+    # воркера между чтением и записью не потеряется
+    if action == 'add':
+        # Без согласия никого не добавляем: участник сам принимает приглашение через /team join
+        if not storage.invite_team_members(name, ids):
+            await update.message.reply_text(f"❌ В команде может быть до {MAX_TEAM_SIZE} человек")
+            return
+    else:
+        storage.remove_team_members(name, ids - {user_id})
+    team = storage.get_team(name) or {'members': set(), 'invited': set()}
+    members, invited = team['members'], team['invited']
+    text = f"✅ В команде {name}: {len(members)} чел."
+    if invited:
+        text += f"\n✉️ Ждут подтверждения: {len(invited)}. Каждый принимает приглашение сам: /team join {name}"
+    await update.message.reply_text(text)
+
+async def autofill_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /autofill - автографики всей команды по списку одной операцией (только администраторы)"""
+    user_id = str(update.effective_user.id)
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Заполнять графики команды могут только администраторы бота")
         return ConversationHandler.END
-    
+    if not context.args or not TEAM_NAME_PATTERN.match(context.args[0]):
+        await update.message.reply_text("❌ Используй: /autofill КОМАНДА")
+        return ConversationHandler.END
+    name = context.args[0].lower()
+    team = get_storage().get_team(name)
+    if team is None or team['owner'] != user_id:
+        await update.message.reply_text("❌ Заполнять графики команды может только тот, кто её создал")
+        return ConversationHandler.END
+
+    context.user_data['autofill_team'] = name
     await update.message.reply_text(
-        "🗑 Введи дату смены для удаления в формате ДД.ММ.ГГГГ\n"
-        "Например: 18.01.2026\n\n"
-        "Или напиши 'отмена' для выхода"
+        f"🤖 <b>Автозаполнение команды {name}</b>\n\n"
+        "Пришли файл .csv или вставь строки текстом:\n"
+        "<code>123456,01.11.2026,day\n234567,01.11.2026,night,day day night night rest dayoff</code>\n\n"
+        "id участника, дата начала, первая смена и, если нужно, свой цикл через пробел "
+        "(по умолчанию день → ночь → отсыпной → выходной). Только участники, принявшие приглашение.\n"
+        "Или напиши 'отмена' для выхода",
+        parse_mode='HTML'
     )
-    return CHOOSING_DATE
+    return CHOOSING_AUTOFILL
 
-async def delete_shift_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Подтверждение удаления смены"""
-    text = update.message.text.strip()
-    
-    if text.lower() == 'отмена':
-        await update.message.reply_text("❌ Удаление отменено")
+async def receive_autofill(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Разбор списка команды и запись всех автографиков одной операцией хранилища"""
+    message = update.message
+    text = await read_uploaded_text(message)
+    if text is None:
+        return CHOOSING_AUTOFILL
+    if message.document is None and text.strip().lower() == 'отмена':
+        await message.reply_text("❌ Автозаполнение отменено")
         return ConversationHandler.END
-    
-    try:
-        # Проверяем формат даты
-        datetime.strptime(text, '%d.%m.%Y')
-        
-        user_id = str(update.effective_user.id)
-        schedule = load_schedule()
-        
-        if user_id in schedule and text in schedule[user_id]:
-            del schedule[user_id][text]
-            save_schedule(schedule)
-            await update.message.reply_text(f"✅ Смена на {text} удалена!")
-        else:
-            await update.message.reply_text(f"❌ Смена на {text} не найдена в графике")
-        
+
+    storage = get_storage()
+    name = context.user_data.get('autofill_team')
+    team = storage.get_team(name) if name else None
+    user_id = str(update.effective_user.id)
+    if team is None or team['owner'] != user_id or not is_admin(user_id):
+        await message.reply_text("❌ Команда не найдена")
         return ConversationHandler.END
-        
-    except ValueError:
+    if not await take_throttle_token(update, 'write'):
+        return CHOOSING_AUTOFILL
+
+    rules, errors = parse_autofill_roster(text)
+    # График меняем только тем, кто сам подтвердил участие в команде
+    outsiders = sorted((member for member in rules if member not in team['members']), key=int)
+    errors += [
+        f"id {member} ещё не принял приглашение в {name}" if member in team['invited']
+        else f"id {member} нет в команде {name}"
+        for member in outsiders
+    ]
+    if errors:
+        shown = "\n".join(errors[:10])
+        more = f"\n…и ещё {len(errors) - 10}" if len(errors) > 10 else ""
+        await message.reply_text(f"❌ Ничего не заполнено, исправь ошибки:\n{shown}{more}")
+        return CHOOSING_AUTOFILL
+    if not rules:
+        await message.reply_text("❌ Не нашёл ни одной строки. Пришли список ещё раз")
+        return CHOOSING_AUTOFILL
+
+    started = perf_counter()
+    storage.set_rule_batch(rules)
+    elapsed = perf_counter() - started
+    rate = len(rules) / elapsed if elapsed else float('inf')
+    logger.info(f"Автозаполнение команды {name}: {len(rules)} графиков за {elapsed:.3f} с ({rate:.0f} польз./с)")
+    context.user_data.pop('autofill_team', None)
+    await message.reply_text(
+        f"✅ Графики заполнены: {len(rules)} чел. из {len(team['members'])}\n"
+        f"⏱ {elapsed:.2f} с ({rate:.0f} польз./с)"
+    )
+    return ConversationHandler.END
+
+async def roster_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /roster - кто из команды на какой смене в указанный день"""
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    today = date.today()
+    try:
+        team = get_visible_team(storage, context.args[0], user_id)
+        day = parse_user_date(context.args[1], today) if len(context.args) > 1 else today
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Используй: /roster КОМАНДА [ДД.ММ.ГГГГ]")
+        return
+    if team is None:
+        await update.message.reply_text("❌ Команда не найдена")
+        return
+
+    (_, roster), = storage.rosters(team['members'], day, day)
+    lines = [f"👥 <b>{context.args[0].lower()}</b> на {format_date(day)} ({WEEKDAYS_RU[day.weekday()]})", ""]
+    for shift_type, shift_info in SHIFT_TYPES.items():
+        members = roster.get(shift_type, [])
+        names = ", ".join(user_link(member) for member in sorted(members, key=int)) or "—"
+        lines.append(f"{shift_info['emoji']} {shift_info['name']} ({len(members)}): {names}")
+    without_shift = len(team['members']) - sum(len(members) for members in roster.values())
+    if without_shift:
+        lines.append(f"❔ Без смены в графике: {without_shift}")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+async def coverage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /coverage - число людей на каждой смене по дням и дни без покрытия"""
+    user_id = str(update.effective_user.id)
+    storage = get_storage()
+    today = date.today()
+    try:
+        team = get_visible_team(storage, context.args[0], user_id)
+        start_date = parse_user_date(context.args[1], today) if len(context.args) > 1 else today
+        end_date = (parse_user_date(context.args[2], today) if len(context.args) > 2
+                    else start_date + timedelta(days=29))
+        if not 0 <= (end_date - start_date).days < MAX_COVERAGE_DAYS:
+            raise ValueError
+    except (IndexError, ValueError):
         await update.message.reply_text(
-            "❌ Неверный формат даты!\n"
-            "Используй формат: ДД.ММ.ГГГГ (например, 18.01.2026)"
+            f"❌ Используй: /coverage КОМАНДА [С ПО], даты ДД.ММ.ГГГГ, до {MAX_COVERAGE_DAYS} дней"
         )
-        return CHOOSING_DATE
+        return
+    if team is None:
+        await update.message.reply_text("❌ Команда не найдена")
+        return
 
-async def clear_all_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Очистить весь график"""
-    user_id = str(update.effective_user.id)
-    schedule = load_schedule()
-    
-    if user_id in schedule and schedule[user_id]:
-        count = len(schedule[user_id])
-        schedule[user_id] = {}
-        save_schedule(schedule)
-        await update.message.reply_text(f"✅ Весь график очищен! Удалено смен: {count}")
+    working_shifts = [t for t, info in SHIFT_TYPES.items() if 'start' in info]
+    lines = [
+        f"📊 <b>{context.args[0].lower()}</b>: {format_date(start_date)} - {format_date(end_date)}"
+        f" ({len(team['members'])} чел.)",
+        ""
+    ]
+    gaps = defaultdict(list)
+    for day, roster in storage.rosters(team['members'], start_date, end_date):
+        counts = " ".join(
+            f"{SHIFT_TYPES[t]['emoji']}{len(roster.get(t, ()))}" for t in working_shifts
+        )
+        missing = [t for t in working_shifts if not roster.get(t)]
+        for shift_type in missing:
+            gaps[shift_type].append(f"{day.day:02d}.{day.month:02d}")
+        lines.append(f"{'⚠️' if missing else '✅'} {day.day:02d}.{day.month:02d} {WEEKDAYS_RU[day.weekday()]}: {counts}")
+
+    lines.append("")
+    if gaps:
+        for shift_type in working_shifts:
+            days = gaps.get(shift_type)
+            if not days:
+                continue
+            lines.append(f"⚠️ Нет: {SHIFT_TYPES[shift_type]['name'].lower()} - {', '.join(days)}")
     else:
-        await update.message.reply_text("📋 У тебя нет смен для удаления")
+        lines.append("✅ Все смены покрыты")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
 
-async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Ежедневное напоминание в 20:05"""
-    schedule = load_schedule()
-    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%d.%m.%Y')
-    
-    for user_id, user_schedule in schedule.items():
-        if tomorrow in user_schedule:
-            shift_type = user_schedule[tomorrow]
-            shift_info = SHIFT_TYPES[shift_type]
-            
-            message = f"{shift_info['emoji']} Завтра {shift_info['name'].lower()}!"
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=int(user_id),
-                    text=message
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки напоминания пользователю {user_id}: {e}")
+async def verify_schedule_index(context: ContextTypes.DEFAULT_TYPE):
+    """Ночная сверка индекса дата -> пользователи с основными данными"""
+    storage = get_storage()
+    mismatched = storage.verify_index()
+    if not mismatched:
+        logger.info("Индекс графика совпадает с данными")
+    # Выборочно пересчитываем статистику текущего месяца по дням графика: и тех, у кого
+    # есть ручные смены, и тех, у кого только правила (счёт по формуле)
+    today = date.today()
+    users = sorted(storage.index.month_deltas.keys() | storage.index.user_rule_keys.keys())
+    for user_id in random.sample(users, min(STATS_CHECK_SAMPLE, len(users))):
+        from_index, recounted = storage.check_month_stats(user_id, today.year, today.month)
+        if from_index != recounted:
+            logger.warning(f"Статистика {user_id} за {today.month:02d}.{today.year} разошлась: {from_index} != {recounted}")
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена текущей операции"""
@@ -500,94 +4418,393 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Операция отменена", reply_markup=reply_markup)
     return ConversationHandler.END
 
-def main():
-    """Запуск бота"""
-    # Получаем токен из переменной окружения или используем значение по умолчанию
-    TOKEN = os.getenv('TELEGRAM_TOKEN', 'YOUR_BOT_TOKEN_HERE')
-    
-    if TOKEN == 'YOUR_BOT_TOKEN_HERE':
-        print("⚠️ ВНИМАНИЕ: Токен не установлен!")
-        print("Установи переменную окружения TELEGRAM_TOKEN или измени код")
+def update_user_id(update):
+    """user_id отправителя по сырому JSON апдейта (0, если отправителя нет)"""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if sender:
+                return sender['id']
+    return 0
+
+class UpdateRouter:
+    """Раздаёт апдейты воркерам по user_id: диалог пользователя всегда ведёт один воркер"""
+
+    def __init__(self, worker_count):
+        self.queues = [asyncio.Queue() for _ in range(worker_count)]
+
+    def dispatch(self, update):
+        self.queues[update_user_id(update) % len(self.queues)].put_nowait(update)
+
+    async def forward(self, index):
+        """Отправка апдейтов воркеру по постоянному TCP-соединению, по одному JSON в строке"""
+        queue = self.queues[index]
+        update = None
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', WORKER_BASE_PORT + index)
+            except OSError:
+                # Воркер ещё запускается или перезапускается
+                await asyncio.sleep(1)
+                continue
+            try:
+                while True:
+                    if update is None:
+                        update = await queue.get()
+                    writer.write(json.dumps(update, ensure_ascii=False).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    update = None
+            except OSError as e:
+                logger.warning(f"Соединение с воркером {index} потеряно: {e}")
+            finally:
+                writer.close()
+
+    async def handle_webhook(self, reader, writer):
+        """Приём апдейтов от Telegram в режиме webhook"""
+        try:
+            request = await read_http_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            if method != 'POST' or path.strip('/') != WEBHOOK_PATH.strip('/'):
+                await write_http_response(writer, '404 Not Found', b'not found\n')
+            elif WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+                await write_http_response(writer, '403 Forbidden', b'forbidden\n')
+            else:
+                update = json.loads(body)
+                if not isinstance(update, dict):
+                    raise ValueError("апдейт должен быть JSON-объектом")
+                self.dispatch(update)
+                await write_http_response(writer, '200 OK', b'')
+        except RequestTooLarge:
+            await write_http_response(writer, '413 Payload Too Large', b'too large\n')
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Webhook: неверный запрос: {e}")
+            await write_http_response(writer, '400 Bad Request', b'bad request\n')
+        finally:
+            writer.close()
+
+    async def poll(self, bot):
+        """Приём апдейтов через getUpdates"""
+        offset = 0
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except NetworkError as e:
+                logger.warning(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+async def run_router(token):
+    """Роутер кластера: получает апдейты от Telegram и раздаёт их воркерам"""
+    router = UpdateRouter(WORKER_COUNT)
+    forwarders = [asyncio.create_task(router.forward(index)) for index in range(WORKER_COUNT)]
+    api_urls = {}
+    if TELEGRAM_API_URL:
+        api_urls = {'base_url': f"{TELEGRAM_API_URL}/bot", 'base_file_url': f"{TELEGRAM_API_URL}/file/bot"}
+    try:
+        async with Bot(token, **api_urls) as bot:
+            if BOT_MODE == 'webhook':
+                await bot.set_webhook(
+                    f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    allowed_updates=ALLOWED_UPDATES,
+                    secret_token=WEBHOOK_SECRET or None,
+                )
+                server = await asyncio.start_server(router.handle_webhook, WEBHOOK_LISTEN, WEBHOOK_PORT)
+                print(f"🌐 Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+                async with server:
+                    await server.serve_forever()
+            else:
+                await bot.delete_webhook()
+                await router.poll(bot)
+    finally:
+        for task in forwarders:
+            task.cancel()
+
+async def run_worker(application, index):
+    """Воркер кластера: апдейты приходят от роутера, а не из Telegram"""
+    async def receive_updates(reader, writer):
+        try:
+            while line := await reader.readline():
+                await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+        finally:
+            writer.close()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        await post_init(application)
+        await application.start()
+        server = await asyncio.start_server(receive_updates, '127.0.0.1', WORKER_BASE_PORT + index)
+        logger.info(f"Воркер {index} принимает апдейты на 127.0.0.1:{WORKER_BASE_PORT + index}")
+        await stop.wait()
+        server.close()
+        await application.stop()
+    await post_shutdown(application)
+
+def run_cluster(token):
+    """Роутер и WORKER_COUNT воркеров с общей базой графика (только SQLite)"""
+    if STORAGE_BACKEND != 'sqlite':
+        print("⚠️ ВНИМАНИЕ: несколько воркеров работают только с STORAGE_BACKEND=sqlite")
         return
-    
-    # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+    # Схему базы и перенос из schedule.json делаем один раз, до запуска воркеров
+    # (роутеру индекс графика не нужен, поэтому хранилище не открываем)
+    conn = SqliteScheduleStorage.connect(SCHEDULE_DB)
+    try:
+        migrate_json_to_sqlite(SCHEDULE_FILE, SCHEDULE_DB, conn=conn)
+    finally:
+        conn.close()
+
+    workers = []
+    for index in range(WORKER_COUNT):
+        env = dict(os.environ)
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(METRICS_PORT + index)
+        # Общие лимиты заданы на весь кластер: у каждого воркера свой бак, поэтому
+        # каждому - его доля (лимит пользователя не делится: пользователь всегда у одного воркера)
+        env['THROTTLE_GLOBAL_READ_RATE'] = str(THROTTLE_GLOBAL_READ_RATE / WORKER_COUNT)
+        env['THROTTLE_GLOBAL_WRITE_RATE'] = str(THROTTLE_GLOBAL_WRITE_RATE / WORKER_COUNT)
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', str(index)], env=env))
+    print(f"🤖 Запущено воркеров: {WORKER_COUNT}")
+    try:
+        asyncio.run(run_router(token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.wait()
+
+def calendar_conversation(**kwargs):
+    """ConversationHandler для диалога с календарём: текстовые шаги и кнопки cal:
+
+    Календарь нажимают в любом сообщении бота: диалог ведётся по пользователю, а не по
+    сообщению (per_message=False), так и задумано. Предупреждение PTB об этом
+    заглушается только на время создания этих обработчиков.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message="If 'per_message=False'", category=PTBUserWarning)
+        return ConversationHandler(per_message=False, **kwargs)
+
+def register_handlers(application, persistent=False):
+    """Регистрация всех обработчиков бота"""
+    # Ограничение частоты - раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-2)
+    # Изменения других воркеров - до любого чтения индекса и кэшей
+    application.add_handler(TypeHandler(Update, refresh_storage), group=-1)
     
     # Обработчик автозаполнения графика
-    auto_schedule_handler = ConversationHandler(
+    auto_schedule_handler = calendar_conversation(
         entry_points=[
             MessageHandler(filters.Regex("🤖 Автозаполнение графика"), auto_schedule_start)
         ],
         states={
-            CHOOSING_AUTO_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, auto_schedule_receive_date)],
+            CHOOSING_AUTO_DATE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, auto_schedule_receive_date),
+                CallbackQueryHandler(auto_schedule_receive_date_calendar, pattern=r'^cal:'),
+            ],
             CHOOSING_AUTO_SHIFT: [MessageHandler(filters.TEXT & ~filters.COMMAND, auto_schedule_receive_shift)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         name="auto_schedule",
-        persistent=False
+        persistent=persistent
     )
     
     # Обработчик добавления смены
-    add_conv_handler = ConversationHandler(
+    add_conv_handler = calendar_conversation(
         entry_points=[
             MessageHandler(filters.Regex("📅 Добавить смену"), add_shift_start)
         ],
         states={
-            CHOOSING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_date)],
+            CHOOSING_DATE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_date),
+                CallbackQueryHandler(receive_date_calendar, pattern=r'^cal:'),
+            ],
             CHOOSING_SHIFT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_shift_type)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         name="add_shift",
-        persistent=False
+        persistent=persistent
     )
     
     # Обработчик удаления смены
-    delete_conv_handler = ConversationHandler(
+    delete_conv_handler = calendar_conversation(
         entry_points=[
             MessageHandler(filters.Regex("🗑 Удалить смену"), delete_shift_start)
         ],
         states={
-            CHOOSING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_shift_confirm)],
+            CHOOSING_DATE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, delete_shift_confirm),
+                CallbackQueryHandler(delete_shift_calendar, pattern=r'^cal:'),
+            ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         name="delete_shift",
-        persistent=False
+        persistent=persistent
+    )
+    
+    # Обработчик импорта графика из CSV/ICS
+    import_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            CHOOSING_IMPORT: [
+                MessageHandler(filters.Document.ALL | (filters.TEXT & ~filters.COMMAND), receive_import)
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name="import_schedule",
+        persistent=persistent
+    )
+    
+    # Автозаполнение графиков всей команды по списку
+    autofill_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('autofill', autofill_start)],
+        states={
+            CHOOSING_AUTOFILL: [
+                MessageHandler(filters.Document.ALL | (filters.TEXT & ~filters.COMMAND), receive_autofill)
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name="team_autofill",
+        persistent=persistent
     )
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("reminder", reminder_command))
+    application.add_handler(CommandHandler("before", before_command))
     application.add_handler(auto_schedule_handler)
     application.add_handler(add_conv_handler)
     application.add_handler(delete_conv_handler)
+    application.add_handler(import_conv_handler)
+    application.add_handler(autofill_conv_handler)
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("myid", myid_command))
+    application.add_handler(CommandHandler("team", team_command))
+    application.add_handler(CommandHandler("roster", roster_command))
+    application.add_handler(CommandHandler("coverage", coverage_command))
     application.add_handler(MessageHandler(filters.Regex("📋 Мой график"), show_schedule))
     application.add_handler(MessageHandler(filters.Regex("🗑 Очистить весь график"), clear_all_schedule))
     application.add_handler(MessageHandler(filters.Regex("ℹ️ Помощь"), help_command))
+    application.add_handler(CallbackQueryHandler(calendar_expired, pattern=r'^cal:'))
+
+def main():
+    """Запуск бота"""
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    
+    # python shift_bot_FINAL.py migrate - перенос schedule.json в SQLite без запуска бота
+    if command == 'migrate':
+        count = migrate_json_to_sqlite(SCHEDULE_FILE, SCHEDULE_DB)
+        print(f"✅ Перенесено в {SCHEDULE_DB}: {count}")
+        return
+    
+    # python shift_bot_FINAL.py journal [inspect|compact] - журнал без запуска бота
+    if command == 'journal':
+        if len(sys.argv) > 2 and sys.argv[2] == 'compact':
+            storage = JournalScheduleStorage()
+            storage.compact()
+            storage.close()
+        print("\n".join(inspect_journal()))
+        return
+    
+    # Получаем токен из переменной окружения или используем значение по умолчанию
+    TOKEN = os.getenv('TELEGRAM_TOKEN', 'YOUR_BOT_TOKEN_HERE')
+    
+    if TOKEN == 'YOUR_BOT_TOKEN_HERE':
+        print("⚠️ ВНИМАНИЕ: Токен не установлен!")
+        print("Установи переменную окружения TELEGRAM_TOKEN или измени код")
+        return
+    
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        print("⚠️ ВНИМАНИЕ: для режима webhook нужна переменная WEBHOOK_URL")
+        return
+    
+    # python shift_bot_FINAL.py cluster - роутер и WORKER_COUNT воркеров
+    if command == 'cluster':
+        run_cluster(TOKEN)
+        return
+    # python shift_bot_FINAL.py worker N - воркер кластера (запускается роутером)
+    worker_index = int(sys.argv[2]) if command == 'worker' else None
+    
+    # Создаем приложение
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    persistence = SqlitePersistence(PERSISTENCE_FILE) if PERSISTENCE_FILE else None
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
+    register_handlers(application, persistent=persistence is not None)
+    
+    # Метрики (если задан METRICS_PORT): время обработчиков и операций хранилища
+    if setup_metrics() is not None:
+        instrument_application(application)
     
     # Настройка ежедневного напоминания в 20:05
     job_queue = application.job_queue
-    
     if job_queue is not None:
-        # Время напоминания: 20:05 (по времени сервера)
-        # Для Render (UTC) и Украины (UTC+2/UTC+3), установи 18:05 для зимы
-        reminder_time = time(hour=18, minute=5, second=0)  # 18:05 UTC = 20:05 Киев (зима)
+        job_queue.run_repeating(log_throttle_stats, interval=THROTTLE_LOG_INTERVAL)
+    
+    if job_queue is not None and worker_index:
+        # В кластере напоминания рассылает только воркер 0
+        print(f"⏰ Воркер {worker_index}: напоминания рассылает воркер 0")
+    elif job_queue is not None:
+        # У каждого пользователя напоминания в его часовом поясе (с учётом перехода
+        # на летнее время), планировщик раз в минуту забирает созревшие корзины
+        get_reminder_scheduler()
+        job_queue.run_repeating(send_due_reminders, interval=60, first=60 - datetime.now().second)
+        print(f"⏰ Напоминания настроены: по умолчанию {DEFAULT_REMINDER_TIME} ({DEFAULT_TIMEZONE})")
         
-        job_queue.run_daily(
-            send_daily_reminder,
-            time=reminder_time,
-            days=(0, 1, 2, 3, 4, 5, 6)  # Каждый день недели
-        )
-        print("⏰ Напоминания настроены на 20:05 по Киеву (18:05 UTC)")
+        # Сверка индекса напоминаний с графиком, когда нагрузка минимальна
+        job_queue.run_daily(verify_schedule_index, time=time(hour=1, minute=0, second=0))
+        job_queue.run_daily(purge_reminder_outbox, time=time(hour=1, minute=30, second=0))
+        job_queue.run_daily(prune_storage_changes, time=time(hour=1, minute=45, second=0))
     else:
         print("⚠️ ВНИМАНИЕ: JobQueue не доступен!")
         print("📝 Выполни команду: pip install \"python-telegram-bot[job-queue]\"")
         print("🔄 После установки перезапусти бота")
     
     # Запуск бота
+    get_storage()
+    if worker_index is not None:
+        asyncio.run(run_worker(application, worker_index))
+        return
+    print(f"💾 Хранилище графика: {STORAGE_BACKEND}")
     print("🤖 Бот запущен и работает!")
     print("🤖 Используй 'Автозаполнение графика' для быстрого заполнения!")
     print("📱 Найди своего бота в Telegram и нажми /start")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        print(f"🌐 Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
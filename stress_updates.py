@@ -0,0 +1,176 @@
+"""Нагрузочная проверка параллельной обработки апдейтов: нет потерянных записей, есть рост пропускной способности
+
+Каждый пользователь одновременно проходит автозаполнение и несколько диалогов
+«Добавить смену» на разные даты. Все апдейты ставятся в очередь сразу, бот отвечает
+через заглушку Bot API с заданной задержкой. После прогона график каждого
+пользователя сверяется с ожидаемым.
+
+Запуск:
+    python stress_updates.py --users 200 --flows 3 --concurrency 1,8,64
+    python stress_updates.py --unsafe   # без очереди по пользователю - для сравнения
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from telegram import Update
+from telegram.ext import Application, SimpleUpdateProcessor
+from telegram.request import BaseRequest
+
+import shift_bot_FINAL as bot
+from replay_updates import BOT_USER, make_update
+
+# Кнопки выбора смены в диалогах
+SHIFT_BUTTONS = {
+    'day': '☕ Дневная смена',
+    'night': '🌙 Ночная смена',
+    'rest': '😴 Отсыпной',
+    'dayoff': '🎉 Выходной',
+}
+
+class FakeTelegramRequest(BaseRequest):
+    """Ответы Bot API без сети: каждый sendMessage занимает latency секунд"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        if api_method == 'getMe':
+            result = BOT_USER
+        elif api_method == 'sendMessage':
+            await asyncio.sleep(self.latency)
+            params = request_data.parameters
+            self.message_id += 1
+            result = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+def build_scenario(users, flows, rng):
+    """Апдейты всех пользователей и ожидаемый результат для каждого"""
+    anchor = date(2026, 11, 1)
+    per_user, expected = {}, {}
+    for user_id in range(1, users + 1):
+        start = rng.choice(bot.SHIFT_CYCLE)
+        texts = ['🤖 Автозаполнение графика', bot.format_date(anchor), SHIFT_BUTTONS[start]]
+        shifts = {}
+        for flow in range(flows):
+            day = anchor + timedelta(days=1 + flow)
+            shift_type = rng.choice(bot.SHIFT_CYCLE)
+            shifts[day] = shift_type
+            texts += ['📅 Добавить смену', bot.format_date(day), SHIFT_BUTTONS[shift_type]]
+        per_user[user_id] = texts
+        expected[str(user_id)] = (bot.ShiftRule(anchor, start, tuple(bot.SHIFT_CYCLE)), shifts)
+
+    # Все шаги пользователя подряд, как при быстрых нажатиях: худший случай для гонок
+    updates = []
+    for user_id, texts in per_user.items():
+        for text in texts:
+            updates.append(make_update(len(updates) + 1, user_id, text))
+    return updates, expected
+
+def count_lost(storage, expected):
+    """Сколько записей не дошло до графика или записано не туда"""
+    lost = 0
+    for user_id, (rule, shifts) in expected.items():
+        if storage.get_rules(user_id) != [rule]:
+            lost += 1
+        for day, shift_type in shifts.items():
+            if storage.get_shift(user_id, day) != shift_type:
+                lost += 1
+    return lost
+
+async def run(concurrency, updates, expected, latency, unsafe, backend):
+    workdir = tempfile.mkdtemp(prefix='shift_stress_')
+    if backend == 'sqlite':
+        storage = bot.SqliteScheduleStorage(os.path.join(workdir, 'schedule.db'))
+    elif backend == 'journal':
+        storage = bot.JournalScheduleStorage(
+            os.path.join(workdir, 'schedule.snapshot'), os.path.join(workdir, 'schedule.journal'),
+            os.path.join(workdir, 'schedule.json')
+        )
+    else:
+        storage = bot.JsonScheduleStorage(os.path.join(workdir, 'schedule.json'))
+    bot._storage = storage
+    # Кэши держат ссылку на хранилище предыдущего прогона
+    bot._render_cache = None
+    bot._calendar_cache = None
+    # Проверяются гонки при одновременных нажатиях: ограничение частоты здесь мешает
+    bot._update_throttle = bot.UpdateThrottle(read=(0, 0, 0), write=(0, 0, 0))
+
+    processor = SimpleUpdateProcessor(concurrency) if unsafe else bot.PerUserUpdateProcessor(concurrency)
+    application = (
+        Application.builder()
+        .token('123:test')
+        .request(FakeTelegramRequest(latency))
+        .updater(None)
+        .job_queue(None)
+        .concurrent_updates(processor)
+        .build()
+    )
+    bot.register_handlers(application)
+
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        for update in updates:
+            application.update_queue.put_nowait(Update.de_json(update, application.bot))
+        # Каждый апдейт отмечается в очереди только после обработки
+        await application.update_queue.join()
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    lost = count_lost(storage, expected)
+    storage.close()
+    return {
+        'concurrency': concurrency,
+        'updates': len(updates),
+        'seconds': round(elapsed, 3),
+        'updates_per_s': round(len(updates) / elapsed, 1),
+        'lost_writes': lost,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--flows', type=int, default=3, help='диалогов «Добавить смену» на пользователя')
+    parser.add_argument('--concurrency', default='1,8,64', help='значения concurrent_updates через запятую')
+    parser.add_argument('--latency', type=float, default=0.01, help='задержка ответа Bot API, с')
+    parser.add_argument('--backend', choices=('json', 'sqlite', 'journal'), default='json')
+    parser.add_argument('--unsafe', action='store_true',
+                        help='обычный concurrent_updates без очереди по пользователю')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.getLogger('telegram').setLevel(logging.WARNING)
+
+    updates, expected = build_scenario(args.users, args.flows, random.Random(args.seed))
+    failed = False
+    for concurrency in [int(n) for n in args.concurrency.split(',')]:
+        result = asyncio.run(run(concurrency, updates, expected, args.latency, args.unsafe, args.backend))
+        print(json.dumps(result))
+        failed = failed or result['lost_writes'] > 0
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Бот - один файл в корне репозитория, без пакета: делаем его импортируемым из тестов
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+"""Выгрузка графика в CSV/ICS, разбор файла обратно и импорт - тот же график"""
+import asyncio
+import tempfile
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import shift_bot_FINAL as bot
+
+EXPORTERS = {'csv': bot.iter_csv_export, 'ics': bot.iter_ics_export}
+TODAY = date(2026, 3, 10)
+
+def make_schedule(path):
+    storage = bot.JsonScheduleStorage(str(path))
+    storage.set_shifts('1', {date(2026, 1, 5): 'day', date(2026, 1, 6): 'night', date(2026, 1, 9): 'dayoff'})
+    storage.set_rule('1', bot.ShiftRule(date(2026, 2, 1), 'night', tuple(bot.SHIFT_CYCLE)))
+    # Поверх цикла: замена смены и день без смены
+    storage.set_shift('1', date(2026, 2, 3), 'day')
+    storage.delete_shift('1', date(2026, 2, 4))
+    return storage
+
+def export_text(storage, file_format):
+    start_date, end_date = bot.export_range(storage, '1', TODAY, 1)
+    chunks = EXPORTERS[file_format](storage, '1', start_date, end_date)
+    with tempfile.TemporaryFile() as file:
+        # Так же, как файл уходит пользователю и возвращается через read_uploaded_text
+        return bot.write_export(chunks, file).read().decode('utf-8-sig'), (start_date, end_date)
+
+@pytest.mark.parametrize('file_format', list(EXPORTERS))
+def test_export_parse_import_round_trip(tmp_path, file_format):
+    source = make_schedule(tmp_path / 'source.json')
+    text, (start_date, end_date) = export_text(source, file_format)
+
+    shifts, errors = bot.parse_import(text)
+    assert errors == []
+    target = bot.JsonScheduleStorage(str(tmp_path / 'target.json'))
+    target.set_shifts('1', shifts)
+
+    expected = source.get_range('1', start_date, end_date)
+    assert expected[0] == (date(2026, 1, 5), 'day')
+    assert date(2026, 2, 4) not in dict(expected)
+    assert dict(expected)[date(2026, 2, 3)] == 'day'
+    assert target.get_range('1', start_date, end_date) == expected
+
+    # Повторный импорт той же выгрузки ничего не меняет
+    target.set_shifts('1', bot.parse_import(export_text(target, file_format)[0])[0])
+    assert target.get_range('1', start_date, end_date) == expected
+
+@pytest.mark.parametrize('text, error', [
+    ("date,shift\n2026-01-05,day\n31.02.2026,night\n", "строка 3: неверная дата «31.02.2026»"),
+    ("05.01.2026;day\nзавтра;night\n", "строка 2: неверная дата «завтра»"),
+    ("2026-01-05,day\n2026-01-06,morning\n", "строка 2: неизвестная смена «morning»"),
+    (
+        "BEGIN:VCALENDAR\nBEGIN:VEVENT\nSUMMARY:day\nEND:VEVENT\nEND:VCALENDAR\n",
+        "событие в строке 2: нет даты DTSTART",
+    ),
+    (
+        "BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART;VALUE=DATE:20260230\nCATEGORIES:day\nEND:VEVENT\nEND:VCALENDAR\n",
+        "событие в строке 2: нет даты DTSTART",
+    ),
+    (
+        "BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART;VALUE=DATE:20260105\nSUMMARY:Обед\nEND:VEVENT\nEND:VCALENDAR\n",
+        "событие в строке 2: неизвестная смена «Обед»",
+    ),
+])
+def test_malformed_input_is_reported(text, error):
+    _, errors = bot.parse_import(text)
+    assert error in errors
+
+def test_malformed_import_writes_nothing(tmp_path, monkeypatch):
+    storage = bot.JsonScheduleStorage(str(tmp_path / 'schedule.json'))
+    monkeypatch.setattr(bot, '_storage', storage)
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(text="05.01.2026,day\n32.01.2026,night\n", document=None, reply_text=reply_text)
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1))
+    state = asyncio.run(bot.receive_import(update, None))
+
+    assert state == bot.CHOOSING_IMPORT
+    assert replies[0].startswith("❌ Ничего не импортировано")
+    assert storage.get_range('1', date(2026, 1, 1), date(2026, 2, 1)) == []
@@ -0,0 +1,131 @@
+"""JournalScheduleStorage: повтор журнала после перезапуска и после сбоев записи"""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import shift_bot_FINAL as bot
+
+USERS = [str(user_id) for user_id in range(1, 6)]
+BASE = date(2026, 1, 1)
+
+def open_storage(tmp_path, **kwargs):
+    return bot.JournalScheduleStorage(
+        str(tmp_path / 'schedule.snap'), str(tmp_path / 'schedule.journal'),
+        str(tmp_path / 'schedule.json'), **kwargs
+    )
+
+def state(storage):
+    """Всё содержимое хранилища в сравнимом виде (пустые пользователи не в счёт)"""
+    users = {}
+    for user_id, rules, overrides in storage.iter_users():
+        settings = storage.get_settings(user_id)
+        if rules or overrides or settings:
+            users[user_id] = (rules, sorted(overrides.items()), settings)
+    return users, dict(storage.iter_teams())
+
+def random_day(rng):
+    return BASE + timedelta(days=rng.randint(-30, 120))
+
+def random_operation(storage, rng):
+    user_id = rng.choice(USERS)
+    action = rng.random()
+    if action < 0.35:
+        storage.set_shift(user_id, random_day(rng), rng.choice([None, *bot.SHIFT_TYPES]))
+    elif action < 0.5:
+        storage.set_shifts(user_id, {random_day(rng): rng.choice(list(bot.SHIFT_TYPES)) for _ in range(5)})
+    elif action < 0.6:
+        storage.set_rule(user_id, bot.ShiftRule(random_day(rng), 'day', tuple(bot.SHIFT_CYCLE)))
+    elif action < 0.65:
+        storage.set_rule_batch({
+            other: bot.ShiftRule(random_day(rng), 'night', tuple(bot.SHIFT_CYCLE))
+            for other in rng.sample(USERS, 2)
+        })
+    elif action < 0.8:
+        storage.delete_shift(user_id, random_day(rng))
+    elif action < 0.85:
+        storage.clear_user(user_id)
+    elif action < 0.92:
+        storage.set_settings(user_id, {'reminders': rng.random() < 0.5})
+    elif action < 0.97:
+        storage.set_team('ops', user_id, {user_id}, set(rng.sample(USERS, 2)) - {user_id})
+    else:
+        storage.delete_team('ops')
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('compact_records', [bot.JOURNAL_COMPACT_RECORDS, 7])
+def test_reopen_restores_state(tmp_path, seed, compact_records):
+    rng = random.Random(seed)
+    storage = open_storage(tmp_path, compact_records=compact_records)
+    for _ in range(200):
+        random_operation(storage, rng)
+        if rng.random() < 0.1:
+            storage.flush()
+    expected = state(storage)
+    storage.close()
+
+    reopened = open_storage(tmp_path, compact_records=compact_records)
+    assert state(reopened) == expected
+    reopened.close()
+
+def test_torn_last_record_is_dropped(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.set_shifts('1', {BASE: 'day', BASE + timedelta(days=1): 'night'})
+    storage.flush()
+    expected = state(storage)
+    size = (tmp_path / 'schedule.journal').stat().st_size
+    storage.set_shift('1', BASE + timedelta(days=2), 'rest')
+    storage.close()
+
+    # Сбой посреди записи последней строки
+    journal = tmp_path / 'schedule.journal'
+    journal.write_bytes(journal.read_bytes()[:-5])
+    reopened = open_storage(tmp_path)
+    assert state(reopened) == expected
+    assert journal.stat().st_size == size
+    reopened.close()
+
+def test_bad_crc_stops_replay(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.set_shift('1', BASE, 'day')
+    storage.flush()
+    expected = state(storage)
+    storage.set_shift('1', BASE + timedelta(days=1), 'night')
+    storage.set_shift('2', BASE, 'rest')
+    storage.close()
+
+    # Портим предпоследнюю запись: и она, и всё после неё не применяются
+    journal = tmp_path / 'schedule.journal'
+    lines = journal.read_bytes().splitlines(keepends=True)
+    lines[-2] = lines[-2].replace(b'night', b'nigth')
+    journal.write_bytes(b''.join(lines))
+    reopened = open_storage(tmp_path)
+    assert state(reopened) == expected
+    reopened.close()
+
+def test_journal_of_old_generation_is_ignored(tmp_path):
+    storage = open_storage(tmp_path)
+    storage.set_shift('1', BASE, 'day')
+    storage.flush()
+    journal = tmp_path / 'schedule.journal'
+    old_journal = journal.read_bytes()
+    storage.compact()
+    expected = state(storage)
+    generation = storage.generation
+    storage.close()
+
+    # Сбой после записи снимка, но до замены журнала: на диске остался журнал прошлого
+    # поколения. Его записи (и та, которой нет в снимке) не применяются
+    stale = bot.encode_journal_record({'op': 'set', 'user': '9', 'shifts': {BASE.isoformat(): 'night'}})
+    journal.write_bytes(old_journal + stale)
+    reopened = open_storage(tmp_path)
+    assert state(reopened) == expected
+    assert bot.read_journal(str(journal))[:2] == (generation, [])
+    reopened.set_shift('2', BASE, 'rest')
+    expected = state(reopened)
+    reopened.close()
+
+    # Новый журнал пишется уже с текущим поколением и применяется
+    again = open_storage(tmp_path)
+    assert state(again) == expected
+    again.close()
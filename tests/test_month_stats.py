@@ -0,0 +1,72 @@
+"""Статистика месяца из индекса против пересчёта по дням графика - на всех хранилищах"""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import shift_bot_FINAL as bot
+
+BACKENDS = {
+    'json': lambda tmp_path: bot.JsonScheduleStorage(str(tmp_path / 'schedule.json')),
+    'journal': lambda tmp_path: bot.JournalScheduleStorage(
+        str(tmp_path / 'schedule.snap'), str(tmp_path / 'schedule.journal'), str(tmp_path / 'schedule.json')
+    ),
+    'sqlite': lambda tmp_path: bot.SqliteScheduleStorage(str(tmp_path / 'schedule.db')),
+}
+MONTHS = [(2025, 12), (2026, 1), (2026, 2), (2026, 3), (2026, 4)]
+
+@pytest.fixture(params=list(BACKENDS))
+def storage(request, tmp_path):
+    storage = BACKENDS[request.param](tmp_path)
+    yield storage
+    storage.close()
+
+def assert_stats_match(storage, user_id):
+    for year, month in MONTHS:
+        from_index, recounted = storage.check_month_stats(user_id, year, month)
+        assert from_index == recounted, (year, month)
+
+def test_rule_changes_across_month_boundaries(storage):
+    cycle = tuple(bot.SHIFT_CYCLE)
+    storage.set_rule('1', bot.ShiftRule(date(2025, 12, 20), 'day', cycle))
+    assert_stats_match(storage, '1')
+    # Новое правило посреди месяца и на последний день месяца
+    storage.set_rule('1', bot.ShiftRule(date(2026, 1, 31), 'night', cycle))
+    storage.set_rule('1', bot.ShiftRule(date(2026, 3, 1), 'rest', ('day', 'rest')))
+    assert_stats_match(storage, '1')
+    # Правило раньше уже действующих заменяет их начиная со своей даты
+    storage.set_rule('1', bot.ShiftRule(date(2026, 2, 14), 'dayoff', cycle))
+    assert_stats_match(storage, '1')
+
+def test_overrides_on_top_of_rules(storage):
+    storage.set_rule('1', bot.ShiftRule(date(2026, 1, 10), 'day', tuple(bot.SHIFT_CYCLE)))
+    storage.set_shifts('1', {date(2026, 1, 31): 'dayoff', date(2026, 2, 1): 'night', date(2025, 12, 31): 'day'})
+    storage.delete_shift('1', date(2026, 2, 2))
+    storage.set_shift('1', date(2026, 3, 1), None)
+    assert_stats_match(storage, '1')
+    # Ручная смена, снятая поверх правила, и повторная замена той же даты
+    storage.set_shift('1', date(2026, 1, 31), 'night')
+    storage.remove_shift('1', date(2026, 2, 1))
+    assert_stats_match(storage, '1')
+    # Правило с более ранней даты сбрасывает ручные смены после неё
+    storage.set_rule('1', bot.ShiftRule(date(2026, 1, 20), 'rest', tuple(bot.SHIFT_CYCLE)))
+    assert_stats_match(storage, '1')
+
+@pytest.mark.parametrize('seed', range(3))
+def test_random_schedule(storage, seed):
+    rng = random.Random(seed)
+    start = date(2025, 11, 15)
+    for _ in range(150):
+        user_id = rng.choice(['1', '2'])
+        day = start + timedelta(days=rng.randint(0, 170))
+        action = rng.random()
+        if action < 0.15:
+            storage.set_rule(user_id, bot.ShiftRule(day, rng.choice(bot.SHIFT_CYCLE), tuple(bot.SHIFT_CYCLE)))
+        elif action < 0.7:
+            storage.set_shift(user_id, day, rng.choice([None, *bot.SHIFT_TYPES]))
+        elif action < 0.95:
+            storage.delete_shift(user_id, day)
+        else:
+            storage.clear_user(user_id)
+    assert_stats_match(storage, '1')
+    assert_stats_match(storage, '2')
@@ -0,0 +1,88 @@
+"""PackedShifts против простой модели-словаря {ordinal: тип смены или None}"""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import shift_bot_FINAL as bot
+
+SHIFT_VALUES = [None, *bot.SHIFT_TYPES]
+BASE = date(2026, 1, 1).toordinal()
+
+def random_day(rng):
+    # В основном рядом, иногда далеко: страницы и вперемешку, и с большими пропусками
+    if rng.random() < 0.1:
+        return rng.randint(1, date.max.toordinal())
+    return BASE + rng.randint(-400, 800)
+
+def check_against_model(shifts, model, rng):
+    assert list(shifts.items()) == sorted(model.items())
+    assert len(shifts) == len(model)
+    assert shifts.count_filled() == sum(1 for value in model.values() if value)
+    for _ in range(20):
+        start = random_day(rng)
+        end = start + rng.randint(0, 600)
+        expected = sorted((day, value) for day, value in model.items() if start <= day <= end)
+        assert list(shifts.irange(start, end)) == expected
+    restored, end = bot.PackedShifts.from_buffer(b'xx' + shifts.to_bytes(), 2)
+    assert end == 2 + len(shifts.to_bytes())
+    assert list(restored.items()) == list(shifts.items())
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_operations_match_dict_model(seed):
+    rng = random.Random(seed)
+    shifts, model = bot.PackedShifts(), {}
+    for _ in range(300):
+        action = rng.random()
+        day = random_day(rng)
+        if action < 0.6:
+            value = rng.choice(SHIFT_VALUES)
+            shifts.set(day, value)
+            model[day] = value
+        elif action < 0.85:
+            shifts.remove(day)
+            model.pop(day, None)
+        elif action < 0.95:
+            # Удаление того, что уже есть, - чтобы страницы освобождались
+            if model:
+                day = rng.choice(list(model))
+                shifts.remove(day)
+                del model[day]
+        else:
+            shifts.truncate_from(day)
+            model = {d: value for d, value in model.items() if d < day}
+        if rng.random() < 0.1:
+            check_against_model(shifts, model, rng)
+    check_against_model(shifts, model, rng)
+
+def test_batch_constructor_matches_model():
+    rng = random.Random(7)
+    items = [(random_day(rng), rng.choice(SHIFT_VALUES)) for _ in range(500)]
+    model = dict(items)
+    check_against_model(bot.PackedShifts(items), model, rng)
+
+def test_update_matches_set_per_day():
+    rng = random.Random(11)
+    shifts, model = bot.PackedShifts([(BASE, 'day'), (BASE + 5, 'night')]), {BASE: 'day', BASE + 5: 'night'}
+    for _ in range(5):
+        items = [(random_day(rng), rng.choice(SHIFT_VALUES)) for _ in range(200)]
+        shifts.update(items)
+        model.update(items)
+        check_against_model(shifts, model, rng)
+    shifts.update([])
+    check_against_model(shifts, model, rng)
+
+def test_copy_is_not_affected_by_later_writes():
+    shifts = bot.PackedShifts([(BASE, 'day')])
+    copy = shifts.copy()
+    shifts.set(BASE + 1, 'night')
+    assert list(copy.items()) == [(BASE, 'day')]
+
+@pytest.mark.parametrize('start, size', [
+    (date(2026, 1, 1), 212),
+    # Год задевает три страницы по 256 дней
+    (date.fromordinal(date(2026, 1, 1).toordinal() // 256 * 256 + 200), 312),
+])
+def test_year_size(start, size):
+    year = [((start + timedelta(days=i)).toordinal(), 'day') for i in range(365)]
+    assert len(bot.PackedShifts(year).to_bytes()) == size
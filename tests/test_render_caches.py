@@ -0,0 +1,74 @@
+"""Кэши "Мой график" и календаря не отдают ответ для устаревших (версия графика, дата)"""
+from datetime import date, timedelta
+
+import pytest
+
+import shift_bot_FINAL as bot
+
+BACKENDS = {
+    'json': lambda tmp_path: bot.JsonScheduleStorage(str(tmp_path / 'schedule.json')),
+    'journal': lambda tmp_path: bot.JournalScheduleStorage(
+        str(tmp_path / 'schedule.snap'), str(tmp_path / 'schedule.journal'), str(tmp_path / 'schedule.json')
+    ),
+    'sqlite': lambda tmp_path: bot.SqliteScheduleStorage(str(tmp_path / 'schedule.db')),
+}
+TODAY = date(2026, 3, 10)
+CYCLE = tuple(bot.SHIFT_CYCLE)
+
+# Каждый метод записи графика хранилища меняет то, что видно в ответе на TODAY
+WRITES = {
+    'set_shift': lambda storage: storage.set_shift('1', date(2026, 3, 12), 'day'),
+    'set_shifts': lambda storage: storage.set_shifts('1', {date(2026, 3, 12): 'day', date(2026, 3, 13): 'night'}),
+    'set_rule': lambda storage: storage.set_rule('1', bot.ShiftRule(date(2026, 3, 11), 'day', CYCLE)),
+    'set_rule_batch': lambda storage: storage.set_rule_batch({'1': bot.ShiftRule(date(2026, 3, 11), 'dayoff', CYCLE)}),
+    'remove_shift': lambda storage: storage.remove_shift('1', date(2026, 3, 14)),
+    'delete_shift': lambda storage: storage.delete_shift('1', date(2026, 3, 12)),
+    'clear_user': lambda storage: storage.clear_user('1'),
+}
+
+@pytest.fixture(params=list(BACKENDS))
+def storage(request, tmp_path):
+    storage = BACKENDS[request.param](tmp_path)
+    storage.set_rule('1', bot.ShiftRule(date(2026, 3, 1), 'day', CYCLE))
+    storage.set_shift('1', date(2026, 3, 14), 'dayoff')
+    yield storage
+    storage.close()
+
+def fresh(storage, today):
+    """Ответы, построенные заново без кэша"""
+    return (
+        bot.render_schedule_reply(storage, '1', today),
+        bot.build_calendar_markup(storage, '1', today.year, today.month, today).to_dict(),
+    )
+
+def cached(render_cache, calendar_cache, today):
+    return (
+        render_cache.get('1', today),
+        calendar_cache.get('1', today.year, today.month, today).to_dict(),
+    )
+
+@pytest.mark.parametrize('write', list(WRITES))
+def test_schedule_change_is_not_served_stale(storage, write):
+    # Без слушателя хранилища: устаревание видно только по версии графика
+    render_cache = bot.ScheduleRenderCache(storage)
+    calendar_cache = bot.CalendarKeyboardCache(storage)
+    before = cached(render_cache, calendar_cache, TODAY)
+    assert cached(render_cache, calendar_cache, TODAY) == before
+    assert (render_cache.hits, calendar_cache.hits) == (1, 1)
+
+    WRITES[write](storage)
+    after = fresh(storage, TODAY)
+    assert after[0] != before[0] and after[1] != before[1]
+    assert cached(render_cache, calendar_cache, TODAY) == after
+
+def test_day_change_is_not_served_stale(storage):
+    render_cache = bot.ScheduleRenderCache(storage)
+    calendar_cache = bot.CalendarKeyboardCache(storage)
+    before = cached(render_cache, calendar_cache, TODAY)
+
+    # Наступил следующий день: другая отметка «сегодня» и другой список ближайших смен
+    tomorrow = TODAY + timedelta(days=1)
+    after = fresh(storage, tomorrow)
+    assert after[0] != before[0] and after[1] != before[1]
+    assert cached(render_cache, calendar_cache, tomorrow) == after
+    assert (render_cache.hits, calendar_cache.hits) == (0, 0)